@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+CSR Arena
+=========
+
+:class:`CSRArena` stores rows of many small sparse matrices in a few
+contiguous numpy buffers (``data``, ``indices`` and ``indptr`` of
+a single large CSR matrix). Compared to a list of scipy matrices, it
+doesn't have per-matrix Python object overhead, and a matrix made of
+arbitrary stored rows is assembled with a couple of fancy-indexing
+operations instead of ``sparse.vstack``.
+
+Rows are appended to the end; removed rows are only marked as dead.
+Space is reclaimed by :meth:`CSRArena.compact`, which returns a mapping
+from old to new row ids, so that callers can update references.
+
+Rows can be saved to a directory of ``.npy`` files with
+:meth:`CSRArena.save`; as rows are append-only between compactions,
+repeated saves to the same directory only write rows appended
+since the previous save.
+
+:class:`MmapCSRArena` keeps the same buffers in memory-mapped files,
+so that the OS page cache decides which rows stay in RAM.
+"""
+import shutil
+import tempfile
+import uuid
+import weakref
+from pathlib import Path
+from typing import Optional, Dict, Any, List
+
+import numpy as np
+from scipy import sparse  # type: ignore
+
+from deepdeep.utils import resized, chunks
+
+
+class CSRArena:
+    """
+    Append-only storage for rows of sparse matrices with
+    the same number of columns.
+
+    >>> arena = CSRArena()
+    >>> arena.append(sparse.csr_matrix([[1, 0, 2], [0, 3, 0]]))
+    0
+    >>> arena.append(sparse.csr_matrix([[0, 0, 4]]))
+    2
+    >>> arena.take([2, 0]).toarray().tolist()
+    [[0, 0, 4], [1, 0, 2]]
+    >>> arena.free(0, 2)
+    >>> arena.compact().tolist()
+    [-1, -1, 0]
+    >>> len(arena), arena.n_dead
+    (1, 0)
+
+    ``live_nbytes`` attribute is the memory used by live rows;
+    it is updated incrementally.
+    """
+    def __init__(self,
+                 n_features: Optional[int]=None,
+                 dtype=None,
+                 capacity: int=1024) -> None:
+        self.n_features = n_features
+        self.dtype = dtype
+        self._data = self._allocate('data', capacity, dtype or np.float64)
+        self._indices = self._allocate('indices', capacity, np.int32)
+        self._indptr = self._allocate('indptr', capacity + 1, np.int64)
+        self._live = np.zeros(capacity, dtype=bool)
+        self._n_rows = 0
+        self.n_dead = 0
+        self.live_nbytes = 0
+        # changed when row ids change; see save()
+        self.uid = uuid.uuid4().hex
+
+    def __len__(self) -> int:
+        """ Number of stored rows, including dead rows """
+        return self._n_rows
+
+    @property
+    def nnz(self) -> int:
+        return int(self._indptr[self._n_rows])
+
+    def nbytes(self) -> int:
+        """ Memory used by stored rows, including dead rows """
+        return self._nbytes(self._n_rows, self.nnz)
+
+    def _nbytes(self, n_rows: int, nnz: int) -> int:
+        return int(nnz * (self._data.itemsize + self._indices.itemsize) +
+                   n_rows * (self._indptr.itemsize + self._live.itemsize))
+
+    def rows_nbytes(self, rows: np.ndarray) -> int:
+        """ Memory used by ``rows`` """
+        nnz = (self._indptr[rows + 1] - self._indptr[rows]).sum()
+        return self._nbytes(len(rows), nnz)
+
+    def is_live(self, start: int, n_rows: int=1) -> bool:
+        """ Return True if all ``n_rows`` rows from ``start`` are live """
+        return bool(self._live[start:start + n_rows].all())
+
+    def append(self, m: sparse.spmatrix) -> int:
+        """
+        Append rows of a sparse matrix ``m``;
+        return an id of the first appended row.
+        """
+        m = m if sparse.isspmatrix_csr(m) else sparse.csr_matrix(m)
+        self._set_format(m.shape[1], m.dtype)
+        start = self._n_rows
+        self._write(m.data, m.indices, m.indptr)
+        return start
+
+    def _set_format(self, n_features: int, dtype) -> None:
+        if self.n_features is None:
+            self.n_features = n_features
+        elif n_features != self.n_features:
+            raise ValueError("Matrix has %d columns, %d expected" % (
+                n_features, self.n_features))
+        if self.dtype is None:
+            self.dtype = np.dtype(dtype)
+            self._data = self._allocate('data', len(self._data), dtype)
+
+    def _write(self,
+               data: np.ndarray,
+               indices: np.ndarray,
+               indptr: np.ndarray) -> None:
+        """
+        Write rows of a CSR matrix with ``data``, ``indices``
+        and ``indptr`` arrays after the last stored row.
+        """
+        start, nnz = self._n_rows, self.nnz
+        n_rows, m_nnz = len(indptr) - 1, indptr[-1]
+        self._reserve(start + n_rows, nnz + m_nnz)
+        self._data[nnz:nnz + m_nnz] = data[:m_nnz]
+        self._indices[nnz:nnz + m_nnz] = indices[:m_nnz]
+        self._indptr[start + 1:start + n_rows + 1] = indptr[1:] + nnz
+        self._live[start:start + n_rows] = True
+        self._n_rows += n_rows
+        self.live_nbytes += self._nbytes(n_rows, m_nnz)
+
+    def free(self, start: int, n_rows: int) -> None:
+        """ Mark ``n_rows`` rows starting from ``start`` as dead """
+        self.free_rows(np.arange(start, start + n_rows))
+
+    def free_rows(self, rows) -> None:
+        """ Mark ``rows`` as dead """
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        rows = rows[self._live[rows]]
+        self.n_dead += len(rows)
+        self.live_nbytes -= self.rows_nbytes(rows)
+        self._live[rows] = False
+
+    def retain(self, rows) -> None:
+        """ Mark all rows except ``rows`` as dead """
+        live = np.zeros(len(self._live), dtype=bool)
+        live[np.asarray(rows, dtype=np.int64)] = True
+        self._live = live
+        self.n_dead = self._n_rows - int(live.sum())
+        self.live_nbytes = self.rows_nbytes(self.live_rows())
+
+    def take(self, rows) -> sparse.csr_matrix:
+        """ Return a CSR matrix made of stored ``rows`` """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self._indptr[rows]
+        lengths = self._indptr[rows + 1] - starts
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        pos = (np.repeat(starts - indptr[:-1], lengths) +
+               np.arange(indptr[-1], dtype=np.int64))
+        return sparse.csr_matrix(
+            (self._data[pos], self._indices[pos], indptr),
+            shape=(len(rows), self.n_features or 0))
+
+    def tocsr(self,
+              start: int=0,
+              stop: Optional[int]=None) -> sparse.csr_matrix:
+        """
+        Return a CSR matrix with stored rows from ``start`` to ``stop``
+        (all rows by default), including dead rows. Row data is
+        not copied, so the matrix is valid only until the next
+        append or compaction.
+        """
+        stop = self._n_rows if stop is None else stop
+        data, indices, indptr = self._rows_arrays(start, stop)
+        return sparse.csr_matrix((data, indices, indptr),
+                                 shape=(stop - start, self.n_features or 0))
+
+    def live_rows(self) -> np.ndarray:
+        """ Return ids of rows which are not dead """
+        return np.flatnonzero(self._live[:self._n_rows])
+
+    def compact(self, chunk_size: int=65536) -> np.ndarray:
+        """
+        Remove dead rows; order of live rows is preserved.
+        Return an array which maps old row ids to new row ids
+        (-1 for removed rows).
+
+        Rows are moved in place, ``chunk_size`` rows at a time:
+        a live row never moves forward, so a chunk is only written
+        over rows which are already read.
+        """
+        live = self.live_rows()
+        mapping = np.full(self._n_rows, -1, dtype=np.int64)
+        mapping[live] = np.arange(len(live))
+        n_rows = self._n_rows
+        self._n_rows = 0
+        self.live_nbytes = 0
+        for rows in chunks(live, chunk_size):
+            m = self.take(rows)
+            self._write(m.data, m.indices, m.indptr)
+        self._live[self._n_rows:n_rows] = False
+        self.n_dead = 0
+        self.uid = uuid.uuid4().hex
+        return mapping
+
+    def save(self,
+             path: Path,
+             name: str,
+             previous: Optional[Dict[str, Any]]=None,
+             row_arrays: Optional[Dict[str, np.ndarray]]=None,
+             ) -> Dict[str, Any]:
+        """
+        Save all rows (including dead rows) to ``.npy`` files
+        in ``path`` directory; file names start with ``name``.
+        ``row_arrays`` are arrays with a value for each row which are
+        saved along with the rows. Return a dict with information
+        about saved files, to be passed to :meth:`load`.
+
+        Rows are saved in chunks. If ``previous`` (a dict returned by an
+        earlier call for the same directory) is passed, and rows are not
+        compacted since then, only rows appended after that call
+        are written, as a new chunk.
+        """
+        row_arrays = row_arrays or {}
+        chunks_ = []  # type: List[List[int]]
+        if (previous and previous['uid'] == self.uid and
+                sorted(previous['row_arrays']) == sorted(row_arrays)):
+            chunks_ = [list(chunk) for chunk in previous['chunks']]
+        start = chunks_[-1][1] if chunks_ else 0
+        if start < self._n_rows:
+            prefix = str(path / self._chunk_name(name, start))
+            data, indices, indptr = self._rows_arrays(start, self._n_rows)
+            np.save(prefix + '.data.npy', data)
+            np.save(prefix + '.indices.npy', indices)
+            np.save(prefix + '.indptr.npy', indptr)
+            for key, values in row_arrays.items():
+                np.save('%s.%s.npy' % (prefix, key),
+                        values[start:self._n_rows])
+            chunks_.append([start, self._n_rows])
+        suffixes = ['data', 'indices', 'indptr'] + sorted(row_arrays)
+        return {
+            'name': name,
+            'uid': self.uid,
+            'n_features': self.n_features,
+            'dtype': None if self.dtype is None else np.dtype(self.dtype).str,
+            'row_arrays': sorted(row_arrays),
+            'chunks': chunks_,
+            'files': ['%s.%s.npy' % (self._chunk_name(name, start), suffix)
+                      for start, _ in chunks_ for suffix in suffixes],
+        }
+
+    def load(self,
+             path: Path,
+             info: Dict[str, Any],
+             mmap: bool=False,
+             ) -> Dict[str, np.ndarray]:
+        """
+        Load rows saved by :meth:`save` to ``path`` (``info`` is a dict
+        returned by :meth:`save`) into an empty arena; all loaded rows
+        are live. Return a dict with saved row arrays.
+
+        With ``mmap=True`` files are memory-mapped and copied to the arena
+        chunk by chunk, without reading a whole chunk to RAM first; it
+        allows to load rows to :class:`MmapCSRArena` larger than RAM.
+        """
+        assert self._n_rows == 0, "arena is not empty"
+        self.uid = info['uid']
+        if info['n_features'] is not None:
+            self._set_format(info['n_features'], np.dtype(info['dtype']))
+        row_arrays = {
+            key: [] for key in info['row_arrays']
+        }  # type: Dict[str, List[np.ndarray]]
+        for start, stop in info['chunks']:
+            prefix = str(path / self._chunk_name(info['name'], start))
+            self._write(*[np.load('%s.%s.npy' % (prefix, suffix),
+                                  mmap_mode='r' if mmap else None)
+                          for suffix in ['data', 'indices', 'indptr']])
+            for key, values in row_arrays.items():
+                values.append(np.load('%s.%s.npy' % (prefix, key)))
+        return {key: (np.concatenate(values) if values
+                      else np.zeros(0, dtype=np.int64))
+                for key, values in row_arrays.items()}
+
+    def _rows_arrays(self, start: int, stop: int):
+        """
+        Return ``data``, ``indices`` and ``indptr`` arrays of a CSR matrix
+        with rows from ``start`` to ``stop``.
+        """
+        nnz_start, nnz_stop = self._indptr[start], self._indptr[stop]
+        return (self._data[nnz_start:nnz_stop],
+                self._indices[nnz_start:nnz_stop],
+                self._indptr[start:stop + 1] - nnz_start)
+
+    def _chunk_name(self, name: str, start: int) -> str:
+        return '%s-%s-%d' % (name, self.uid, start)
+
+    def _reserve(self, n_rows: int, nnz: int) -> None:
+        if n_rows > len(self._live):
+            capacity = max(n_rows, 2 * len(self._live))
+            self._live = resized(self._live, capacity)
+            self._indptr = self._grow('indptr', self._indptr, capacity + 1)
+        if nnz > len(self._data):
+            capacity = max(nnz, 2 * len(self._data))
+            self._data = self._grow('data', self._data, capacity)
+            self._indices = self._grow('indices', self._indices, capacity)
+
+    def _allocate(self, name: str, size: int, dtype) -> np.ndarray:
+        """ Return a new zero-filled buffer ``name`` """
+        return np.zeros(size, dtype=dtype)
+
+    def _grow(self, name: str, buf: np.ndarray, size: int) -> np.ndarray:
+        """ Return buffer ``name`` resized to ``size`` elements """
+        return resized(buf, size)
+
+
+class MmapCSRArena(CSRArena):
+    """
+    :class:`CSRArena` which keeps ``data``, ``indices`` and ``indptr``
+    buffers in memory-mapped files in a new temporary directory
+    inside ``path``; the directory is removed when the arena is
+    garbage collected. Only a "live" flag per row is kept in RAM.
+
+    Rows are read from disk only when they are accessed, so
+    :meth:`take` on a few rows is cheap even if the arena is much
+    larger than RAM, as long as the OS page cache can hold the rows
+    which are used often.
+
+    When the arena is pickled, used parts of its buffers are pickled
+    inline, as views of the memory-mapped files: ``joblib.dump`` writes
+    them in small blocks, without copying whole buffers to RAM first.
+    An unpickled arena writes rows to files in its own directory.
+    """
+    def __init__(self,
+                 path: str,
+                 n_features: Optional[int]=None,
+                 dtype=None,
+                 capacity: int=65536) -> None:
+        self.path = path
+        Path(path).mkdir(parents=True, exist_ok=True)
+        self._dir = Path(tempfile.mkdtemp(prefix='arena-', dir=path))
+        self._finalizer = weakref.finalize(
+            self, shutil.rmtree, str(self._dir), ignore_errors=True)
+        super().__init__(n_features=n_features, dtype=dtype,
+                         capacity=capacity)
+
+    def _allocate(self, name: str, size: int, dtype) -> np.ndarray:
+        filename = self._dir / ('%s.bin' % name)
+        with filename.open('wb') as f:
+            f.truncate(size * np.dtype(dtype).itemsize)
+        return np.memmap(str(filename), dtype=dtype, mode='r+', shape=size)
+
+    def _grow(self, name: str, buf: Any, size: int) -> np.ndarray:
+        # The file is extended in place; new part is zero-filled by OS,
+        # and existing rows are not copied.
+        buf.flush()
+        filename = self._dir / ('%s.bin' % name)
+        with filename.open('r+b') as f:
+            f.truncate(size * buf.dtype.itemsize)
+        return np.memmap(str(filename), dtype=buf.dtype, mode='r+',
+                         shape=size)
+
+    def __getstate__(self):
+        dct = self.__dict__.copy()
+        nnz, n_rows = self.nnz, self._n_rows
+        # np.asarray makes ndarray views, not copies
+        dct['_data'] = np.asarray(self._data[:nnz])
+        dct['_indices'] = np.asarray(self._indices[:nnz])
+        dct['_indptr'] = np.asarray(self._indptr[:n_rows + 1])
+        dct['_live'] = self._live[:n_rows].copy()
+        for key in ['_dir', '_finalizer']:
+            del dct[key]
+        return dct
+
+    def __setstate__(self, state):
+        n_rows, data = len(state['_live']), state['_data']
+        self.__init__(state['path'], n_features=state['n_features'],
+                      dtype=state['dtype'], capacity=max(n_rows, 1))
+        self._reserve(n_rows, len(data))
+        self._data[:len(data)] = data
+        self._indices[:len(data)] = state['_indices']
+        self._indptr[:n_rows + 1] = state['_indptr']
+        self._live[:n_rows] = state['_live']
+        self._n_rows = n_rows
+        self.n_dead = state['n_dead']
+        self.live_nbytes = state.get('live_nbytes')
+        if self.live_nbytes is None:
+            self.live_nbytes = self.rows_nbytes(self.live_rows())
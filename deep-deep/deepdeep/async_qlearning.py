@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous Q-Learning
+=======================
+
+:class:`AsyncQLearner` provides the same interface as
+:class:`deepdeep.qlearning.QLearner`, but training happens in a separate
+learner process. This process owns the experience replay memory and
+the online Q function; experiences are streamed to it, and each
+``steps_before_switch`` updates it publishes target Q function weights
+to memory-mapped .npy files. The crawler process only uses target weights
+to score links, so it never blocks on training.
+
+The queue of experiences is bounded: if the learner falls behind,
+new experiences are dropped (and counted) instead of piling up
+in crawler RAM. If the learner process fails, the error is sent
+to the crawler process, which raises :class:`LearnerError`.
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import time
+import traceback
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import joblib  # type: ignore
+import numpy as np
+from scipy import sparse  # type: ignore
+
+from deepdeep.qlearning import QLearner, LinearScorer
+from deepdeep.ftrl import SparseLinearScorer, HashedLinearScorer
+
+
+logger = logging.getLogger(__name__)
+
+
+class LearnerError(RuntimeError):
+    """ The learner process failed or exited unexpectedly """
+
+
+class AsyncQLearner:
+    """
+    :math:`Q(s, a)` function trained in a separate learner process.
+
+    Parameters
+    ----------
+    on_model_changed : callable, optional
+        Function to call in the crawler process when new target
+        :math:`Q(s, a)` function weights are received.
+    weights_path : str, optional
+        A directory to publish target :math:`Q(s, a)` function weights to.
+        By default a temporary directory is created; it is removed
+        when the learner is closed.
+
+    All other keyword arguments are passed to :class:`QLearner`
+    which is created in the learner process.
+
+    Call :meth:`close` to stop the learner process.
+
+    At most ``max_pending`` tasks are queued for the learner;
+    experiences which don't fit are dropped, ``n_dropped`` counts them.
+    """
+    join_As = QLearner.join_As
+    join_as = QLearner.join_as
+
+    max_pending = 1000
+
+    # how often to check that the learner is alive while waiting for it
+    poll_interval = 1.0
+
+    def __init__(self, *,
+                 on_model_changed: Optional[Callable[[], None]]=None,
+                 weights_path: Optional[str]=None,
+                 **qlearner_kwargs) -> None:
+        self.on_model_changed = on_model_changed
+        self.factored = qlearner_kwargs.get('factored', False)
+        defaults = QLearner.__init__.__kwdefaults__ or {}
+        self.initial_predictions = qlearner_kwargs.get(
+            'initial_predictions', defaults['initial_predictions'])
+        self.t_ = 0
+        self.target_version_ = 0
+        self.memory = RemoteMemoryStats()
+        self._status = {}  # type: Dict[str, Any]
+        self._scorer = None  # type: Optional[LinearScorer]
+        self._sync_id = 0
+        self._closed = False
+        self._error = None  # type: Optional[str]
+        self.n_dropped = 0
+
+        self._remove_weights_path = weights_path is None
+        if weights_path is None:
+            weights_path = tempfile.mkdtemp(prefix='deepdeep-weights-')
+        self.weights_path = Path(weights_path)
+        self.weights_path.mkdir(parents=True, exist_ok=True)
+
+        # spawn is used because the crawler process runs Twisted reactor
+        # and has threads, so forking it is not safe
+        ctx = multiprocessing.get_context('spawn')
+        self._tasks = ctx.Queue(self.max_pending)
+        self._updates = ctx.Queue()
+        self._process = ctx.Process(
+            target=_learner_main,
+            args=(qlearner_kwargs, str(self.weights_path),
+                  self._tasks, self._updates),
+            name='deepdeep-learner',
+            daemon=True,
+        )
+        self._process.start()
+
+    def add_experience(self, as_t, AS_t1, r_t1,
+                       domain: Optional[str]=None) -> None:
+        """
+        Send the observed experience to the learner process.
+        This method doesn't wait for the learner: if too many tasks
+        are queued, the experience is dropped.
+        """
+        self.t_ += 1
+        self.receive_updates()
+        try:
+            self._tasks.put_nowait(('experience', as_t, AS_t1, r_t1, domain))
+        except queue.Full:
+            self.n_dropped += 1
+            if self.n_dropped & (self.n_dropped - 1) == 0:  # power of 2
+                logger.warning("Learner process falls behind, %d experiences "
+                               "are dropped so far", self.n_dropped)
+
+    def receive_updates(self) -> None:
+        """
+        Process status updates sent by the learner process, load the latest
+        target :math:`Q(s, a)` function weights if they are changed and call
+        ``on_model_changed``. It is called automatically in
+        :meth:`add_experience`. :class:`LearnerError` is raised
+        if the learner process is dead.
+        """
+        latest = None
+        while True:
+            try:
+                latest = self._updates.get_nowait()
+            except queue.Empty:
+                break
+            self._check_error(latest)
+        if latest is not None:
+            self._process_status(latest)
+        else:
+            self._check_alive()
+
+    def sync(self, timeout: Optional[float]=None) -> None:
+        """
+        Wait until the learner process handles all experiences sent so far
+        and process its updates. ``queue.Empty`` is raised on timeout,
+        and :class:`LearnerError` if the learner process is dead.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._sync_id += 1
+        self._put(('sync', self._sync_id))
+        while True:
+            try:
+                status = self._updates.get(timeout=self.poll_interval)
+            except queue.Empty:
+                self._check_alive()
+                if deadline is not None and time.monotonic() > deadline:
+                    raise
+                continue
+            self._check_error(status)
+            self._process_status(status)
+            if status.get('sync_id') == self._sync_id:
+                return
+
+    def _put(self, task) -> None:
+        """ Queue a task, waiting while the learner process is alive """
+        while True:
+            self._check_alive()
+            try:
+                self._tasks.put(task, timeout=self.poll_interval)
+                return
+            except queue.Full:
+                pass
+
+    def _check_alive(self) -> None:
+        if self._error is not None:
+            raise LearnerError(self._error)
+        if self._closed or self._process.is_alive():
+            return
+        # the error could be sent right before the process exited
+        while True:
+            try:
+                self._check_error(self._updates.get(timeout=0.1))
+            except queue.Empty:
+                break
+        raise LearnerError("Learner process exited unexpectedly "
+                           "(exit code %s)" % self._process.exitcode)
+
+    def _check_error(self, status: Dict[str, Any]) -> None:
+        if 'error' in status:
+            self._error = "Learner process failed:\n%s" % status['error']
+            raise LearnerError(self._error)
+
+    def _process_status(self, status: Dict[str, Any]) -> None:
+        self._status = status
+        self.memory.update(status)
+        version = status['version']
+        if version == self.target_version_ or status['weights'] is None:
+            return
+        try:
+            arrays = {name: np.load(path, mmap_mode='r')
+                      for name, path in status['weights'].items()}
+        except FileNotFoundError:
+            # weights are already replaced by a newer version;
+            # they will be loaded on the next update.
+            return
+        scorer_cls = _SCORERS[status['scorer']]
+        self._scorer = scorer_cls(intercept=status['intercept'], **arrays)
+        self.target_version_ = version
+        if self.on_model_changed is not None:
+            self.on_model_changed()
+
+    def target_scorer(self) -> Optional[LinearScorer]:
+        """
+        Return a scorer for the latest target :math:`Q(s, a)` function
+        received from the learner process, or None if there is no one yet.
+        """
+        return self._scorer
+
+    def predict(self, AS: sparse.csr_matrix, online: bool=False) -> np.ndarray:
+        """
+        Compute Q(s, a) function for all state-action pairs using
+        the latest target :math:`Q(s, a)` function received from
+        the learner process.
+
+        Online :math:`Q(s, a)` function is not available in
+        the crawler process, so ``online`` argument is ignored.
+        """
+        if self._scorer is None:
+            return np.ones(AS.shape[0]) * self.initial_predictions
+        return self._scorer.predict(AS)
+
+    def predict_one(self, as_, online=False) -> float:
+        """ Compute Q(s, a) function for a single state-action pair """
+        if self._scorer is None:
+            return self.initial_predictions
+        return self._scorer.predict_one(as_)
+
+    def coef_norm(self, online: bool=True) -> float:
+        """
+        Return L2 norm of classifier weights, as reported
+        by the learner process.
+        """
+        key = 'coef_norm_online' if online else 'coef_norm_target'
+        return float(self._status.get(key, 0))
+
+    def warm_start(self, Q: QLearner, memory: bool=False,
+                   resume: bool=False) -> None:
+        """
+        Send QLearner ``Q`` to the learner process and initialize
+        learner's Q functions with its weights
+        (see :meth:`deepdeep.qlearning.QLearner.warm_start`).
+        Target weights are received as a regular update.
+        """
+        if resume:
+            self.t_ = Q.t_
+        Q.pickle_memory = memory
+        self._put(('warm_start', Q, memory, resume))
+
+    def dump(self, path: Path, data: Dict, pickle_memory: bool) -> None:
+        """
+        Ask the learner process to save ``data`` dict with
+        the learner's QLearner added as ``Q`` key to ``path``.
+        This method doesn't wait for the dump to finish.
+        """
+        data = {k: v for k, v in data.items() if k != 'Q'}
+        self._put(('dump', str(path), data, pickle_memory))
+
+    def save_memory(self, path: str) -> None:
+        """
+        Ask the learner process to save experience replay memory
+        to ``path`` directory (see
+        :meth:`deepdeep.qlearning.ExperienceMemory.save`).
+        This method doesn't wait for the save to finish.
+        """
+        self._put(('save_memory', path))
+
+    def load_memory(self, path: str, mmap: bool=False) -> None:
+        """
+        Ask the learner process to load experience replay memory
+        from ``path`` directory (see
+        :meth:`deepdeep.qlearning.ExperienceMemory.load`).
+        """
+        self._put(('load_memory', path, mmap))
+
+    def close(self, timeout: float=30) -> None:
+        """ Stop the learner process """
+        self._closed = True
+        if self._process.is_alive():
+            try:
+                self._tasks.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self._process.join(timeout)
+            if self._process.is_alive():
+                logger.warning("Learner process didn't stop in time, "
+                               "terminating it.")
+                self._process.terminate()
+        # tasks which are still queued are never read, and waiting
+        # to flush them would block interpreter exit
+        self._tasks.cancel_join_thread()
+        if self._remove_weights_path:
+            shutil.rmtree(str(self.weights_path), ignore_errors=True)
+
+    def __getstate__(self):
+        raise TypeError("AsyncQLearner can't be pickled; use dump() "
+                        "to save the model from the learner process.")
+
+
+class RemoteMemoryStats:
+    """
+    Experience replay memory stats, as reported by the learner process
+    on each target switch.
+    """
+    def __init__(self) -> None:
+        self._len = 0
+        self._nbytes = 0
+
+    def update(self, status: Dict[str, Any]) -> None:
+        self._len = status['memory_size']
+        self._nbytes = status['memory_nbytes']
+
+    def __len__(self) -> int:
+        return self._len
+
+    def nbytes(self) -> int:
+        return self._nbytes
+
+
+def _learner_main(qlearner_kwargs: Dict[str, Any],
+                  weights_path: str,
+                  tasks: Any,
+                  updates: Any) -> None:
+    """
+    Entry point of the learner process; errors are logged
+    and sent to the crawler process.
+    """
+    try:
+        _learn(qlearner_kwargs, weights_path, tasks, updates)
+    except Exception:
+        logger.exception("Learner process failed")
+        updates.put({'error': traceback.format_exc()})
+
+
+def _learn(qlearner_kwargs: Dict[str, Any],
+           weights_path: str,
+           tasks: Any,
+           updates: Any) -> None:
+    Q = QLearner(**qlearner_kwargs)
+    publisher = _WeightsPublisher(Path(weights_path), updates)
+    Q.on_model_changed = lambda: publisher.publish(Q)
+    for task in iter(tasks.get, None):
+        name, args = task[0], task[1:]
+        if name == 'experience':
+            Q.add_experience(*args)
+        elif name == 'dump':
+            path, data, pickle_memory = args
+            _dump(Q, path, data, pickle_memory)
+            publisher.send_status(Q)
+        elif name == 'save_memory':
+            Q.memory.save(*args)
+            publisher.send_status(Q)
+        elif name == 'load_memory':
+            Q.memory.load(*args)
+            publisher.send_status(Q)
+        elif name == 'warm_start':
+            Q.warm_start(*args)
+            publisher.publish(Q)
+        elif name == 'sync':
+            publisher.send_status(Q, sync_id=args[0])
+        else:
+            raise ValueError("Unknown task: %r" % name)
+
+
+class _WeightsPublisher:
+    """
+    Save target Q function weights to .npy files which can be
+    memory-mapped by the crawler process and send status updates.
+    """
+    keep_versions = 3
+
+    def __init__(self, path: Path, updates: Any) -> None:
+        self.path = path
+        self.updates = updates
+        self.weights = None  # type: Optional[Dict[str, str]]
+        self.scorer = None  # type: Optional[str]
+        self.intercept = 0.0
+        self._published = []  # type: List[List[Path]]
+
+    def publish(self, Q: QLearner) -> None:
+        scorer = Q._get_scorer(online=False)
+        if scorer is not None:
+            weights = {}
+            for name, array in scorer.arrays().items():
+                path = self.path / ('target-%d-%s.npy' % (
+                    Q.target_version_, name))
+                tmp_path = path.with_suffix('.tmp')
+                with tmp_path.open('wb') as f:
+                    np.save(f, array)
+                os.replace(str(tmp_path), str(path))
+                weights[name] = str(path)
+            self.weights = weights
+            self.scorer = type(scorer).__name__
+            self.intercept = scorer.intercept
+            self._published.append([Path(p) for p in weights.values()])
+        self.send_status(Q)
+        # The crawler process can still use an older version;
+        # it is fine to remove files which are memory-mapped.
+        while len(self._published) > self.keep_versions:
+            for path in self._published.pop(0):
+                path.unlink()
+
+    def send_status(self, Q: QLearner, **extra) -> None:
+        status = {
+            't': Q.t_,
+            'version': Q.target_version_,
+            'weights': self.weights,
+            'scorer': self.scorer,
+            'intercept': self.intercept,
+            'memory_size': len(Q.memory),
+            'memory_nbytes': Q.memory.nbytes(),
+            'coef_norm_online': Q.coef_norm(online=True),
+            'coef_norm_target': Q.coef_norm(online=False),
+        }
+        status.update(extra)
+        self.updates.put(status)
+
+
+_SCORERS = {
+    cls.__name__: cls for cls in [
+        LinearScorer, SparseLinearScorer, HashedLinearScorer]
+}
+
+
+def _dump(Q: QLearner, path: str, data: Dict, pickle_memory: bool) -> None:
+    data = dict(data, Q=Q)
+    Q.pickle_memory = pickle_memory
+    try:
+        joblib.dump(data, path, compress=3)
+    finally:
+        Q.pickle_memory = False
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Eviction Policies
+=================
+
+Eviction policies decide which example is removed from
+:class:`deepdeep.qlearning.ExperienceMemory` when it is full.
+Memory tells the policy about examples stored at integer slots
+(``add``, ``remove``, ``move`` and ``update`` methods), and asks it
+to ``choose`` a slot to evict. All operations are O(1) or O(log n)
+amortized, so that eviction cost doesn't depend on memory size.
+
+Available policies:
+
+* ``'random'`` (:class:`RandomEviction`) - a random example is evicted;
+* ``'oldest'`` (:class:`OldestEviction`) - the example which is stored
+  for the longest time is evicted, i.e. memory is a FIFO queue;
+* ``'lowest_priority'`` (:class:`LowestPriorityEviction`) - the example
+  with the lowest sampling priority is evicted; it requires
+  prioritized experience replay.
+"""
+import heapq
+import random
+from collections import deque
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+from deepdeep.utils import resized
+
+
+class EvictionPolicy:
+    """ Base class for eviction policies """
+    needs_priorities = False
+
+    def add(self, idx: int, priority: float) -> None:
+        """ A new example is stored at slot ``idx`` """
+
+    def remove(self, idx: int) -> None:
+        """ An example at slot ``idx`` is removed """
+
+    def move(self, src: int, dst: int) -> None:
+        """ An example is moved from slot ``src`` to slot ``dst`` """
+
+    def update(self, indices: np.ndarray, priorities: np.ndarray) -> None:
+        """ Priorities of examples at ``indices`` are changed """
+
+    def clear(self) -> None:
+        """ All examples are removed """
+
+    def choose(self, size: int) -> int:
+        """
+        Return a slot of an example to evict;
+        examples are stored at slots ``0 <= idx < size``.
+        """
+        raise NotImplementedError()
+
+
+class RandomEviction(EvictionPolicy):
+    """ Evict a random example """
+    def choose(self, size: int) -> int:
+        return random.randint(0, size - 1)
+
+
+class _TrackedEviction(EvictionPolicy):
+    """
+    Base class for policies which need to identify examples:
+    each stored example gets a unique increasing id.
+    """
+    def __init__(self) -> None:
+        self.clear()
+
+    def clear(self) -> None:
+        self._next_id = 0
+        self._ids = np.zeros(0, dtype=np.int64)  # slot -> id
+        self._slots = {}  # type: Dict[int, int]
+
+    def add(self, idx: int, priority: float) -> None:
+        if idx >= len(self._ids):
+            self._ids = resized(self._ids, max(idx + 1, 2 * len(self._ids)))
+        id_ = self._next_id
+        self._next_id += 1
+        self._ids[idx] = id_
+        self._slots[id_] = idx
+        self._added(id_, idx, priority)
+
+    def remove(self, idx: int) -> None:
+        del self._slots[int(self._ids[idx])]
+
+    def move(self, src: int, dst: int) -> None:
+        id_ = int(self._ids[src])
+        self._ids[dst] = id_
+        self._slots[id_] = dst
+
+    def _added(self, id_: int, idx: int, priority: float) -> None:
+        pass
+
+
+class OldestEviction(_TrackedEviction):
+    """ Evict the example which is stored for the longest time """
+    def clear(self) -> None:
+        super().clear()
+        self._queue = deque()  # type: deque
+
+    def _added(self, id_: int, idx: int, priority: float) -> None:
+        self._queue.append(id_)
+
+    def choose(self, size: int) -> int:
+        # ids of removed examples are dropped lazily
+        while self._queue[0] not in self._slots:
+            self._queue.popleft()
+        return self._slots[self._queue[0]]
+
+
+class LowestPriorityEviction(_TrackedEviction):
+    """
+    Evict the example with the lowest sampling priority.
+    A heap of ``(priority, id)`` entries is used; entries of removed
+    examples and outdated priorities are dropped lazily, and the heap is
+    rebuilt when most of its entries are outdated.
+    """
+    needs_priorities = True
+
+    def clear(self) -> None:
+        super().clear()
+        self._heap = []  # type: List[Tuple[float, int]]
+        self._priorities = np.zeros(0)  # slot -> priority
+
+    def _added(self, id_: int, idx: int, priority: float) -> None:
+        if idx >= len(self._priorities):
+            self._priorities = resized(self._priorities, len(self._ids))
+        self._priorities[idx] = priority
+        self._push(priority, id_)
+
+    def move(self, src: int, dst: int) -> None:
+        super().move(src, dst)
+        self._priorities[dst] = self._priorities[src]
+
+    def update(self, indices: np.ndarray, priorities: np.ndarray) -> None:
+        self._priorities[indices] = priorities
+        for idx in np.unique(indices):
+            self._push(float(self._priorities[idx]), int(self._ids[idx]))
+
+    def choose(self, size: int) -> int:
+        while True:
+            priority, id_ = self._heap[0]
+            idx = self._slots.get(id_)
+            if idx is not None and self._priorities[idx] == priority:
+                return idx
+            heapq.heappop(self._heap)
+
+    def _push(self, priority: float, id_: int) -> None:
+        heapq.heappush(self._heap, (priority, id_))
+        if len(self._heap) > 2 * len(self._slots) + 16:
+            self._heap = [(float(self._priorities[idx]), id_)
+                          for id_, idx in self._slots.items()]
+            heapq.heapify(self._heap)
+
+
+EVICTION_POLICIES = {
+    'random': RandomEviction,
+    'oldest': OldestEviction,
+    'lowest_priority': LowestPriorityEviction,
+}
+
+
+def make_eviction_policy(
+        eviction: Union[str, EvictionPolicy]) -> EvictionPolicy:
+    """
+    Return an eviction policy: ``eviction`` is either a policy name
+    (see :data:`EVICTION_POLICIES`) or an :class:`EvictionPolicy` instance.
+    """
+    if isinstance(eviction, EvictionPolicy):
+        return eviction
+    try:
+        return EVICTION_POLICIES[eviction]()
+    except KeyError:
+        raise ValueError("Unknown eviction policy: %r" % eviction)
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+FTRL-Proximal Learner
+=====================
+
+:class:`FTRLProximalRegressor` is an alternative to ``SGDRegressor``
+for :math:`Q(s, a)` function approximation. It uses per-coordinate
+adaptive learning rates and L1 regularization (see H. B. McMahan et al.,
+"Ad Click Prediction: a View from the Trenches", KDD 2013), and stores
+parameters only for features seen in training: a hash table
+(:class:`SlotTable`) maps feature ids to slots in append-only arrays,
+which grow by doubling. Hashed feature
+spaces are huge (millions of features), but only a small part of them
+is used in a crawl, so models are much smaller than dense ``coef_``
+arrays, adding features doesn't move stored parameters, and target
+Q function switches only copy non-zero weights.
+"""
+from typing import Any, Dict, Optional
+
+import numpy as np
+from scipy import sparse  # type: ignore
+from sklearn.base import BaseEstimator, RegressorMixin  # type: ignore
+from sklearn.exceptions import NotFittedError  # type: ignore
+
+from deepdeep.qlearning import LinearScorer, row_sums
+from deepdeep.utils import resized
+
+
+class FTRLProximalRegressor(BaseEstimator, RegressorMixin):
+    """
+    Linear regression (squared loss) trained with FTRL-Proximal.
+
+    Parameters
+    ----------
+    alpha : float
+        Learning rate scale (default: 0.1).
+    beta : float
+        Learning rate smoothing parameter (default: 1.0).
+    l1 : float
+        L1 regularization strength; larger values make more
+        weights exactly zero (default: 1.0).
+    l2 : float
+        L2 regularization strength (default: 1.0).
+
+    Minibatches passed to :meth:`partial_fit` are processed as
+    if examples were processed one by one with fixed weights.
+
+    Parameters of a feature are stored at its slot in ``keys_``, ``z_``,
+    ``n_`` and ``w_`` arrays (``slots_`` maps feature ids to slots);
+    only first ``n_features_`` slots are used.
+    """
+    def __init__(self,
+                 alpha: float=0.1,
+                 beta: float=1.0,
+                 l1: float=1.0,
+                 l2: float=1.0) -> None:
+        self.alpha = alpha
+        self.beta = beta
+        self.l1 = l1
+        self.l2 = l2
+
+    def partial_fit(self, X: sparse.spmatrix, y: np.ndarray,
+                    sample_weight: Optional[np.ndarray]=None,
+                    ) -> 'FTRLProximalRegressor':
+        """ Update the model using a minibatch of examples """
+        X = sparse.csr_matrix(X)
+        y = np.asarray(y, dtype=np.float64)
+        if sample_weight is None:
+            sample_weight = np.ones(X.shape[0])
+        if not hasattr(self, 'z_'):
+            self._init_params()
+
+        columns, inverse = np.unique(X.indices, return_inverse=True)
+        pos = self._add_features(columns)
+        weights = self.w_[pos]
+        pred = row_sums(X.data * weights[inverse], X.indptr)
+        pred += self.intercept_[0]
+        residuals = (pred - y) * sample_weight
+        row_residuals = np.repeat(residuals, np.diff(X.indptr))
+        grad = X.data * row_residuals
+        g = np.bincount(inverse, weights=grad, minlength=len(columns))
+        g2 = np.bincount(inverse, weights=grad ** 2, minlength=len(columns))
+
+        self.z_[pos], self.n_[pos] = self._update(
+            self.z_[pos], self.n_[pos], weights, g, g2)
+        self.w_[pos] = self._weights(self.z_[pos], self.n_[pos], self.l1,
+                                     self.l2)
+
+        # intercept is not regularized
+        z0, n0 = self._update(self.intercept_z_, self.intercept_n_,
+                              self.intercept_, residuals.sum(),
+                              (residuals ** 2).sum())
+        self.intercept_z_ = z0  # type: np.ndarray
+        self.intercept_n_ = n0  # type: np.ndarray
+        self.intercept_ = self._weights(z0, n0, 0, 0)  # type: np.ndarray
+        return self
+
+    def predict(self, X: sparse.spmatrix) -> np.ndarray:
+        scorer = self.scorer()
+        if scorer is None:
+            raise NotFittedError("FTRLProximalRegressor is not fitted yet")
+        return scorer.predict(sparse.csr_matrix(X))
+
+    def scorer(self) -> Optional['SparseLinearScorer']:
+        """
+        Return a scorer which uses current weights without copying them,
+        or None if the model is not fitted yet.
+        """
+        if not hasattr(self, 'keys_'):
+            return None
+        if not hasattr(self, 'slots_'):
+            # parameters are set from trained_params() of another model
+            return SparseLinearScorer(self.keys_, self.w_, self.intercept_[0])
+        n = self.n_features_
+        return HashedLinearScorer(self.keys_[:n], self.w_[:n],
+                                  self.intercept_[0], slots=self.slots_)
+
+    def trained_params(self) -> Dict[str, Any]:
+        """
+        Return a copy of parameters needed for predictions;
+        only non-zero weights are included, sorted by feature id.
+        """
+        n = self.n_features_
+        nonzero = np.flatnonzero(self.w_[:n])
+        nonzero = nonzero[np.argsort(self.keys_[nonzero], kind='mergesort')]
+        return {
+            'keys_': self.keys_[nonzero],
+            'w_': self.w_[nonzero],
+            'intercept_': self.intercept_.copy(),
+        }
+
+    def _init_params(self) -> None:
+        self.slots_ = SlotTable()
+        self.n_features_ = 0
+        self.keys_ = np.zeros(0, dtype=np.int64)
+        self.z_ = np.zeros(0)
+        self.n_ = np.zeros(0)
+        self.w_ = np.zeros(0)
+        self.intercept_ = np.zeros(1)
+        self.intercept_z_ = np.zeros(1)
+        self.intercept_n_ = np.zeros(1)
+
+    def _add_features(self, columns: np.ndarray) -> np.ndarray:
+        """
+        Add parameters for new features from ``columns`` array
+        (without duplicates), return slots of ``columns`` parameters.
+        """
+        columns = columns.astype(np.int64, copy=False)
+        pos = self.slots_.get(columns)
+        new = np.flatnonzero(pos < 0)
+        if len(new):
+            start = self.n_features_
+            stop = start + len(new)
+            self._reserve(stop)
+            pos[new] = np.arange(start, stop)
+            self.keys_[start:stop] = columns[new]
+            self.slots_.add(columns[new], pos[new])
+            self.n_features_ = stop
+        return pos
+
+    def _reserve(self, n_features: int) -> None:
+        if n_features > len(self.keys_):
+            capacity = max(n_features, 2 * len(self.keys_))
+            self.keys_ = resized(self.keys_, capacity)
+            self.z_ = resized(self.z_, capacity)
+            self.n_ = resized(self.n_, capacity)
+            self.w_ = resized(self.w_, capacity)
+
+    def _update(self, z, n, w, g, g2):
+        sigma = (np.sqrt(n + g2) - np.sqrt(n)) / self.alpha
+        return z + g - sigma * w, n + g2
+
+    def _weights(self, z, n, l1, l2):
+        learning_rate = (self.beta + np.sqrt(n)) / self.alpha + l2
+        w = -(z - np.sign(z) * l1) / learning_rate
+        return np.where(np.abs(z) <= l1, 0.0, w)
+
+
+class SparseLinearScorer(LinearScorer):
+    """
+    :class:`deepdeep.qlearning.LinearScorer` for weights stored as a sorted
+    array of feature ids ``keys`` and an array of their weights ``values``;
+    weights of other features are zero.
+    """
+    def __init__(self, keys: np.ndarray, values: np.ndarray,
+                 intercept: float) -> None:
+        self.keys = keys
+        self.values = values
+        self.intercept = float(intercept)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {'keys': self.keys, 'values': self.values}
+
+    def coef_norm(self) -> float:
+        return float(np.sqrt((self.values ** 2).sum()))
+
+    def _weights(self, indices: np.ndarray) -> np.ndarray:
+        if not len(self.keys):
+            return np.zeros(len(indices))
+        pos = np.searchsorted(self.keys, indices)
+        pos[pos == len(self.keys)] = 0
+        return np.where(self.keys[pos] == indices, self.values[pos], 0)
+
+    def _dot(self, X: sparse.spmatrix, offset: int) -> np.ndarray:
+        if not sparse.isspmatrix_csr(X):
+            X = sparse.csr_matrix(X)
+        weights = self._weights(X.indices.astype(np.int64) + offset)
+        return row_sums(X.data * weights, X.indptr)
+
+
+class HashedLinearScorer(SparseLinearScorer):
+    """
+    :class:`SparseLinearScorer` for weights stored in an unsorted array
+    of feature ids ``keys`` and an array of their weights ``values``;
+    ``slots`` :class:`SlotTable` maps feature ids to positions in these
+    arrays (it is built from ``keys`` if not given). Ids mapped to positions
+    past the end of ``values`` are ignored, so ``slots`` can be shared
+    with a model which keeps adding features.
+    """
+    def __init__(self, keys: np.ndarray, values: np.ndarray,
+                 intercept: float,
+                 slots: Optional['SlotTable']=None) -> None:
+        super().__init__(keys, values, intercept)
+        if slots is None:
+            slots = SlotTable(len(keys))
+            slots.add(keys.astype(np.int64), np.arange(len(keys)))
+        self.slots = slots
+
+    def _weights(self, indices: np.ndarray) -> np.ndarray:
+        if not len(self.values):
+            return np.zeros(len(indices))
+        pos = self.slots.get(indices)
+        pos[pos >= len(self.values)] = -1
+        return np.where(pos >= 0, self.values[pos], 0)
+
+
+class SlotTable:
+    """
+    Hash table which maps non-negative int64 feature ids to slots.
+    It uses open addressing with linear probing in numpy arrays, so
+    lookups and inserts of arrays of ids don't run Python code per id.
+    The table is rebuilt twice as large when it is more than
+    ``max_load`` full.
+
+    >>> table = SlotTable()
+    >>> table.add(np.array([10, 3, 1 << 40]), np.array([0, 1, 2]))
+    >>> table.get(np.array([3, 5, 1 << 40, 10])).tolist()
+    [1, -1, 2, 0]
+    >>> len(table)
+    3
+    """
+    max_load = 0.5
+    _EMPTY = -1
+    _MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+    def __init__(self, capacity: int=0) -> None:
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int) -> None:
+        bits = 4
+        while (1 << bits) * self.max_load < capacity:
+            bits += 1
+        self._bits = bits
+        self._keys = np.full(1 << bits, self._EMPTY, dtype=np.int64)
+        self._slots = np.zeros(1 << bits, dtype=np.int64)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def get(self, keys: np.ndarray) -> np.ndarray:
+        """ Return slots of ``keys``, -1 for keys which are not stored """
+        keys = np.asarray(keys, dtype=np.int64)
+        pos = self._probe(keys)
+        return np.where(self._keys[pos] == keys, self._slots[pos], -1)
+
+    def add(self, keys: np.ndarray, slots: np.ndarray) -> None:
+        """ Store ``keys`` (without duplicates, not stored yet) """
+        if (self._size + len(keys)) > self.max_load * len(self._keys):
+            self._rebuild(self._size + len(keys))
+        self._insert(np.asarray(keys, dtype=np.int64),
+                     np.asarray(slots, dtype=np.int64))
+
+    def _insert(self, keys: np.ndarray, slots: np.ndarray) -> None:
+        while len(keys):
+            pos = self._probe(keys)
+            # keys probed to the same empty position compete for it:
+            # one of them is written, others are probed again
+            self._keys[pos] = keys
+            won = self._keys[pos] == keys
+            self._slots[pos[won]] = slots[won]
+            self._size += int(won.sum())
+            keys, slots = keys[~won], slots[~won]
+
+    def _probe(self, keys: np.ndarray) -> np.ndarray:
+        """ Return positions of ``keys``, or of empty cells for them """
+        mask = len(self._keys) - 1
+        hashes = keys.astype(np.uint64) * self._MULTIPLIER
+        pos = (hashes >> np.uint64(64 - self._bits)).astype(np.int64)
+        result = np.empty(len(keys), dtype=np.int64)
+        todo = np.arange(len(keys))
+        while len(todo):
+            found = self._keys[pos]
+            done = (found == keys[todo]) | (found == self._EMPTY)
+            result[todo[done]] = pos[done]
+            todo = todo[~done]
+            pos = (pos[~done] + 1) & mask
+        return result
+
+    def _rebuild(self, size: int) -> None:
+        used = self._keys != self._EMPTY
+        keys, slots = self._keys[used], self._slots[used]
+        self._allocate(max(size, 2 * self._size))
+        self._insert(keys, slots)
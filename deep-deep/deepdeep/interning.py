@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+"""
+Row Interning
+=============
+
+Navigation and footer links repeat on every page of a website, so the
+same link feature row is stored many times: in ``link_vector`` of each
+request and in ``AS_t1`` matrices of experience replay memory.
+
+:class:`RowInterner` stores each distinct sparse row once, in
+a :class:`deepdeep.arena.CSRArena`; rows are found by a hash of their
+content and are identified by integer ids. Each id has a reference count,
+and a row is freed when the count drops to zero.
+
+References can be released by the garbage collector at any allocation,
+including allocations in the middle of :meth:`RowInterner.intern`,
+so releases which happen while the interner is in use are queued and
+applied when it is done.
+
+Rows are referenced by:
+
+* :class:`InternedRow` objects, which are stored in request meta instead
+  of 1-row matrices; a reference is released when the object
+  is garbage collected, i.e. when a request is processed or dropped;
+* :class:`InternedArena`, a drop-in replacement for
+  :class:`deepdeep.arena.CSRArena` which stores row ids instead of rows;
+  it is used by :class:`deepdeep.qlearning.ExperienceMemory`.
+"""
+import hashlib
+import uuid
+from typing import Dict, List, Optional, Any
+
+import numpy as np
+from scipy import sparse  # type: ignore
+
+from deepdeep.arena import CSRArena
+from deepdeep.utils import resized
+
+
+class RowInterner:
+    """
+    Storage of distinct sparse rows with reference counts.
+
+    >>> interner = RowInterner()
+    >>> m = sparse.csr_matrix([[1, 0], [0, 2], [1, 0]])
+    >>> interner.intern(m).tolist()
+    [0, 1, 0]
+    >>> len(interner), interner.hits, interner.misses
+    (2, 1, 2)
+    >>> interner.take([1, 0]).toarray().tolist()
+    [[0, 2], [1, 0]]
+    >>> interner.decref([0, 0])
+    >>> len(interner)
+    1
+    """
+    compact_ratio = 0.5
+
+    def __init__(self, arena: Optional[CSRArena]=None) -> None:
+        self._arena = arena if arena is not None else CSRArena()
+        self._ids = {}  # type: Dict[bytes, int]
+        self._keys = []  # type: List[Optional[bytes]]
+        self._free_ids = []  # type: List[int]
+        self._rows = np.zeros(0, dtype=np.int64)
+        self._refcounts = np.zeros(0, dtype=np.int64)
+        self.hits = 0
+        self.misses = 0
+        self.saved_nbytes = 0
+        # decref calls made while rows or ids are being read or written
+        self._busy = 0
+        self._pending = []  # type: List[np.ndarray]
+
+    @property
+    def n_features(self) -> Optional[int]:
+        return self._arena.n_features
+
+    def __len__(self) -> int:
+        """ Number of distinct rows stored """
+        return len(self._ids)
+
+    def intern(self, m: sparse.spmatrix) -> np.ndarray:
+        """
+        Store rows of ``m`` which are not stored yet; return an array
+        with row ids. Reference counts of returned ids are incremented.
+        """
+        self._busy += 1
+        try:
+            return self._intern(m)
+        finally:
+            self._leave()
+
+    def _intern(self, m: sparse.spmatrix) -> np.ndarray:
+        m = m if sparse.isspmatrix_csr(m) else sparse.csr_matrix(m)
+        if self._arena.dtype is not None and m.dtype != self._arena.dtype:
+            m = m.astype(self._arena.dtype)
+        if not m.has_sorted_indices:
+            m = m.sorted_indices()
+        data, indices, indptr = m.data, m.indices, m.indptr
+        row_itemsize = data.itemsize + indices.itemsize
+        ids = np.empty(m.shape[0], dtype=np.int64)
+        new_rows = []
+        for row in range(m.shape[0]):
+            start, stop = indptr[row], indptr[row + 1]
+            key = _row_key(data[start:stop], indices[start:stop])
+            id_ = self._ids.get(key)
+            if id_ is None:
+                id_ = self._new_id(key)
+                new_rows.append(row)
+            else:
+                self.hits += 1
+                self.saved_nbytes += int((stop - start) * row_itemsize)
+            ids[row] = id_
+        self.misses += len(new_rows)
+        if new_rows:
+            start = self._arena.append(m[new_rows])
+            self._rows[ids[new_rows]] = np.arange(start,
+                                                  start + len(new_rows))
+        self.incref(ids)
+        return ids
+
+    def intern_rows(self, m: sparse.spmatrix) -> List['InternedRow']:
+        """ Store rows of ``m``; return an :class:`InternedRow` for each """
+        return [InternedRow(self, id_) for id_ in self.intern(m).tolist()]
+
+    def take(self, ids) -> sparse.csr_matrix:
+        """ Return a CSR matrix with rows ``ids`` """
+        self._busy += 1
+        try:
+            return self._arena.take(
+                self._rows[np.asarray(ids, dtype=np.int64)])
+        finally:
+            self._leave()
+
+    def rows_nbytes(self, ids) -> int:
+        """ Memory used by rows ``ids`` """
+        self._busy += 1
+        try:
+            return self._arena.rows_nbytes(
+                self._rows[np.asarray(ids, dtype=np.int64)])
+        finally:
+            self._leave()
+
+    def incref(self, ids) -> None:
+        np.add.at(self._refcounts, np.asarray(ids, dtype=np.int64), 1)
+
+    def decref(self, ids) -> None:
+        """
+        Decrement reference counts of ``ids``;
+        rows which are not referenced anymore are freed.
+        If the interner is in use, the call is deferred until it is done.
+        """
+        self._pending.append(np.array(ids, dtype=np.int64, ndmin=1))
+        if not self._busy:
+            self._release_pending()
+
+    def _leave(self) -> None:
+        self._busy -= 1
+        if not self._busy and self._pending:
+            self._release_pending()
+
+    def _release_pending(self) -> None:
+        self._busy += 1
+        try:
+            while self._pending:
+                pending, self._pending = self._pending, []
+                self._decref(np.concatenate(pending))
+        finally:
+            self._busy -= 1
+
+    def _decref(self, ids: np.ndarray) -> None:
+        np.subtract.at(self._refcounts, ids, 1)
+        ids = np.unique(ids)
+        freed = ids[self._refcounts[ids] == 0]
+        if not len(freed):
+            return
+        self._arena.free_rows(self._rows[freed])
+        for id_ in freed.tolist():
+            del self._ids[self._keys[id_]]
+            self._keys[id_] = None
+        self._free_ids.extend(freed.tolist())
+        if self._arena.n_dead > self.compact_ratio * len(self._arena):
+            self._compact()
+
+    def nbytes(self) -> int:
+        """
+        Memory used by stored rows and per-id arrays
+        (hash table memory is not counted).
+        """
+        return (self._arena.live_nbytes + self._rows.nbytes +
+                self._refcounts.nbytes)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'rows': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'nbytes': self.nbytes(),
+            'saved_nbytes': self.saved_nbytes,
+        }
+
+    def _new_id(self, key: bytes) -> int:
+        if self._free_ids:
+            id_ = self._free_ids.pop()
+        else:
+            id_ = len(self._keys)
+            self._keys.append(None)
+            if id_ >= len(self._rows):
+                capacity = max(id_ + 1, 2 * len(self._rows))
+                self._rows = resized(self._rows, capacity)
+                self._refcounts = resized(self._refcounts, capacity)
+        self._keys[id_] = key
+        self._ids[key] = id_
+        return id_
+
+    def _compact(self) -> None:
+        mapping = self._arena.compact()
+        ids = np.flatnonzero(self._refcounts[:len(self._keys)] > 0)
+        self._rows[ids] = mapping[self._rows[ids]]
+
+
+def _row_key(data: np.ndarray, indices: np.ndarray) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(indices.astype(np.int32, copy=False).tobytes())
+    h.update(data.tobytes())
+    return h.digest()
+
+
+class InternedRow:
+    """
+    A reference to a row stored in :class:`RowInterner`. It is used
+    instead of a 1-row CSR matrix; the reference is released when
+    the object is garbage collected. It is pickled as a CSR matrix.
+    """
+    __slots__ = ['interner', 'id']
+
+    def __init__(self, interner: RowInterner, id_: int) -> None:
+        self.interner = interner
+        self.id = id_
+
+    @property
+    def shape(self):
+        return 1, self.interner.n_features
+
+    @property
+    def nbytes(self) -> int:
+        """ Memory used by the reference; the row itself is shared """
+        return 8
+
+    def tocsr(self) -> sparse.csr_matrix:
+        return self.interner.take([self.id])
+
+    @classmethod
+    def vstack(cls, rows: List['InternedRow']) -> sparse.csr_matrix:
+        """ Stack rows vertically """
+        interner = rows[0].interner
+        if all(row.interner is interner for row in rows):
+            return interner.take([row.id for row in rows])
+        return sparse.vstack([row.tocsr() for row in rows], format='csr')
+
+    def __del__(self):
+        self.interner.decref([self.id])
+
+    def __reduce__(self):
+        return sparse.csr_matrix, (self.tocsr(),)
+
+
+class InternedArena(CSRArena):
+    """
+    :class:`deepdeep.arena.CSRArena` which stores ids of rows
+    in a :class:`RowInterner` instead of rows; rows are interned when
+    they are appended, and released when they are freed.
+    :class:`InternedRow` objects from the same interner are appended
+    without copying the row.
+
+    ``live_nbytes`` is a size of row ids plus memory used by distinct
+    rows which are referenced by this arena (even if they are
+    also used elsewhere).
+    """
+    def __init__(self, interner: RowInterner) -> None:
+        self.interner = interner
+        self._refs = np.zeros(0, dtype=np.int64)
+        # number of references to each interner row from this arena
+        self._local_refs = np.zeros(0, dtype=np.int64)
+        self._unique_nbytes = 0
+        self._refs_nbytes = 0
+        super().__init__(capacity=0)
+
+    @property
+    def live_nbytes(self) -> int:
+        return self._refs_nbytes + self._unique_nbytes
+
+    @live_nbytes.setter
+    def live_nbytes(self, value: int) -> None:
+        # CSRArena counts row bytes; here only ids are counted
+        pass
+
+    @property
+    def _row_itemsize(self) -> int:
+        return self._refs.itemsize + self._live.itemsize
+
+    def nbytes(self) -> int:
+        return self._n_rows * self._row_itemsize + self._unique_nbytes
+
+    def rows_nbytes(self, rows: np.ndarray) -> int:
+        return len(rows) * self._row_itemsize
+
+    def append(self, m) -> int:
+        if isinstance(m, InternedRow):
+            if m.interner is self.interner:
+                if self.n_features is None:
+                    self.n_features = self.interner.n_features
+                start = self._n_rows
+                self.interner.incref([m.id])
+                self._add_refs(np.array([m.id], dtype=np.int64))
+                return start
+            m = m.tocsr()
+        return super().append(m)
+
+    def _write(self, data, indices, indptr) -> None:
+        m = sparse.csr_matrix((data, indices, indptr),
+                              shape=(len(indptr) - 1, self.n_features))
+        self._add_refs(self.interner.intern(m))
+
+    def _add_refs(self, ids: np.ndarray) -> None:
+        start, n_rows = self._n_rows, len(ids)
+        self._reserve(start + n_rows, 0)
+        self._refs[start:start + n_rows] = ids
+        self._live[start:start + n_rows] = True
+        self._n_rows += n_rows
+        self._refs_nbytes += n_rows * self._row_itemsize
+        if not n_rows:
+            return
+        if ids.max() >= len(self._local_refs):
+            self._local_refs = resized(
+                self._local_refs,
+                max(ids.max() + 1, 2 * len(self._local_refs)))
+        ids, counts = np.unique(ids, return_counts=True)
+        new = ids[self._local_refs[ids] == 0]
+        self._local_refs[ids] += counts
+        self._unique_nbytes += self.interner.rows_nbytes(new)
+
+    def free_rows(self, rows) -> None:
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        rows = rows[self._live[rows]]
+        self._live[rows] = False
+        self.n_dead += len(rows)
+        self._refs_nbytes -= len(rows) * self._row_itemsize
+        ids, counts = np.unique(self._refs[rows], return_counts=True)
+        self._local_refs[ids] -= counts
+        unused = ids[self._local_refs[ids] == 0]
+        self._unique_nbytes -= self.interner.rows_nbytes(unused)
+        self.interner.decref(self._refs[rows])
+
+    def retain(self, rows) -> None:
+        keep = np.zeros(self._n_rows, dtype=bool)
+        keep[np.asarray(rows, dtype=np.int64)] = True
+        self.free_rows(np.flatnonzero(self._live[:self._n_rows] & ~keep))
+
+    def clear(self) -> None:
+        """ Free all rows """
+        self.free_rows(self.live_rows())
+
+    def take(self, rows) -> sparse.csr_matrix:
+        return self.interner.take(self._refs[np.asarray(rows,
+                                                        dtype=np.int64)])
+
+    def compact(self, chunk_size: int=65536) -> np.ndarray:
+        live = self.live_rows()
+        mapping = np.full(self._n_rows, -1, dtype=np.int64)
+        mapping[live] = np.arange(len(live))
+        self._refs[:len(live)] = self._refs[live]
+        self._live[:len(live)] = True
+        self._live[len(live):self._n_rows] = False
+        self._refs_nbytes = len(live) * self._row_itemsize
+        self._n_rows = len(live)
+        self.n_dead = 0
+        self.uid = uuid.uuid4().hex
+        return mapping
+
+    def _rows_arrays(self, start: int, stop: int):
+        # ids of dead rows can be reused by other rows,
+        # so dead rows are saved as empty rows
+        rows = np.arange(start, stop)
+        live = self._live[rows]
+        m = self.take(rows[live])
+        lengths = np.zeros(len(rows), dtype=np.int64)
+        lengths[live] = np.diff(m.indptr)
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        return m.data, m.indices, indptr
+
+    def _reserve(self, n_rows: int, nnz: int) -> None:
+        if n_rows > len(self._live):
+            capacity = max(n_rows, 2 * len(self._live), 16)
+            self._live = resized(self._live, capacity)
+            self._refs = resized(self._refs, capacity)
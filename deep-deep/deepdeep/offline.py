@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Offline Q-Learning
+==================
+
+Pre-train :math:`Q(s, a)` function on recorded crawls, so that a new crawl
+doesn't start learning from scratch. A recorded crawl is a crawl graph
+(``graph.pickle`` saved by QSpider checkpoints) and CDR items exported
+by QSpider (``items.jl.gz``). (as, AS', r) transitions are rebuilt from
+them in the same way QSpider builds them online: nodes with a reward are
+parsed pages, and an edge from the parent page tells which link was
+followed. Link extraction and vectorization run in a process pool.
+
+See ``scripts/pretrain-offline.py`` for a command-line interface.
+"""
+import logging
+import math
+import multiprocessing
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import joblib  # type: ignore
+import json_lines  # type: ignore
+import networkx as nx  # type: ignore
+import numpy as np
+from scrapy.http import TextResponse  # type: ignore
+from scipy import sparse  # type: ignore
+
+from deepdeep.links import DictLinkExtractor
+from deepdeep.qlearning import QLearner
+from deepdeep.utils import canonicalize_url
+
+
+logger = logging.getLogger(__name__)
+
+Transition = Tuple[Any, Any, float]
+
+
+class Page:
+    """
+    Links of a crawled page: ``A`` is a link feature matrix,
+    ``s`` is a page feature vector (or None) and ``link_rows``
+    maps canonical link URLs to ``A`` rows.
+    """
+    def __init__(self,
+                 A: Optional[sparse.csr_matrix],
+                 s: Optional[sparse.csr_matrix],
+                 link_rows: Dict[str, int]) -> None:
+        self.A = A
+        self.s = s
+        self.link_rows = link_rows
+
+
+def qlearner_params(spider_params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Return QLearner keyword arguments which match arguments of a QSpider
+    (as saved in ``_params`` key of a policy file).
+    """
+    mapping = [
+        ('gamma', 'gamma', float),
+        ('double', 'double_learning', bool),
+        ('lagged_double', 'lagged_double_learning', bool),
+        ('steps_before_switch', 'steps_before_switch', int),
+        ('replay_sample_size', 'replay_sample_size', int),
+        ('clf_alpha', 'clf_alpha', float),
+        ('clf_penalty', 'clf_penalty', str),
+        ('clf_backend', 'clf_backend', str),
+        ('ftrl_alpha', 'ftrl_alpha', float),
+        ('ftrl_beta', 'ftrl_beta', float),
+        ('ftrl_l1', 'ftrl_l1', float),
+        ('ftrl_l2', 'ftrl_l2', float),
+        ('factored_as', 'factored', bool),
+        ('replay_prioritized', 'prioritized_replay', bool),
+        ('replay_alpha', 'replay_alpha', float),
+        ('replay_beta', 'replay_beta', float),
+        ('replay_path', 'er_path', str),
+        ('replay_stratified', 'er_stratified', bool),
+    ]
+    return {kwarg: type_(spider_params[key])
+            for key, kwarg, type_ in mapping
+            if spider_params.get(key) is not None}
+
+
+def load_pages(items: Iterable[Dict],
+               link_vectorizer: Any,
+               page_vectorizer: Any=None,
+               limit_by_domain: bool=True,
+               processes: Optional[int]=None,
+               chunksize: int=20) -> Dict[str, Page]:
+    """
+    Extract and vectorize links of CDR ``items`` (dicts with 'url' and
+    'raw_content' keys) in a process pool; return a dict with
+    :class:`Page` for each item URL.
+    """
+    pages = {}  # type: Dict[str, Page]
+    url_contents = ((item['url'], item['raw_content']) for item in items
+                    if item.get('raw_content'))
+    with multiprocessing.Pool(
+            processes,
+            initializer=_init_worker,
+            initargs=(link_vectorizer, page_vectorizer, limit_by_domain),
+            ) as pool:
+        for url, page in pool.imap(_vectorize_page, url_contents, chunksize):
+            pages[url] = page
+    return pages
+
+
+_worker_state = {}  # type: Dict[str, Any]
+
+
+def _init_worker(link_vectorizer, page_vectorizer, limit_by_domain):
+    _worker_state.update(
+        link_vectorizer=link_vectorizer,
+        page_vectorizer=page_vectorizer,
+        limit_by_domain=limit_by_domain,
+        le=DictLinkExtractor(),
+    )
+
+
+def _vectorize_page(url_content: Tuple[str, str]) -> Tuple[str, Page]:
+    url, raw_content = url_content
+    return url, vectorize_page(url, raw_content, **_worker_state)
+
+
+def vectorize_page(url: str,
+                   raw_content: str,
+                   link_vectorizer: Any,
+                   page_vectorizer: Any=None,
+                   limit_by_domain: bool=True,
+                   le: Optional[DictLinkExtractor]=None) -> Page:
+    """
+    Extract links from a page and vectorize them,
+    like :class:`deepdeep.spiders.qspider.QSpider` does.
+    """
+    if le is None:
+        le = DictLinkExtractor()
+    response = TextResponse(url=url, body=raw_content, encoding='utf8')
+    links = list(le.iter_link_dicts(
+        response=response,
+        limit_by_domain=limit_by_domain,
+        deduplicate=False,
+        deduplicate_local=True,
+    ))
+    s = None
+    if page_vectorizer is not None:
+        s = page_vectorizer.transform([response.text])[0]
+    if not links:
+        return Page(None, s, {})
+    A = link_vectorizer.transform(links)
+    link_rows = {canonicalize_url(link['url']): idx
+                 for idx, link in enumerate(links)}
+    return Page(A, s, link_rows)
+
+
+def iter_transitions(G: nx.DiGraph,
+                     pages: Dict[str, Page],
+                     Q: QLearner) -> Iterator[Transition]:
+    """
+    Rebuild (as_t, AS_t1, r_t1) transitions from the crawl graph ``G``
+    and vectorized ``pages``; ``Q`` is used to join state and action
+    features. Transitions for which the parent page or the followed
+    link is not found are skipped.
+    """
+    nodes = dict(G.nodes(data=True))
+    joined = {}  # type: Dict[str, Any]
+
+    def get_AS(url):
+        if url not in joined:
+            page = pages[url]
+            AS = Q.join_As(page.A, page.s)
+            if AS is not None:
+                AS = AS.astype(np.float32)  # saving memory
+            joined[url] = AS
+        return joined[url]
+
+    for node_id, node in nodes.items():
+        if 'reward' not in node:
+            # not a parsed page, or a seed
+            continue
+        for parent_id in G.predecessors(node_id):
+            parent_url = nodes[parent_id].get('url')
+            if parent_url not in pages:
+                continue
+            url = canonicalize_url(node.get('original_url', node['url']))
+            row = pages[parent_url].link_rows.get(url)
+            if row is None:
+                continue
+            as_t = get_AS(parent_url)[row]
+            AS_t1 = get_AS(node['url']) if node['url'] in pages else None
+            yield as_t, AS_t1, node['reward']
+            break
+
+
+def load_crawl(graph_path: str,
+               items_path: str,
+               link_vectorizer: Any,
+               page_vectorizer: Any,
+               Q: QLearner,
+               **kwargs) -> List[Transition]:
+    """
+    Load transitions from a crawl graph at ``graph_path`` and CDR items
+    at ``items_path``; ``kwargs`` are passed to :func:`load_pages`.
+    """
+    G = nx.read_gpickle(graph_path)
+    with json_lines.open(items_path, broken=True) as items:
+        pages = load_pages(items, link_vectorizer, page_vectorizer, **kwargs)
+    transitions = list(iter_transitions(G, pages, Q))
+    logger.info("%s: %d pages, %d transitions",
+                graph_path, len(pages), len(transitions))
+    return transitions
+
+
+def pretrain(Q: QLearner,
+             transitions: Iterable[Transition],
+             epochs: float) -> int:
+    """
+    Add ``transitions`` to the experience replay memory of ``Q`` and fit
+    it for ``epochs`` passes over the memory (on average); target Q
+    function is switched each ``Q.steps_before_switch`` fit iterations.
+    Return the number of fit iterations.
+    """
+    for as_t, AS_t1, r_t1 in transitions:
+        Q.memory.add(as_t, AS_t1, r_t1)
+    if not len(Q.memory):
+        return 0
+    n_steps = int(math.ceil(
+        epochs * len(Q.memory) / Q.replay_sample_size))
+    for step in range(1, n_steps + 1):
+        Q.fit_iteration(Q.replay_sample_size)
+        if step % Q.steps_before_switch == 0:
+            Q._update_target_clf()
+    Q._update_target_clf()
+    return n_steps
+
+
+def dump_policy(path: str,
+                Q: QLearner,
+                link_vectorizer: Any,
+                page_vectorizer: Any,
+                params: Dict[str, Any],
+                pickle_memory: bool=False) -> None:
+    """ Save a policy in the same format as QSpider checkpoints """
+    data = {
+        'Q': Q,
+        'link_vectorizer': link_vectorizer,
+        'page_vectorizer': page_vectorizer,
+        '_params': params,
+    }
+    Q.pickle_memory = pickle_memory
+    try:
+        joblib.dump(data, path, compress=3)
+    finally:
+        Q.pickle_memory = False
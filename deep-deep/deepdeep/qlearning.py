@@ -70,19 +70,50 @@ two functions are used:
 For efficiency reasons instead of two (s, a) vectors a single vector is used,
 with all features joined. It requires ~2x RAM because multiple
 `s` copies are stored in memory, but the scipy-based implementation becomes
-10x faster.
+10x faster. With ``factored=True`` :class:`FactoredAS` matrices are used
+instead: they store each state vector once, and compute
+:math:`Q(s, a) = w_a \cdot a + w_s \cdot s` with the state term
+computed once per state.
 """
 from __future__ import absolute_import
 from collections.abc import Sized
+import bisect
+import json
+import os
 import random
-from typing import Callable, List, Tuple, Any, Optional
+import shutil
+import tempfile
+import uuid
+import weakref
+from pathlib import Path
+from typing import (
+    Callable, List, Tuple, Any, Optional, Iterable, Dict, Union, Sequence,
+)
 
 import numpy as np  # type: ignore
 from scipy import sparse  # type: ignore
 import sklearn.base  # type: ignore
 from sklearn.linear_model import SGDRegressor  # type: ignore
 
-from deepdeep.utils import log_time, csr_nbytes
+from deepdeep.utils import (
+    log_time, csr_nbytes, segment_max, segment_argmax, resized,
+)
+from deepdeep.arena import CSRArena, MmapCSRArena
+from deepdeep.eviction import EvictionPolicy, make_eviction_policy
+from deepdeep.interning import RowInterner, InternedRow, InternedArena
+from deepdeep.stratified import StratifiedSampler
+from deepdeep.sumtree import SumTree
+
+
+SGD_TRAINED_PARAMS = [
+    't_',
+    'coef_',
+    'intercept_',
+    'average_coef_',
+    'average_intercept_',
+    'standard_coef_',
+    'standard_intercept_',
+]
 
 
 class QLearner:
@@ -99,6 +130,16 @@ class QLearner:
         (http://arxiv.org/abs/1509.06461): instead of using two totally
         separate Q functions it uses online and target Q functions
         which we need anyways to stabilize Experience Replay training.
+    lagged_double_learning : bool
+        Whether to use a lagged variant of Double Learning
+        (default: False). In this mode the best next action for
+        an observation is chosen by online Q function only once after
+        each target Q function switch, not at every time step.
+        Q values of next states then depend only on the target
+        Q function version, so they are cached in the experience replay
+        memory and recomputed lazily after switches. It makes learning
+        steps much cheaper, especially for large ``replay_sample_size``.
+        Requires ``double_learning=True``.
     steps_before_switch : int
         Parameters of online Q function are copied to target Q function
         every `steps_before_switch` steps (default: 100).
@@ -142,6 +183,9 @@ class QLearner:
         How often to update online :math:`Q(s, a)` function (default: 1).
         By default, it is updated on each time step; set ``fit_interval``
         to a higher value to update on each fit_interval-th time step.
+        Set it to 0 to disable automatic updates; in this case
+        :meth:`fit_iteration` should be called explicitly
+        (see :class:`deepdeep.training.TrainingController`).
     on_model_changed: callable, optional
         Function to call when target :math:`Q(s, a)` function is changed.
     pickle_memory: bool
@@ -157,9 +201,57 @@ class QLearner:
     er_maxlinks: int, optional
         Max number of links in experience replay memory.
         None (default) means there is no limit.
+    er_path: str, optional
+        Directory for memory-mapped experience replay storage
+        (see ``path`` argument of :class:`ExperienceMemory`).
+        By default experience replay memory is kept in RAM.
+    er_maxbytes: int, optional
+        Max memory taken by experience replay examples, in bytes.
+        None (default) means there is no limit.
+    er_eviction: str
+        Which example to evict from experience replay memory when
+        it is full: ``'random'`` (default), ``'oldest'`` or
+        ``'lowest_priority'`` (requires ``prioritized_replay``).
+    er_interner: RowInterner, optional
+        Intern action rows of experience replay memory in this
+        :class:`deepdeep.interning.RowInterner`, so that identical rows
+        are stored once (see ``interner`` argument
+        of :class:`ExperienceMemory`).
+    er_stratified: bool
+        Sample experience replay minibatches balanced across domains
+        and reward buckets (see ``stratified`` argument
+        of :class:`ExperienceMemory`). Default is False.
+    prioritized_replay : bool
+        Whether to use Prioritized Experience Replay
+        (https://arxiv.org/abs/1511.05952): observations are sampled
+        from replay memory with probabilities proportional to
+        ``|TD error| ** replay_alpha``, so that rare surprising
+        observations (e.g. a rewarding page) are replayed more often.
+        Default is False.
+    replay_alpha : float
+        How much prioritization is used with ``prioritized_replay``,
+        0 meaning uniform sampling (default: 0.6).
+    replay_beta : float
+        How much non-uniform sampling is compensated by importance
+        sampling weights with ``prioritized_replay``,
+        1 meaning full compensation (default: 0.4).
+    clf_backend: str
+        Regression model for :math:`Q(s, a)` function: ``'sgd'`` (default)
+        for ``SGDRegressor`` with ``clf_penalty`` and ``clf_alpha``
+        parameters, or ``'ftrl'`` for
+        :class:`deepdeep.ftrl.FTRLProximalRegressor` with ``ftrl_*``
+        parameters. FTRL-Proximal model stores weights only for features
+        seen in training, so it is much smaller, and target Q function
+        switches are cheaper.
+    factored: bool
+        When True, :meth:`join_As` and :meth:`join_as` return
+        :class:`FactoredAS` matrices which don't copy state vector
+        to each row; it saves a lot of memory when state features
+        are used. Default is False.
     """
     def __init__(self, *,
                  double_learning: bool = True,
+                 lagged_double_learning: bool = False,
                  steps_before_switch: int = 100,
                  gamma: float = 0.4,
                  initial_predictions: float = 0.05,
@@ -170,11 +262,29 @@ class QLearner:
                  dummy: bool = False,
                  er_maxsize: Optional[int] = None,
                  er_maxlinks: Optional[int] = None,
+                 er_path: Optional[str] = None,
+                 er_maxbytes: Optional[int] = None,
+                 er_eviction: str = 'random',
+                 er_interner: Optional[RowInterner] = None,
+                 er_stratified: bool = False,
+                 prioritized_replay: bool = False,
+                 replay_alpha: float = 0.6,
+                 replay_beta: float = 0.4,
                  clf_penalty: str='l2',
-                 clf_alpha: float=1e-6
+                 clf_alpha: float=1e-6,
+                 clf_backend: str='sgd',
+                 ftrl_alpha: float=0.1,
+                 ftrl_beta: float=1.0,
+                 ftrl_l1: float=1.0,
+                 ftrl_l2: float=1.0,
+                 factored: bool=False,
                  ) -> None:
         assert 0 <= gamma < 1
+        if lagged_double_learning and not double_learning:
+            raise ValueError("lagged_double_learning requires "
+                             "double_learning=True")
         self.double_learning = double_learning
+        self.lagged_double_learning = lagged_double_learning
         self.steps_before_switch = steps_before_switch
         self.gamma = gamma
         self.initial_predictions = initial_predictions
@@ -183,55 +293,86 @@ class QLearner:
         self.fit_interval = fit_interval
         self.pickle_memory = pickle_memory
         self.dummy = dummy
-
-        self.clf_online = SGDRegressor(
-            penalty=clf_penalty,
-            average=False,
-            n_iter=1,
-            learning_rate='constant',
-            # loss='epsilon_insensitive',
-            alpha=clf_alpha,
-            eta0=0.1,
-        )
-
-        self.clf_target = sklearn.base.clone(self.clf_online)  # type: SGDRegressor
-        self.memory = ExperienceMemory(maxsize=er_maxsize, maxlinks=er_maxlinks)
+        self.factored = factored
+        self.replay_alpha = replay_alpha
+        self.replay_beta = replay_beta
+
+        if clf_backend == 'sgd':
+            self.clf_online = SGDRegressor(
+                penalty=clf_penalty,
+                average=False,
+                n_iter=1,
+                learning_rate='constant',
+                # loss='epsilon_insensitive',
+                alpha=clf_alpha,
+                eta0=0.1,
+            )
+        elif clf_backend == 'ftrl':
+            from deepdeep.ftrl import FTRLProximalRegressor
+            self.clf_online = FTRLProximalRegressor(
+                alpha=ftrl_alpha,
+                beta=ftrl_beta,
+                l1=ftrl_l1,
+                l2=ftrl_l2,
+            )
+        else:
+            raise ValueError("Unknown clf_backend: %r" % clf_backend)
+
+        self.clf_target = sklearn.base.clone(self.clf_online)
+        self.memory = ExperienceMemory(maxsize=er_maxsize,
+                                       maxlinks=er_maxlinks,
+                                       prioritized=prioritized_replay,
+                                       path=er_path,
+                                       maxbytes=er_maxbytes,
+                                       eviction=er_eviction,
+                                       interner=er_interner,
+                                       stratified=er_stratified)
+        self._target_scorer = None  # type: Optional[LinearScorer]
         self.t_ = 0
+        # incremented each time target Q function is changed
+        self.target_version_ = 0
 
-    @classmethod
-    def join_As(cls,
+    def join_As(self,
                 A: sparse.spmatrix,
-                s: Optional[sparse.spmatrix]) -> sparse.csr_matrix:
+                s: Optional[sparse.spmatrix]):
         """
         Append vector ``s`` to each row of matrix ``A``.
 
         For efficiency reasons state vector should be appended to each
         action vector. It requires ~2x RAM, but is ~10x faster in the end.
+        If QLearner is created with ``factored=True``, a :class:`FactoredAS`
+        matrix is returned instead; it stores ``s`` only once.
         """
         if A is not None and s is not None:
+            # models pickled before factored option is added don't have it
+            if getattr(self, 'factored', False):
+                return FactoredAS(A, s, np.zeros(A.shape[0], dtype=np.int64))
             n_rows = A.shape[0]
             S = sparse.vstack([sparse.coo_matrix(s)] * n_rows)
             return sparse.hstack([A, S]).tocsr()
         else:
             return A
 
-    @classmethod
-    def join_as(cls,
+    def join_as(self,
                 a: sparse.spmatrix,
-                s: Optional[sparse.spmatrix]) -> sparse.csr_matrix:
+                s: Optional[sparse.spmatrix]):
         """ Append sparse vector ``s`` to sparse vector ``a``. """
-        return sparse.hstack([a, s]).tocsr() if s is not None else a
+        if s is None:
+            return a
+        return self.join_As(a, s)
 
-    def add_experience(self, as_t, AS_t1, r_t1) -> None:
+    def add_experience(self, as_t, AS_t1, r_t1,
+                       domain: Optional[str]=None) -> None:
         """
         Tell QLearner about the observed experience. QLearner stores it
         to the experience replay memory and updates Q functions.
+        ``domain`` of the page is used by stratified replay sampling.
         """
         self.t_ += 1
         if not self.dummy:
-            self.memory.add(as_t=as_t, AS_t1=AS_t1, r_t1=r_t1)
+            self.memory.add(as_t=as_t, AS_t1=AS_t1, r_t1=r_t1, domain=domain)
 
-            if (self.t_ % self.fit_interval) == 0:
+            if self.fit_interval and (self.t_ % self.fit_interval) == 0:
                 self.fit_iteration(self.replay_sample_size)
 
         if (self.t_ % self.steps_before_switch) == 0:
@@ -262,10 +403,10 @@ class QLearner:
             A vector of :math:`Q(s, a)` values.
 
         """
-        clf = self.clf_target if not online else self.clf_online
-        if clf.coef_ is None:
+        scorer = self._get_scorer(online)
+        if scorer is None:
             return np.ones(AS.shape[0]) * self.initial_predictions
-        return clf.predict(AS)
+        return scorer.predict(AS)
 
     def predict_one(self, as_, online=False) -> float:
         """
@@ -293,90 +434,415 @@ class QLearner:
             :math:`Q(s, a)` value
 
         """
-        return self.predict(sparse.vstack([as_]), online=online)[0]
+        scorer = self._get_scorer(online)
+        if scorer is None:
+            return self.initial_predictions
+        return scorer.predict_one(as_)
+
+    def target_scorer(self) -> Optional['LinearScorer']:
+        """
+        Return a scorer for target :math:`Q(s, a)` function,
+        or None if it is not fitted yet.
+        """
+        return self._get_scorer(online=False)
+
+    def _get_scorer(self, online: bool) -> Optional['LinearScorer']:
+        if online:
+            return make_scorer(self.clf_online)
+        # models pickled before target scorer is added don't have it
+        scorer = getattr(self, '_target_scorer', None)
+        if scorer is None:
+            scorer = self._target_scorer = make_scorer(self.clf_target)
+        return scorer
 
     @log_time
     def fit_iteration(self, sample_size: int) -> None:
         """
         Update online Q function using random examples from the experience
-        replay memory.
+        replay memory. With prioritized replay, priorities of these
+        examples are updated using their TD errors.
         """
-        sample = self.memory.sample(sample_size)
-        as_t_list, AS_t1_list, r_t1_list = zip(*sample)
-        rewards = np.asarray(r_t1_list)
-        X = sparse.vstack(as_t_list)
-        Q_t1_vector = self._get_Q_t1_values(rewards.shape, AS_t1_list)
+        indices = self.memory.sample_indices(sample_size)
+        rewards = self.memory.get_rewards(indices)
+        X = to_csr(self.memory.get_as_t(indices))
+        if self.lagged_double_learning:
+            Q_t1_vector = self._get_cached_Q_t1_values(indices)
+        else:
+            Q_t1_vector = self._get_stacked_Q_t1_values(
+                *self.memory.get_AS_t1(indices))
         y = rewards + self.gamma * Q_t1_vector
-        self.clf_online.partial_fit(X, y)
+        sample_weight = None
+        if self.memory.prioritized:
+            td_errors = y - self.predict(X, online=True)
+            self.memory.update_priorities(
+                indices, np.abs(td_errors) ** self.replay_alpha)
+            sample_weight = self.memory.importance_weights(
+                indices, self.replay_beta)
+        self.clf_online.partial_fit(X, y, sample_weight=sample_weight)
 
     def _get_Q_t1_values(self,
                          shape: Tuple,
                          AS_t1_list: List[sparse.csr_matrix],
-                         ):
-        Q_t1_values = np.zeros(shape)
-
-        # XXX: An alternative way to implement it would be to
-        # stack all AS_t1 matrices into one big matrix, predict
-        # all scores at once, and then slice the result according
-        # to shapes of original matrices to fill Q_t1_values.
-        # The implementation can be found here:
-        # https://gist.github.com/kmike/c0d3fa1822cd6ddcdbca9b067ee3e94a;
-        # it turns out to be ~4x slower.
-
-        for idx, AS_t1 in enumerate(AS_t1_list):
-            if AS_t1 is not None and AS_t1.shape[0] > 0:
-                scores = self.predict(AS_t1, online=True)
-                if self.double_learning:
-                    # This is a simple variant of double learning
-                    # used in http://arxiv.org/abs/1509.06461.
-                    # Instead of using totally separate Q functions
-                    # action is chosen by online Q function, but the score
-                    # is estimated using target Q function.
-                    best_idx = scores.argmax()
-                    as_t1 = AS_t1[best_idx]
-                    Q_t1_values[idx] = self.predict_one(as_t1, online=False)
-                else:
-                    Q_t1_values[idx] = scores.max()  # vanilla Q-learning
-        # print('Q_t1_values shape:', Q_t1_values.shape)
-        # print('Total links: ', sum(_A.shape[0] for _A in AS_t1_list if _A is not None))
+                         ) -> np.ndarray:
+        """
+        Compute Q values of next states for a list of ``AS_t1``
+        matrices; Q value is 0 if ``AS_t1`` is None or empty.
+        """
+        matrices = [AS_t1 for AS_t1 in AS_t1_list
+                    if AS_t1 is not None and AS_t1.shape[0] > 0]
+        if not matrices:
+            return np.zeros(shape)
+        lengths = [AS_t1.shape[0] if AS_t1 is not None else 0
+                   for AS_t1 in AS_t1_list]
+        indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        return self._get_stacked_Q_t1_values(
+            vstack_AS(matrices), indptr).reshape(shape)
+
+    def _get_stacked_Q_t1_values(self,
+                                 AS_t1,
+                                 indptr: np.ndarray) -> np.ndarray:
+        """
+        Compute Q values of next states for ``AS_t1`` matrices stacked
+        vertically: rows ``indptr[i]:indptr[i+1]`` are actions available
+        at i-th next state. Q value is 0 if there are no actions.
+        """
+        # All AS_t1 matrices are stacked into a single matrix, so that
+        # online and target Q functions are computed with a single
+        # sparse dot product each; per-observation max / argmax are
+        # segment reductions over row offsets of the original matrices.
+        # Unlike the approach from
+        # https://gist.github.com/kmike/c0d3fa1822cd6ddcdbca9b067ee3e94a
+        # there is no Python-level loop over the results; see
+        # scripts/benchmark-qlearning.py for timings.
+        lengths = np.diff(indptr)
+        Q_t1_values = np.zeros(len(lengths))
+        non_empty = lengths > 0
+        if not non_empty.any():
+            return Q_t1_values
+        segments = np.zeros(non_empty.sum() + 1, dtype=np.int64)
+        np.cumsum(lengths[non_empty], out=segments[1:])
+        Q_t1_values[non_empty] = self._segment_Q_t1_values(AS_t1, segments)
         return Q_t1_values
 
+    def _get_cached_Q_t1_values(self,
+                                indices: np.ndarray,
+                                AS_t1_list: Optional[List[Any]]=None,
+                                ) -> np.ndarray:
+        """
+        Return Q values of next states for memory observations at
+        ``indices``, using values cached for the current target
+        Q function version when possible. ``AS_t1`` matrices
+        are fetched from memory unless ``AS_t1_list`` is passed.
+        """
+        values, is_cached = self.memory.get_cached_Q_t1(
+            indices, self.target_version_)
+        missing = np.flatnonzero(~is_cached)
+        if len(missing):
+            if AS_t1_list is None:
+                values[missing] = self._get_stacked_Q_t1_values(
+                    *self.memory.get_AS_t1(indices[missing]))
+            else:
+                values[missing] = self._get_Q_t1_values(
+                    missing.shape, [AS_t1_list[i] for i in missing])
+            self.memory.set_cached_Q_t1(
+                indices[missing], values[missing], self.target_version_)
+        return values
+
+    def _segment_Q_t1_values(self,
+                             AS_t1,
+                             indptr: np.ndarray) -> np.ndarray:
+        """
+        Compute Q values of next states for stacked ``AS_t1`` matrices.
+        Rows ``indptr[i]:indptr[i+1]`` of ``AS_t1`` are actions available
+        at i-th next state; all segments must be non-empty.
+        """
+        scores = self.predict(AS_t1, online=True)
+        if not self.double_learning:
+            return segment_max(scores, indptr)  # vanilla Q-learning
+
+        # This is a simple variant of double learning
+        # used in http://arxiv.org/abs/1509.06461.
+        # Instead of using totally separate Q functions
+        # action is chosen by online Q function, but the score
+        # is estimated using target Q function.
+        best_rows = segment_argmax(scores, indptr)
+        return self.predict(AS_t1[best_rows], online=False)
+
     def _update_target_clf(self):
-        trained_params = [
-            't_',
-            'coef_',
-            'intercept_',
-            'average_coef_',
-            'average_intercept_',
-            'standard_coef_',
-            'standard_intercept_',
-        ]
-        for attr in trained_params:
-            if not hasattr(self.clf_online, attr):
-                continue
-            data = getattr(self.clf_online, attr)
-            if hasattr(data, 'copy'):
-                data = data.copy()
+        if hasattr(self.clf_online, 'trained_params'):
+            # e.g. FTRLProximalRegressor
+            trained_params = self.clf_online.trained_params()
+        else:
+            trained_params = {}
+            for attr in SGD_TRAINED_PARAMS:
+                if not hasattr(self.clf_online, attr):
+                    continue
+                data = getattr(self.clf_online, attr)
+                if hasattr(data, 'copy'):
+                    data = data.copy()
+                trained_params[attr] = data
+        for attr, data in trained_params.items():
             setattr(self.clf_target, attr, data)
+        self._target_scorer = make_scorer(self.clf_target)
+        self.target_version_ += 1
+
+    def warm_start(self, Q: 'QLearner', memory: bool=False,
+                   resume: bool=False) -> None:
+        """
+        Initialize online and target :math:`Q(s, a)` functions with weights
+        of another QLearner ``Q`` (e.g. loaded from a checkpoint).
+        Hyperparameters of this QLearner's models are kept.
+        If ``memory`` is True, the experience replay memory of this
+        QLearner is replaced with a copy of ``Q`` memory, including
+        strata and priorities (see :meth:`ExperienceMemory.copy_from`).
+        If ``resume`` is True, the number of observations ``t_`` is also
+        restored, to continue training ``Q`` where it was stopped.
+        """
+        if type(Q.clf_online) is not type(self.clf_online):
+            raise ValueError(
+                "Can't warm start %s model from %s model" % (
+                    type(self.clf_online).__name__,
+                    type(Q.clf_online).__name__))
+        if memory and len(Q.memory) and Q.factored != self.factored:
+            raise ValueError("Can't restore experience replay memory: "
+                             "factored option doesn't match")
+        params = self.clf_online.get_params()
+        self.clf_online = Q.clf_online
+        self.clf_target = Q.clf_target
+        self.clf_online.set_params(**params)
+        self.clf_target.set_params(**params)
+        if memory and len(Q.memory):
+            self.memory.copy_from(Q.memory)
+        if resume:
+            self.t_ = Q.t_
+        self._target_scorer = make_scorer(self.clf_target)
+        self.target_version_ += 1
 
     def coef_norm(self, online: bool=True) -> float:
         """ Return L2 norm of classifier weights """
-        clf = self.clf_target if not online else self.clf_online
-        if clf.coef_ is None:
+        scorer = self._get_scorer(online)
+        if scorer is None:
             return 0
-        return np.sqrt((clf.coef_ ** 2).sum())
+        return scorer.coef_norm()
 
     def __getstate__(self):
         dct = self.__dict__.copy()
-        try:
-            del dct['on_model_changed']
-        except KeyError:
-            pass
+        for key in ['on_model_changed', '_target_scorer']:
+            dct.pop(key, None)
         if not self.pickle_memory:
             dct['memory'] = ExperienceMemory()
         return dct
 
 
+class LinearScorer:
+    """
+    Linear model :math:`y = Xw + b` which scores sparse matrices directly,
+    without input validation and conversions done by scikit-learn
+    ``predict`` methods; they dominate prediction time for small inputs.
+
+    Weights are stored as a contiguous array; ``coef`` is not copied
+    if it is already contiguous. It is best to use weights of the same
+    dtype as feature matrices: then the scipy sparse matrix-vector
+    product is used; otherwise only weights of non-zero features
+    are converted.
+    """
+    def __init__(self, coef: np.ndarray, intercept: float) -> None:
+        self.coef = np.ascontiguousarray(coef).ravel()
+        self.intercept = float(intercept)
+
+    @classmethod
+    def from_clf(cls, clf) -> Optional['LinearScorer']:
+        """
+        Create a scorer which uses weights of a fitted scikit-learn
+        linear regression model; return None if ``clf`` is not fitted.
+        """
+        if getattr(clf, 'coef_', None) is None:
+            return None
+        return cls(clf.coef_, clf.intercept_[0])
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """
+        Return weight arrays; ``cls(intercept=intercept, **arrays)``
+        creates the same scorer.
+        """
+        return {'coef': self.coef}
+
+    def coef_norm(self) -> float:
+        """ Return L2 norm of weights """
+        return float(np.sqrt((self.coef ** 2).sum()))
+
+    def predict(self, X) -> np.ndarray:
+        """
+        Return a vector of scores for all rows of matrix ``X``
+        (a sparse matrix or :class:`FactoredAS`).
+        """
+        if isinstance(X, FactoredAS):
+            scores = self._dot(X.A, 0)
+            # state term is computed once per state
+            scores += self._dot(X.S, X.A.shape[1])[X.state_idx]
+        else:
+            scores = self._dot(X, 0)
+        return scores + self.intercept
+
+    def predict_one(self, x) -> float:
+        """
+        Return a score for a single feature vector ``x``
+        (a sparse matrix with a single row or :class:`FactoredAS`).
+        """
+        if isinstance(x, FactoredAS):
+            return float(self.predict(x)[0])
+        if sparse.issparse(x) and x.shape[0] == 1:
+            x = x.tocsr()
+            return self.predict_row(x.indices, x.data)
+        return self.predict(sparse.vstack([x]))[0]
+
+    def predict_row(self, indices: np.ndarray, data: np.ndarray) -> float:
+        """
+        Return a score for a single sparse feature vector, given
+        as arrays of non-zero feature ``indices`` and their values.
+        """
+        return float(np.dot(data, self._weights(indices))) + self.intercept
+
+    def weights(self, indices: np.ndarray) -> np.ndarray:
+        """ Return weights of features at ``indices`` """
+        return self._weights(indices)
+
+    def _weights(self, indices: np.ndarray) -> np.ndarray:
+        return self.coef[indices]
+
+    def _dot(self, X: sparse.spmatrix, offset: int) -> np.ndarray:
+        """
+        Return ``X @ w[offset:offset + X.shape[1]]``, i.e. a dot product
+        with weights of features starting from ``offset``.
+        """
+        if not sparse.isspmatrix_csr(X):
+            X = sparse.csr_matrix(X)
+        coef = self.coef[offset:offset + X.shape[1]]
+        if X.dtype == coef.dtype:
+            return X.dot(coef)
+        # avoid converting the whole coef array to X dtype
+        return row_sums(X.data * coef[X.indices], X.indptr)
+
+
+def make_scorer(clf) -> Optional[LinearScorer]:
+    """
+    Return a scorer for a regression model ``clf``,
+    or None if it is not fitted yet.
+    """
+    if hasattr(clf, 'scorer'):  # e.g. FTRLProximalRegressor
+        return clf.scorer()
+    return LinearScorer.from_clf(clf)
+
+
+def row_sums(values: np.ndarray, indptr: np.ndarray) -> np.ndarray:
+    """
+    Return sums of ``values[indptr[i]:indptr[i+1]]`` for each row ``i``
+    of a CSR matrix with data ``values``.
+    """
+    cumsum = np.zeros(len(values) + 1, dtype=values.dtype)
+    np.cumsum(values, out=cumsum[1:])
+    return cumsum[indptr[1:]] - cumsum[indptr[:-1]]
+
+
+class FactoredAS:
+    """
+    A matrix of joined state-action feature vectors, stored in
+    a factored form: action features ``A`` (one row per action),
+    state features ``S`` (one row per unique state) and ``state_idx``,
+    an array with ``S`` row index for each action. It represents
+    the same data as ``sparse.hstack([A, S[state_idx]])``, but
+    each state vector is stored only once.
+
+    Only operations needed by :class:`QLearner` are supported: row
+    indexing (rows share ``S`` with the original matrix), iteration
+    over rows, stacking (see :meth:`vstack`) and conversion to
+    a CSR matrix (see :meth:`tocsr`).
+    """
+    def __init__(self,
+                 A: sparse.spmatrix,
+                 S: sparse.spmatrix,
+                 state_idx: np.ndarray) -> None:
+        assert A.shape[0] == len(state_idx)
+        # S is not converted if it is already CSR, to keep it shared
+        self.A = A if sparse.isspmatrix_csr(A) else sparse.csr_matrix(A)
+        self.S = S if sparse.isspmatrix_csr(S) else sparse.csr_matrix(S)
+        self.state_idx = np.asarray(state_idx, dtype=np.int64)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.A.shape[0], self.A.shape[1] + self.S.shape[1]
+
+    @property
+    def dtype(self):
+        return self.A.dtype
+
+    @property
+    def nbytes(self) -> int:
+        """ Memory used by the matrix, including ``S`` rows """
+        return (csr_nbytes(self.A) + csr_nbytes(self.S) +
+                self.state_idx.nbytes)
+
+    def __getitem__(self, key) -> 'FactoredAS':
+        rows = np.arange(self.A.shape[0])[key]
+        if rows.ndim == 0:
+            rows = rows.reshape(1)
+        return FactoredAS(self.A[rows], self.S, self.state_idx[rows])
+
+    def __iter__(self):
+        for idx in range(self.A.shape[0]):
+            yield self[idx]
+
+    def astype(self, dtype) -> 'FactoredAS':
+        return FactoredAS(self.A.astype(dtype), self.S.astype(dtype),
+                          self.state_idx)
+
+    def tocsr(self) -> sparse.csr_matrix:
+        """ Return joined state-action feature matrix """
+        return sparse.hstack([self.A, self.S[self.state_idx]], format='csr')
+
+    @classmethod
+    def vstack(cls, matrices: List['FactoredAS']) -> 'FactoredAS':
+        """
+        Stack matrices vertically. ``S`` matrices shared by several
+        of them are included in the result only once.
+        """
+        S_list = []  # type: List[sparse.csr_matrix]
+        offsets = {}  # type: Dict[int, int]
+        state_idx = []
+        n_states = 0
+        for m in matrices:
+            key = id(m.S)
+            if key not in offsets:
+                offsets[key] = n_states
+                S_list.append(m.S)
+                n_states += m.S.shape[0]
+            state_idx.append(m.state_idx + offsets[key])
+        return cls(sparse.vstack([m.A for m in matrices], format='csr'),
+                   sparse.vstack(S_list, format='csr'),
+                   np.concatenate(state_idx))
+
+
+def vstack_AS(matrices: List[Any]):
+    """
+    Stack state-action matrices vertically. Result is a
+    :class:`FactoredAS` if all matrices are factored, and
+    a CSR matrix otherwise.
+    """
+    if all(isinstance(m, FactoredAS) for m in matrices):
+        return FactoredAS.vstack(matrices)
+    if matrices and all(isinstance(m, InternedRow) for m in matrices):
+        return InternedRow.vstack(matrices)
+    return sparse.vstack([to_csr(m) for m in matrices], format='csr')
+
+
+def to_csr(AS) -> sparse.csr_matrix:
+    """ Convert a state-action matrix to a CSR matrix """
+    if isinstance(AS, (FactoredAS, InternedRow)):
+        return AS.tocsr()
+    return AS
+
+
 class ExperienceMemory(Sized):
     """
     Experience replay memory.
@@ -401,59 +867,599 @@ class ExperienceMemory(Sized):
         each observation can contain multiple links. This is useful to
         control in case of running separate spiders for each domain,
         as different domains have different average number of links.
+
+    prioritized : bool
+        When True, observations are sampled with probabilities proportional
+        to their priorities (see :meth:`update_priorities`) instead
+        of uniformly. New observations get the max priority seen so far,
+        so that they are sampled at least once. Default is False.
+
+    path : str, optional
+        When passed, observation rows are stored in memory-mapped files
+        in a temporary directory inside ``path``
+        (see :class:`deepdeep.arena.MmapCSRArena`); only per-observation
+        offsets and rewards are kept in RAM, and the OS page cache decides
+        which rows stay in memory. By default everything is kept in RAM.
+
+    maxbytes : int, optional
+        Max memory taken by stored examples (as returned
+        by :meth:`nbytes`); examples are evicted until memory fits.
+        Unlike ``maxsize`` and ``maxlinks``, it doesn't depend
+        on a size of observations. Note that space taken by evicted
+        examples is reclaimed only when the arena is compacted, and that
+        buffers are allocated in advance, so actual RAM usage can be
+        higher. By default there is no limit.
+
+    eviction : str or :class:`deepdeep.eviction.EvictionPolicy`
+        Which example to evict when memory is full: ``'random'``
+        (default), ``'oldest'`` or ``'lowest_priority'``
+        (requires ``prioritized=True``); see :mod:`deepdeep.eviction`.
+
+    interner : :class:`deepdeep.interning.RowInterner`, optional
+        When passed, action rows are interned: identical rows
+        (e.g. rows of navigation links which are present on all pages
+        of a website) are stored once in the interner, and memory only
+        keeps their ids. The interner can be shared with other users
+        (e.g. requests in a crawl frontier). ``as_t`` can be
+        an :class:`deepdeep.interning.InternedRow` of the same interner;
+        it is stored without copying.
+
+    stratified : bool
+        When True, observations are grouped into strata by domain
+        (passed to :meth:`add`) and reward bucket, and minibatches are
+        sampled without replacement with an equal share for each stratum
+        (see :class:`deepdeep.stratified.StratifiedSampler`), so that
+        a few link-heavy domains don't dominate them.
+        Can't be used with ``prioritized``. Default is False.
+
+    reward_bins : sequence of float
+        Reward bucket boundaries for ``stratified`` sampling: a reward
+        ``r`` goes to bucket ``i`` if ``reward_bins[i - 1] < r <=
+        reward_bins[i]``. Default is ``(0,)``, i.e. rewarded and
+        non-rewarded observations are separate strata.
+
+    Observations are not stored as separate scipy matrices: rows of
+    ``as_t`` and ``AS_t1`` matrices are appended to a
+    :class:`deepdeep.arena.CSRArena` (``as_t`` row followed by
+    ``AS_t1`` rows), and only the first row id, the number of ``AS_t1``
+    rows and the reward are kept for each observation. For
+    :class:`FactoredAS` observations state vectors are stored in
+    a separate arena; a state matrix shared by several observations
+    is stored once while it is alive. Rows of replaced observations
+    are removed when they take more than ``compact_ratio`` of the arena.
+    Use :meth:`get_as_t`, :meth:`get_AS_t1` and :meth:`get_rewards`
+    to get stacked matrices for a minibatch.
+
+    Memory can also cache a Q value of the next state for each observation;
+    cached values are tagged with a version of the target Q function
+    they are computed with, and they are ignored when the version changes
+    (see :meth:`get_cached_Q_t1` and :meth:`set_cached_Q_t1`).
     """
+    compact_ratio = 0.5
+    _sampler = None  # type: Optional[StratifiedSampler]
+
     def __init__(self,
                  maxsize: Optional[int]=None,
                  maxlinks: Optional[int]=None,
+                 prioritized: bool=False,
+                 path: Optional[str]=None,
+                 maxbytes: Optional[int]=None,
+                 eviction: Union[str, EvictionPolicy]='random',
+                 interner: Optional[RowInterner]=None,
+                 stratified: bool=False,
+                 reward_bins: Sequence[float]=(0,),
                  ) -> None:
-        self.data = []  # type: List[Tuple[Any, Any, Any]]
         self.maxsize = maxsize
         self.maxlinks = maxlinks
+        self.prioritized = prioritized
+        self.path = path
+        self.maxbytes = maxbytes
+        self.eviction = eviction
+        self.interner = interner
+        self.stratified = stratified
+        self.reward_bins = sorted(reward_bins)
+        if stratified and prioritized:
+            raise ValueError("stratified sampling can't be used "
+                             "with prioritized=True")
+        if make_eviction_policy(eviction).needs_priorities and not prioritized:
+            raise ValueError("%r eviction requires prioritized=True"
+                             % eviction)
+        self._reset()
+
+    def _reset(self) -> None:
+        self._size = 0
         self._n_links = 0
-
-    def add(self, as_t, AS_t1, r_t1) -> None:
+        self._factored = None  # type: Optional[bool]
+        actions = getattr(self, '_actions', None)
+        if isinstance(actions, InternedArena):
+            actions.clear()  # release interned rows
+        interner = getattr(self, 'interner', None)
+        if interner is not None:
+            self._actions = InternedArena(interner)  # type: CSRArena
+        else:
+            self._actions = self._new_arena()
+        self._states = self._new_arena()
+        # for factored observations: state row of each action row
+        self._state_idx = np.zeros(0, dtype=np.int64)
+        # number of action rows which use each state row
+        self._state_refs = np.zeros(0, dtype=np.int64)
+        # id(S) -> (weak reference to S, first state row, number of rows)
+        self._state_rows = {}  # type: Dict[int, Tuple[Any, int, int]]
+        self._starts = np.zeros(0, dtype=np.int64)
+        self._n_next = np.zeros(0, dtype=np.int64)
+        self._rewards = np.zeros(0)
+        self._priorities = SumTree()
+        self._max_priority = 1.0
+        self._Q_t1_cache = np.zeros(0)
+        self._Q_t1_cache_version = np.zeros(0, dtype=np.int64)
+        self._eviction = make_eviction_policy(self.eviction)
+        self._eviction.clear()
+        self._sampler = (StratifiedSampler()
+                         if getattr(self, 'stratified', False) else None)
+
+    def _new_arena(self) -> CSRArena:
+        # memory pickled by an older version doesn't have path
+        path = getattr(self, 'path', None)
+        return MmapCSRArena(path) if path else CSRArena()
+
+    def add(self, as_t, AS_t1, r_t1, domain: Optional[str]=None) -> None:
         """
-        Add an example to the replay memory.
-
-        If memory is full and maxsize is enabled, a random example from
-        memory is replaced with a passed example.
+        Add an example to the replay memory. Empty ``AS_t1``
+        matrix is stored as None. ``domain`` is used only
+        for ``stratified`` sampling.
+
+        If memory is full (see ``maxsize`` and ``maxlinks``), an example
+        chosen by the eviction policy is replaced with a passed example.
+        If ``maxbytes`` is set, examples are evicted after
+        adding until memory fits.
         """
-        # TODO: In AS matrix rows of S columns usually contains the same data;
-        # delta-compress them?
-        item = (as_t, AS_t1, r_t1)
         too_large = False
-        if self.maxsize and len(self.data) >= self.maxsize:
+        if self.maxsize and self._size >= self.maxsize:
             too_large = True
         elif self.maxlinks and self._n_links >= self.maxlinks:
             too_large = True
-        self._n_links += AS_t1.shape[0] if AS_t1 is not None else 0
+        n_next = AS_t1.shape[0] if AS_t1 is not None else 0
         if not too_large:
-            self.data.append(item)
+            idx = self._size
+            self._size += 1
+            self._reserve(self._size)
         else:
-            idx = random.randint(0, len(self.data)-1)
-            removed = self.data[idx]
-            if removed[1] is not None:
-                self._n_links -= removed[1].shape[0]
-            self.data[idx] = item
+            idx = self._eviction.choose(self._size)
+            self._release(idx)
+        self._n_links += n_next
+        self._starts[idx] = self._append(as_t)
+        if n_next:
+            self._append(AS_t1)
+        self._n_next[idx] = n_next
+        self._rewards[idx] = r_t1
+        self._Q_t1_cache_version[idx] = -1
+        if self.prioritized:
+            self._priorities.update([idx], self._max_priority)
+        self._eviction.add(idx, self._max_priority)
+        if self._sampler is not None:
+            self._sampler.add(idx, self._stratum_key(domain, r_t1))
+        if self.maxbytes:
+            while self.nbytes() > self.maxbytes and self._size > 1:
+                self._remove(self._eviction.choose(self._size))
+        if self._actions.n_dead > self.compact_ratio * len(self._actions):
+            self._compact()
+
+    def _release(self, idx: int) -> None:
+        """ Free arena rows of an example at ``idx`` """
+        start, n_next = self._starts[idx], self._n_next[idx]
+        self._n_links -= n_next
+        rows = np.arange(start, start + 1 + n_next)
+        self._actions.free_rows(rows)
+        if self._factored:
+            states = self._state_idx[rows]
+            np.subtract.at(self._state_refs, states, 1)
+            states = np.unique(states)
+            self._states.free_rows(states[self._state_refs[states] == 0])
+        self._eviction.remove(idx)
+        if self._sampler is not None:
+            self._sampler.remove(idx)
+
+    def _remove(self, idx: int) -> None:
+        """
+        Remove an example at ``idx``; the last example
+        is moved to its place.
+        """
+        self._release(idx)
+        last = self._size - 1
+        if idx != last:
+            for values in [self._starts, self._n_next, self._rewards,
+                           self._Q_t1_cache, self._Q_t1_cache_version]:
+                values[idx] = values[last]
+            if self.prioritized:
+                self._priorities.update([idx], self._priorities[[last]])
+            self._eviction.move(last, idx)
+            if self._sampler is not None:
+                self._sampler.move(last, idx)
+        if self.prioritized:
+            self._priorities.update([last], 0.0)
+        self._size = last
+
+    def _stratum_key(self, domain: Optional[str],
+                     r_t1: float) -> Tuple[Optional[str], int]:
+        return domain, bisect.bisect_left(self.reward_bins, r_t1)
+
+    def _append(self, AS) -> int:
+        """ Append rows of ``AS`` to the arena, return the first row id """
+        if (isinstance(AS, InternedRow) and
+                not isinstance(self._actions, InternedArena)):
+            AS = AS.tocsr()
+        factored = isinstance(AS, FactoredAS)
+        if self._factored is None:
+            self._factored = factored
+        elif factored != self._factored:
+            raise ValueError("FactoredAS and CSR observations "
+                             "can't be mixed in the same memory")
+        if not factored:
+            return self._actions.append(AS)
+        start = self._actions.append(AS.A)
+        stop = start + AS.shape[0]
+        if stop > len(self._state_idx):
+            self._state_idx = resized(
+                self._state_idx, max(stop, 2 * len(self._state_idx)))
+        states = AS.state_idx + self._state_offset(AS.S)
+        self._state_idx[start:stop] = states
+        if len(self._states) > len(self._state_refs):
+            self._state_refs = resized(
+                self._state_refs,
+                max(len(self._states), 2 * len(self._state_refs)))
+        np.add.at(self._state_refs, states, 1)
+        return start
+
+    def _state_offset(self, S: sparse.csr_matrix) -> int:
+        """
+        Return the first row of ``S`` in the state arena; S is stored
+        if it is not there yet, or if some of its rows are freed.
+        """
+        key = id(S)
+        entry = self._state_rows.get(key)
+        if (entry is not None and entry[0]() is S and
+                self._states.is_live(entry[1], entry[2])):
+            return entry[1]
+        offset = self._states.append(S)
+        state_rows = self._state_rows
+
+        def forget(ref):
+            if state_rows.get(key, (None,))[0] is ref:
+                del state_rows[key]
+
+        state_rows[key] = (weakref.ref(S, forget), offset, S.shape[0])
+        return offset
+
+    def _compact(self) -> None:
+        """ Remove rows of replaced observations from arenas """
+        mapping = self._actions.compact()
+        self._starts[:self._size] = mapping[self._starts[:self._size]]
+        if not self._factored:
+            return
+        state_idx = self._state_idx[:len(mapping)][mapping >= 0]
+        self._state_idx[:len(state_idx)] = state_idx
+        self._states.retain(state_idx)
+        if self._states.n_dead <= self.compact_ratio * len(self._states):
+            return
+        state_mapping = self._states.compact()
+        self._state_idx[:len(state_idx)] = state_mapping[state_idx]
+        live = state_mapping >= 0
+        refs = self._state_refs[:len(state_mapping)][live]
+        self._state_refs[:len(state_mapping)] = 0
+        self._state_refs[:len(refs)] = refs
+        for key, (ref, first, n_rows) in list(self._state_rows.items()):
+            new_first = state_mapping[first]
+            new_last = state_mapping[first + n_rows - 1]
+            if new_first >= 0 and new_last - new_first == n_rows - 1:
+                self._state_rows[key] = (ref, new_first, n_rows)
+            else:
+                del self._state_rows[key]
+
+    def _take(self, rows: np.ndarray):
+        """ Return a state-action matrix with arena ``rows`` """
+        A = self._actions.take(rows)
+        if not self._factored:
+            return A
+        states, state_idx = np.unique(self._state_idx[rows],
+                                      return_inverse=True)
+        return FactoredAS(A, self._states.take(states), state_idx)
+
+    def get_as_t(self, indices: np.ndarray):
+        """
+        Return a matrix with ``as_t`` rows of examples at ``indices``
+        (a :class:`FactoredAS` matrix if factored examples are stored).
+        """
+        return self._take(self._starts[indices])
+
+    def get_AS_t1(self, indices: np.ndarray) -> Tuple[Any, np.ndarray]:
+        """
+        Return ``(AS_t1, indptr)`` tuple for examples at ``indices``:
+        ``AS_t1`` matrices stacked vertically, and an array such that
+        ``AS_t1`` rows ``indptr[i]:indptr[i+1]`` belong to
+        the i-th example.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self._n_next[indices]
+        indptr = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        rows = (np.repeat(self._starts[indices] + 1 - indptr[:-1], lengths) +
+                np.arange(indptr[-1], dtype=np.int64))
+        return self._take(rows), indptr
+
+    def get_rewards(self, indices: np.ndarray) -> np.ndarray:
+        """ Return rewards of examples at ``indices`` """
+        return self._rewards[indices]
+
+    def sample_indices(self, k: int) -> np.ndarray:
+        """
+        Return indices of no more than ``k`` random examples
+        from the memory.
+        """
+        assert k >= 0
+        if self._sampler is not None:
+            return self._sampler.sample(k)
+        if self.prioritized and self._size and self._priorities.total > 0:
+            # examples are sampled with replacement
+            return self._priorities.sample(k)
+        k = min(k, self._size)
+        return np.array(random.sample(range(self._size), k),
+                        dtype=np.int64)
+
+    def update_priorities(self,
+                          indices: np.ndarray,
+                          priorities: np.ndarray,
+                          eps: float=1e-3) -> None:
+        """
+        Set sampling priorities of examples at ``indices``;
+        ``eps`` is added to priorities, so that all examples have
+        a chance to be sampled.
+        """
+        priorities = np.asarray(priorities) + eps
+        self._priorities.update(indices, priorities)
+        self._max_priority = max(self._max_priority, priorities.max())
+
+    def importance_weights(self,
+                           indices: np.ndarray,
+                           beta: float) -> np.ndarray:
+        """
+        Return importance sampling weights which compensate for
+        non-uniform sampling of examples at ``indices``. Weights are
+        normalized so that the max weight is 1.
+        """
+        probs = self._priorities[indices] / self._priorities.total
+        weights = (self._size * probs) ** -beta
+        return weights / weights.max()
+
+    def get(self, indices: Iterable[int]) -> List[Tuple[Any, Any, Any]]:
+        """
+        Return examples stored at ``indices``
+        as ``(as_t, AS_t1, r_t1)`` tuples.
+        """
+        items = []
+        for idx in indices:
+            start, n_next = self._starts[idx], self._n_next[idx]
+            as_t = self._take(np.array([start]))
+            AS_t1 = None
+            if n_next:
+                AS_t1 = self._take(np.arange(start + 1, start + 1 + n_next))
+            items.append((as_t, AS_t1, float(self._rewards[idx])))
+        return items
 
     def sample(self, k: int) -> List[Tuple[Any, Any, Any]]:
         """
         Return no more than ``k`` random examples from the memory.
         """
-        assert k >= 0
-        k = min(k, len(self.data))
-        return random.sample(self.data, k)
+        return self.get(self.sample_indices(k))
+
+    def get_cached_Q_t1(self,
+                        indices: np.ndarray,
+                        version: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return ``(values, is_cached)`` tuple for examples at ``indices``:
+        Q values of next states cached for a target Q function ``version``,
+        and a boolean mask which tells if a value is in cache.
+        Values which are not in cache are zeros.
+        """
+        is_cached = self._Q_t1_cache_version[indices] == version
+        values = np.where(is_cached, self._Q_t1_cache[indices], 0)
+        return values, is_cached
+
+    def set_cached_Q_t1(self,
+                        indices: np.ndarray,
+                        values: np.ndarray,
+                        version: int) -> None:
+        """
+        Cache Q values of next states for examples at ``indices``,
+        computed using target Q function ``version``.
+        """
+        self._Q_t1_cache[indices] = values
+        self._Q_t1_cache_version[indices] = version
+
+    def _reserve(self, size: int) -> None:
+        """ Grow per-example arrays to fit ``size`` examples """
+        capacity = len(self._starts)
+        if size <= capacity:
+            return
+        capacity = max(size, capacity * 2)
+        self._starts = resized(self._starts, capacity)
+        self._n_next = resized(self._n_next, capacity)
+        self._rewards = resized(self._rewards, capacity)
+        self._Q_t1_cache = resized(self._Q_t1_cache, capacity)
+        self._Q_t1_cache_version = resized(self._Q_t1_cache_version,
+                                            capacity, fill=-1)
 
     def clear(self) -> None:
-        self.data.clear()
-        self._n_links = 0
+        self._reset()
+
+    def save(self, path: str) -> None:
+        """
+        Save examples to ``path`` directory as ``.npy`` files
+        (see :meth:`load`). Saving to the same directory again is
+        incremental: unless memory is compacted, only rows of examples
+        added since the previous save are written, plus a few small
+        per-example arrays. Files which are not needed anymore are removed.
+        """
+        dir_path = Path(path)
+        dir_path.mkdir(parents=True, exist_ok=True)
+        manifest_path = dir_path / 'memory.json'
+        previous = {}  # type: Dict[str, Any]
+        if manifest_path.exists():
+            previous = json.loads(manifest_path.read_text())
+
+        token = uuid.uuid4().hex
+        size = self._size
+        examples = {
+            'starts': self._starts[:size],
+            'n_next': self._n_next[:size],
+            'rewards': self._rewards[:size],
+        }
+        if self.prioritized:
+            examples['priorities'] = self._priorities[np.arange(size)]
+        if self._sampler is not None:
+            examples['strata'] = self._sampler.strata(size)
+        for key, values in examples.items():
+            np.save(str(dir_path / self._examples_file(token, key)), values)
+        row_arrays = {}
+        if self._factored:
+            row_arrays['state_idx'] = self._state_idx
+        manifest = {  # type: Dict[str, Any]
+            'token': token,
+            'size': size,
+            'n_links': int(self._n_links),
+            'factored': self._factored,
+            'max_priority': self._max_priority,
+            'examples': sorted(examples),
+            'strata': (self._sampler.keys if self._sampler is not None
+                       else None),
+            'actions': self._actions.save(
+                dir_path, 'actions', previous.get('actions'), row_arrays),
+            'states': self._states.save(
+                dir_path, 'states', previous.get('states')),
+        }
+        tmp_path = manifest_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(manifest))
+        os.replace(str(tmp_path), str(manifest_path))
+
+        used = set(manifest['actions']['files'] + manifest['states']['files'])
+        used.update(self._examples_file(token, key) for key in examples)
+        for file_path in dir_path.glob('*.npy'):
+            if file_path.name not in used:
+                file_path.unlink()
+
+    def load(self, path: str, mmap: bool=False) -> None:
+        """
+        Replace memory contents with examples saved by :meth:`save`
+        to ``path`` directory. ``maxsize``, ``maxlinks`` and other options
+        of this memory are kept. Cached Q values are not restored.
+
+        With ``mmap=True`` saved files are memory-mapped instead of
+        being read to RAM; use it to load a large memory
+        which uses memory-mapped storage (see ``path`` argument).
+        """
+        dir_path = Path(path)
+        manifest = json.loads((dir_path / 'memory.json').read_text())
+        examples = {
+            key: np.load(str(dir_path / self._examples_file(
+                manifest['token'], key)), mmap_mode='r' if mmap else None)
+            for key in manifest['examples']
+        }
+        self._reset()
+        size = manifest['size']
+        self._reserve(size)
+        self._size = size
+        self._starts[:size] = examples['starts']
+        self._n_next[:size] = examples['n_next']
+        self._rewards[:size] = examples['rewards']
+        self._n_links = manifest['n_links']
+        self._factored = manifest['factored']
+        row_arrays = self._actions.load(dir_path, manifest['actions'], mmap)
+        self._states.load(dir_path, manifest['states'], mmap)
+
+        # rows of replaced examples are not restored as dead
+        # by the arenas; mark them dead again
+        lengths = 1 + self._n_next[:size]
+        offsets = np.cumsum(lengths) - lengths
+        rows = (np.repeat(self._starts[:size] - offsets, lengths) +
+                np.arange(lengths.sum(), dtype=np.int64))
+        self._actions.retain(rows)
+        if self._factored:
+            self._state_idx = row_arrays['state_idx']
+            self._state_refs = np.bincount(self._state_idx[rows],
+                                           minlength=len(self._states))
+            self._states.retain(self._state_idx[rows])
+
+        if self.prioritized:
+            self._max_priority = manifest['max_priority']
+        priorities = np.full(size, self._max_priority)
+        if self.prioritized:
+            priorities = examples.get('priorities', priorities)
+            self._priorities.update(np.arange(size), priorities)
+        # arena rows are ordered by insertion time
+        for idx in np.argsort(self._starts[:size], kind='stable'):
+            self._eviction.add(int(idx), float(priorities[idx]))
+        if self._sampler is not None:
+            if manifest.get('strata') is not None:
+                keys = [tuple(key) for key in manifest['strata']]
+                for idx, stratum in enumerate(examples['strata'].tolist()):
+                    self._sampler.add(idx, keys[stratum])
+            else:
+                # memory saved without strata: domains are unknown
+                for idx, r_t1 in enumerate(self._rewards[:size].tolist()):
+                    self._sampler.add(idx, self._stratum_key(None, r_t1))
+
+    def copy_from(self, memory: 'ExperienceMemory') -> None:
+        """
+        Replace memory contents with examples of another ``memory``.
+        Arena rows, strata and priorities of examples are copied
+        as arrays, through a temporary directory (see :meth:`save`
+        and :meth:`load`); it is created in ``path`` if it is set.
+        """
+        tmp_path = tempfile.mkdtemp(prefix='memory-copy-',
+                                    dir=getattr(self, 'path', None))
+        try:
+            memory.save(tmp_path)
+            self.load(tmp_path)
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def _examples_file(self, token: str, key: str) -> str:
+        return 'examples-%s.%s.npy' % (token, key)
 
     def __len__(self) -> int:
-        return len(self.data)
+        return self._size
 
     def nbytes(self) -> int:
         """
-        Memory taken by sparse matrices in self.data.
+        Memory taken by stored examples: their arena rows and
+        per-example arrays. Rows of evicted examples which are not
+        compacted yet are not counted. With ``path`` arena rows are
+        on disk, and only a part of them is in RAM.
+
+        The value is maintained incrementally, so this method is cheap.
         """
-        return sum(csr_nbytes(as_t) + csr_nbytes(AS_t1)
-                   for as_t, AS_t1, _ in self.data)
+        per_example = sum(values.itemsize for values in [
+            self._starts, self._n_next, self._rewards,
+            self._Q_t1_cache, self._Q_t1_cache_version])
+        nbytes = self._actions.live_nbytes + self._size * per_example
+        if self._factored:
+            n_rows = len(self._actions) - self._actions.n_dead
+            nbytes += (self._states.live_nbytes +
+                       n_rows * self._state_idx.itemsize)
+        return nbytes
+
+    def __getstate__(self):
+        dct = self.__dict__.copy()
+        dct['_state_rows'] = {}  # weak references can't be pickled
+        return dct
+
+    def __setstate__(self, state):
+        data = state.pop('data', None)
+        if data is None:
+            self.__dict__.update(state)
+            return
+        # memory pickled by an older version: a list of observations
+        self.__init__(maxsize=state.get('maxsize'),
+                      maxlinks=state.get('maxlinks'),
+                      prioritized=state.get('prioritized', False))
+        for as_t, AS_t1, r_t1 in data:
+            self.add(as_t, AS_t1, r_t1)
@@ -15,21 +15,32 @@ It should:
 This module contains custom Scrapy queues which allow to do that:
 :class:`BalancedPriorityQueue` allows to have per-domain request queues and
 sample from them, :class:`RequestsPriorityQueue` is a per-domain queue
-which allows to update request priorities.
+which allows to update request priorities. :class:`FrontierVectors`
+keeps link vectors of requests from all queues in a single arena,
+so that all of them can be scored at once. All queued requests
+can be saved to a binary snapshot to resume a crawl
+(:meth:`BalancedPriorityQueue.save`).
 """
+import functools
 import heapq
-import itertools
+import os
 import random
 import csv
+import weakref
 from typing import (
     List, Any, Iterable, Optional, Callable, Dict, Iterator, Set, TextIO,
-    Sized,
+    Sized, Tuple,
 )
 
 import numpy as np  # type: ignore
+from scipy import sparse  # type: ignore
 import scrapy  # type: ignore
 
-from deepdeep.utils import softmax, log_time, csr_nbytes
+from deepdeep.arena import CSRArena
+from deepdeep.interning import InternedRow
+from deepdeep.snapshot import SnapshotWriter, read_snapshot
+from deepdeep.sumtree import SumTree
+from deepdeep.utils import log_time, csr_nbytes, resized
 
 
 FLOAT_PRIORITY_MULTIPLIER = 10000
@@ -47,6 +58,246 @@ class QueueClosed(Exception):
     pass
 
 
+class FrontierVectors:
+    """
+    Link vectors of queued requests from all queues, stored
+    in a single :class:`deepdeep.arena.CSRArena` (use
+    :class:`deepdeep.interning.InternedArena` to store each distinct
+    vector once). Rows are indexed by frontier row ids.
+
+    A :class:`RequestsPriorityQueue` which uses it removes
+    ``link_vector`` from meta of a pushed request and keeps a row id
+    instead; the vector is put back to meta when the request is removed
+    from the queue. Rows of removed requests are compacted when they take
+    more than ``compact_ratio`` of the arena; queues are notified, so that
+    they can update row ids.
+
+    Vectors of all queued requests are scored at once with :meth:`score`.
+    When a linear model changes only a little, :meth:`update_scores`
+    rescores only the rows affected by the change (see
+    :meth:`rows_by_queue` to find their requests).
+    """
+    compact_ratio = 0.5
+
+    # update_scores ignores weight changes smaller than delta_tol
+    delta_tol = 1e-4
+
+    # the inverted index is rebuilt when rows appended after it is built
+    # take more than index_ratio of indexed rows
+    index_ratio = 0.25
+
+    def __init__(self, arena: Optional[CSRArena]=None) -> None:
+        self.arena = arena if arena is not None else CSRArena()
+        self._queues = weakref.WeakValueDictionary()  # type: weakref.WeakValueDictionary
+        self._next_queue_id = 0
+        # row id -> id of a queue which owns the row (-1 for free rows),
+        # and a handle of the request in that queue
+        self._row_queues = np.zeros(0, dtype=np.int64)
+        self._row_handles = np.zeros(0, dtype=np.int64)
+        # update_scores state: weights and scores of the first
+        # _n_indexed rows, and the inverted index of these rows
+        self._weights = None  # type: Optional[np.ndarray]
+        self._intercept = 0.0
+        self._scores = np.zeros(0)
+        self._index = None  # type: Optional[sparse.csc_matrix]
+        self._n_indexed = 0
+
+    def register(self, queue: 'RequestsPriorityQueue') -> int:
+        """
+        Update row ids of ``queue`` when the arena is compacted;
+        return an id of the queue, to be passed to :meth:`add`.
+        """
+        queue_id = self._next_queue_id
+        self._next_queue_id += 1
+        self._queues[queue_id] = queue
+        return queue_id
+
+    @staticmethod
+    def can_store(vector: Any) -> bool:
+        """ Return True if ``vector`` can be stored in the arena """
+        return ((sparse.issparse(vector) or isinstance(vector, InternedRow))
+                and vector.shape[0] == 1)
+
+    def add(self, vector: Any, queue_id: int=-1, handle: int=-1) -> int:
+        """
+        Store a vector of a request with ``handle`` in a queue
+        with ``queue_id``; return its row id.
+        """
+        row = self.arena.append(vector)
+        self._reserve(row + 1)
+        self._row_queues[row] = queue_id
+        self._row_handles[row] = handle
+        return row
+
+    def add_rows(self,
+                 m: sparse.csr_matrix,
+                 queue_id: int,
+                 handles: np.ndarray) -> np.ndarray:
+        """
+        Store rows of ``m``, which are vectors of requests with ``handles``
+        in a queue with ``queue_id``; return their row ids.
+        """
+        start = self.arena.append(m)
+        rows = np.arange(start, start + m.shape[0], dtype=np.int64)
+        self._reserve(start + m.shape[0])
+        self._row_queues[rows] = queue_id
+        self._row_handles[rows] = handles
+        return rows
+
+    def _reserve(self, n_rows: int) -> None:
+        if n_rows > len(self._row_queues):
+            capacity = max(n_rows, 2 * len(self._row_queues))
+            self._row_queues = resized(self._row_queues, capacity, fill=-1)
+            self._row_handles = resized(self._row_handles, capacity, fill=-1)
+
+    def take(self, rows) -> sparse.csr_matrix:
+        """ Return a CSR matrix with vectors from ``rows`` """
+        return self.arena.take(rows)
+
+    def free(self, rows) -> None:
+        """ Free ``rows``; the arena is compacted if needed """
+        rows = np.asarray(rows, dtype=np.int64)
+        self._row_queues[rows] = -1
+        self.arena.free_rows(rows)
+        if self.arena.n_dead > self.compact_ratio * len(self.arena):
+            self._compact()
+
+    def _compact(self) -> None:
+        n_rows = len(self.arena)
+        mapping = self.arena.compact()
+        live = np.flatnonzero(mapping >= 0)
+        for values in [self._row_queues, self._row_handles]:
+            values[:len(live)] = values[live]
+            values[len(live):n_rows] = -1
+        if self._weights is not None:
+            indexed = live[live < self._n_indexed]
+            self._scores = self._scores[indexed]
+            self._n_indexed = len(indexed)
+            self._index = None  # it is rebuilt on the next update
+        for queue in list(self._queues.values()):
+            queue.remap_rows(mapping)
+
+    def score(self,
+              predict: Callable[[sparse.csr_matrix], np.ndarray],
+              chunk_size: int=1 << 20,
+              start: int=0) -> np.ndarray:
+        """
+        Return scores of all rows (or rows from ``start``), indexed by
+        row id; rows are scored by ``predict`` function which accepts
+        a CSR matrix. Usually it is a single sparse matrix-vector product
+        over the arena; large arenas are scored ``chunk_size`` rows at
+        a time. Scores of free rows are meaningless.
+        """
+        n_rows = len(self.arena)
+        if start >= n_rows:
+            return np.zeros(0)
+        return np.concatenate([
+            predict(self.arena.tocsr(pos, min(pos + chunk_size, n_rows)))
+            for pos in range(start, n_rows, chunk_size)])
+
+    def reset_scores(self, scorer: Any) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Score all rows with ``scorer`` (a linear model, e.g.
+        :class:`deepdeep.qlearning.LinearScorer`) and remember its
+        weights for :meth:`update_scores`. Return ``(row_scores, rows)``:
+        scores of all rows, indexed by row id, and ids of live rows.
+        """
+        n_features = self.arena.n_features or 0
+        self._weights = np.array(scorer.weights(np.arange(n_features)),
+                                 dtype=np.float64)
+        self._intercept = scorer.intercept
+        self._scores = self.score(self._predict)
+        self._n_indexed = len(self._scores)
+        self._index = None
+        return self._scores, self._live_rows()
+
+    def update_scores(self, scorer: Any) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Update row scores after weights of a linear model are changed,
+        rescoring only rows which have features with changed weights.
+        Return ``(row_scores, rows)``: scores of all rows, indexed by
+        row id, and ids of live rows with changed scores.
+
+        Weights of the last ``scorer`` are remembered (the first call
+        is the same as :meth:`reset_scores`). Changed weights are found
+        by comparing them with weights of ``scorer``, and ``Δw·x`` is
+        added to scores of rows with changed features; the rows are
+        found in an inverted index (a CSC copy of indexed rows).
+        Weight changes smaller than ``delta_tol`` are not applied until
+        they accumulate, so a score of a row ``x`` differs from
+        the exact one by at most ``delta_tol * |x|_1``. Rows appended
+        after the index is built are scored from scratch.
+        """
+        n_features = self.arena.n_features or 0
+        if self._weights is None or len(self._weights) != n_features:
+            return self.reset_scores(scorer)
+        if self._index is None:
+            self._index = self.arena.tocsr(0, self._n_indexed).tocsc()
+        changed = []
+        delta = scorer.weights(np.arange(n_features)) - self._weights
+        features = np.flatnonzero(np.abs(delta) > self.delta_tol)
+        if len(features):
+            self._weights[features] += delta[features]
+            hits = self._index[:, features]
+            np.add.at(self._scores, hits.indices,
+                      hits.data * np.repeat(delta[features],
+                                            np.diff(hits.indptr)))
+            changed.append(hits.indices)
+        delta_intercept = scorer.intercept - self._intercept
+        if abs(delta_intercept) > self.delta_tol:
+            self._intercept = scorer.intercept
+            self._scores += delta_intercept
+            changed.append(np.arange(self._n_indexed))
+
+        n_rows = len(self.arena)
+        tail = self.score(self._predict, start=self._n_indexed)
+        changed.append(np.arange(self._n_indexed, n_rows))
+        scores = np.concatenate([self._scores, tail])
+        if n_rows - self._n_indexed > self.index_ratio * self._n_indexed:
+            self._scores = scores
+            self._n_indexed = n_rows
+            self._index = None
+        rows = np.unique(np.concatenate(changed).astype(np.int64))
+        return scores, rows[self._row_queues[rows] >= 0]
+
+    def _predict(self, m: sparse.csr_matrix) -> np.ndarray:
+        """ Score rows with weights remembered by update_scores """
+        return m.dot(self._weights) + self._intercept
+
+    def _live_rows(self) -> np.ndarray:
+        return np.flatnonzero(self._row_queues[:len(self.arena)] >= 0)
+
+    def rows_by_queue(self, rows: np.ndarray,
+                      ) -> Iterator[Tuple['RequestsPriorityQueue',
+                                          np.ndarray, np.ndarray]]:
+        """
+        Group live ``rows`` by queues; return ``(queue, handles, rows)``
+        tuples, where ``handles`` are handles of requests in ``queue``
+        which own ``rows``.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        queue_ids = self._row_queues[rows]
+        order = np.argsort(queue_ids, kind='mergesort')
+        rows, queue_ids = rows[order], queue_ids[order]
+        bounds = np.flatnonzero(np.diff(queue_ids)) + 1
+        for group in np.split(rows, bounds):
+            if not len(group):
+                continue
+            queue = self._queues.get(int(self._row_queues[group[0]]))
+            if queue is not None:
+                yield queue, self._row_handles[group], group
+
+    def nbytes(self) -> int:
+        """
+        Memory used by vectors of queued requests
+        and by the :meth:`update_scores` state.
+        """
+        nbytes = self.arena.live_nbytes + self._scores.nbytes
+        if self._weights is not None:
+            nbytes += self._weights.nbytes
+        return nbytes + csr_nbytes(self._index)
+
+
 class RequestsPriorityQueue(Sized):
     """
     In-memory priority queue for requests.
@@ -54,65 +305,199 @@ class RequestsPriorityQueue(Sized):
     Unlike default Scrapy queues it supports high-cardinality priorities
     (but no float priorities because scrapy.Request doesn't support them).
 
-    This queue allows to change request priorities. To do it
-
-    1. iterate over queue.entries;
-    2. call queue.change_priority(entry, new_priority) for each entry;
-    3. call queue.heapify()
-
-    It also allows to remove a request from a queue using remove_entry,
-    and limit queue size with maxsize argument (queue is trimmed when
-    updating request priorities).
+    Requests are stored in a table indexed by integer handles
+    (:meth:`push` returns a handle); priorities and sequence numbers
+    of requests are stored in numpy arrays indexed by handles.
+    Handles of removed requests are reused.
+
+    Request order is kept as a sorted array of handles, built by
+    :meth:`heapify`, plus a heap of requests pushed after that.
+    Entries of removed requests and outdated priorities are tombstones
+    in this order; they are skipped lazily, and the order is rebuilt when
+    they take more than ``compact_ratio`` of it. When ``maxsize`` is set,
+    the order is double-ended: the sorted array is also consumed from
+    the end, and there is a second heap of pushed requests with
+    the lowest priority at the top, so that the request which would be
+    popped last is found in O(log n).
+
+    This queue allows to change request priorities: use
+    :meth:`update_all_priorities`, or :meth:`update_priorities` with
+    handles from :meth:`iter_active_entries`. It also allows to remove
+    a request from a queue using :meth:`remove_entry`, and limit queue
+    size with maxsize argument: when a request is pushed to a full queue,
+    the request which would be popped last is dropped. ``maxsize``
+    should be set when the queue is created; call :meth:`heapify`
+    after changing it. ``n_evicted`` attribute is the number of dropped
+    requests, and ``on_evict`` is a function called with a number
+    of requests dropped.
+
+    ``priority`` attributes of requests are updated when they are
+    popped or iterated over.
+
+    When ``vectors`` (:class:`FrontierVectors`) is passed, link vectors
+    of queued requests are kept there instead of request meta
+    (see :meth:`rescore`).
+
+    ``on_change`` attribute is a function called without arguments
+    when the top request or its priority may be changed.
     """
 
-    REMOVED = object()
-
-    REMOVED_PRIORITY = score_to_priority(15000)
     EMPTY_PRIORITY = score_to_priority(-15000)
 
-    def __init__(self, fifo: bool=True, maxsize: Optional[int]=None) -> None:
-        # entries are lists of [int, int, scrapy.Request]
-        self.entries = []  # type: List[List]
-        step = 1 if fifo else -1
-        self.counter = itertools.count(step=step)
+    def __init__(self,
+                 fifo: bool=True,
+                 maxsize: Optional[int]=None,
+                 compact_ratio: float=0.5,
+                 vectors: Optional[FrontierVectors]=None,
+                 ) -> None:
         self.maxsize = maxsize
-
-    def push(self, request: scrapy.Request) -> List:
-        count = next(self.counter)
-        entry = [-request.priority, count, request]
-        heapq.heappush(self.entries, entry)
-        return entry
+        self.compact_ratio = compact_ratio
+        self.on_change = None  # type: Optional[Callable[[], Any]]
+        self.on_evict = None  # type: Optional[Callable[[int], Any]]
+        self.n_evicted = 0
+        self.vectors = vectors
+        self._vectors_id = -1
+        if vectors is not None:
+            self._vectors_id = vectors.register(self)
+        self._count_step = 1 if fifo else -1
+        self._next_count = 0
+        # handle -> request, priority and sequence number
+        self._requests = []  # type: List[Optional[scrapy.Request]]
+        self._priorities = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int64)
+        # handle -> FrontierVectors row id (-1 if the vector is not there)
+        self._rows = np.zeros(0, dtype=np.int64)
+        self._free = []  # type: List[int]
+        # handles of queued requests, and position of each handle there
+        # (-1 for removed requests)
+        self._live = np.zeros(0, dtype=np.int64)
+        self._live_pos = np.zeros(0, dtype=np.int64)
+        self._n_live = 0
+        # handles sorted by (-priority, count) at the last heapify call
+        self._order = np.zeros(0, dtype=np.int64)
+        self._order_priorities = np.zeros(0, dtype=np.int64)
+        self._order_counts = np.zeros(0, dtype=np.int64)
+        self._order_pos = 0
+        self._order_end = 0
+        # (-priority, count, handle) entries added after heapify call
+        self._heap = []  # type: List[Tuple[int, int, int]]
+        # (priority, -count, handle) entries added after heapify call,
+        # if maxsize is set
+        self._min_heap = []  # type: List[Tuple[int, int, int]]
+
+    def push(self, request: scrapy.Request) -> int:
+        """
+        Add a request to the queue; return its handle. If the queue
+        is full, the request which would be popped last is dropped;
+        -1 is returned if it is the pushed request.
+        """
+        if self.maxsize and self._n_live >= self.maxsize:
+            bottom = self._bottom()
+            if bottom is not None:
+                if ((request.priority, -self._next_count) <=
+                        (self._priorities[bottom], -self._counts[bottom])):
+                    self._evicted(1)
+                    return -1
+                self._evict(bottom)
+        if self._free:
+            handle = self._free.pop()
+        else:
+            handle = len(self._requests)
+            self._requests.append(None)
+            if handle >= len(self._priorities):
+                capacity = max(16, 2 * len(self._priorities))
+                self._priorities = resized(self._priorities, capacity)
+                self._counts = resized(self._counts, capacity)
+                self._rows = resized(self._rows, capacity, fill=-1)
+                self._live = resized(self._live, capacity)
+                self._live_pos = resized(self._live_pos, capacity, fill=-1)
+        count = self._next_count
+        self._next_count += self._count_step
+        self._requests[handle] = request
+        self._priorities[handle] = request.priority
+        vector = request.meta.get('link_vector')
+        if self.vectors is not None and self.vectors.can_store(vector):
+            self._rows[handle] = self.vectors.add(vector, self._vectors_id,
+                                                  handle)
+            del request.meta['link_vector']
+        self._counts[handle] = count
+        self._live[self._n_live] = handle
+        self._live_pos[handle] = self._n_live
+        self._n_live += 1
+        heapq.heappush(self._heap, (-request.priority, count, handle))
+        if self.maxsize:
+            heapq.heappush(self._min_heap, (request.priority, -count, handle))
+        self._changed()
+        return handle
+
+    def push_many(self,
+                  requests: List[scrapy.Request],
+                  vectors: Optional[sparse.csr_matrix]=None,
+                  with_vectors: Optional[np.ndarray]=None,
+                  ) -> np.ndarray:
+        """
+        Add requests to the queue; return their handles
+        (see :meth:`push`). ``vectors`` is a CSR matrix with link vectors
+        of requests at ``with_vectors`` positions in ``requests``; they are
+        added to :class:`FrontierVectors` at once instead of one by one.
+        """
+        handles = np.array([self.push(request) for request in requests],
+                           dtype=np.int64)
+        if (vectors is not None and with_vectors is not None and
+                len(with_vectors)):
+            with_vectors = np.asarray(with_vectors, dtype=np.int64)
+            if self.maxsize:
+                # requests can be dropped when the queue is full
+                queued = np.array([
+                    handle >= 0 and self._requests[handle] is requests[idx]
+                    for handle, idx in zip(handles[with_vectors].tolist(),
+                                           with_vectors.tolist())],
+                    dtype=bool)
+                vectors = vectors[np.flatnonzero(queued)]
+                with_vectors = with_vectors[queued]
+            if self.vectors is None:
+                for pos, idx in enumerate(with_vectors.tolist()):
+                    requests[idx].meta['link_vector'] = vectors[pos]
+            elif len(with_vectors):
+                self._rows[handles[with_vectors]] = self.vectors.add_rows(
+                    vectors, self._vectors_id, handles[with_vectors])
+        self.heapify()
+        return handles
 
     def pop(self) -> Optional[scrapy.Request]:
-        while self.entries:
-            priority, count, request = heapq.heappop(self.entries)
-            if request is not self.REMOVED:
-                self._pop_empty()
-                return request
-        return None
+        handle = self._top()
+        if handle is None:
+            return None
+        return self.remove_entry(handle)
 
-    @classmethod
-    def change_priority(cls,
-                        entry: List,
-                        new_priority: int) -> None:
+    def change_priority(self, entry: int, new_priority: int) -> None:
         """
-        Change priority of an existing entry.
-
-        ``entry`` is an item from :attr:`entries` attribute.
-
-        After priorities are changed it is necessary to call
-        :meth:`heapify`.
+        Change priority of a request with ``entry`` handle.
+        To change priorities of many requests use :meth:`update_priorities`.
         """
-        entry[0] = -new_priority
-        if cls.entry_is_active(entry):
-            entry[2].priority = new_priority
+        self._priorities[entry] = new_priority
+        count = int(self._counts[entry])
+        heapq.heappush(self._heap, (-new_priority, count, entry))
+        if self.maxsize:
+            heapq.heappush(self._min_heap, (new_priority, -count, entry))
+        self._changed()
+        self._maybe_compact()
+
+    def update_priorities(self, entries, priorities) -> None:
+        """
+        Set ``priorities`` of requests with ``entries`` handles;
+        the order of requests is rebuilt.
+        """
+        self._priorities[np.asarray(entries, dtype=np.int64)] = priorities
+        self.heapify()
 
-    @classmethod
-    def entry_is_active(cls, entry: List) -> bool:
-        return entry[2] is not cls.REMOVED
+    def entry_is_active(self, entry: int) -> bool:
+        """ Return True if a request with ``entry`` handle is queued """
+        return bool(self._live_pos[entry] >= 0)
 
-    def iter_active_entries(self) -> Iterator[List]:
-        return (e for e in self.entries if self.entry_is_active(e))
+    def iter_active_entries(self) -> Iterator[int]:
+        """ Return handles of all queued requests """
+        return iter(self._live[:self._n_live].tolist())
 
     def update_all_priorities(self,
                               compute_priority_func: Callable[[List[scrapy.Request]], List[int]]) -> None:
@@ -123,90 +508,346 @@ class RequestsPriorityQueue(Sized):
         new priority; it should accept a list of Requests and return a list of
         integer priorities.
         """
+        handles = self._live[:self._n_live].copy()
         requests = list(self.iter_requests())
-        new_priorities = compute_priority_func(requests)
-        n = len(new_priorities)
+        new_priorities = np.asarray(compute_priority_func(requests),
+                                    dtype=np.int64)
+        self._set_all_priorities(handles, new_priorities)
+
+    def rescore(self,
+                score_rows: Callable[[np.ndarray], np.ndarray],
+                ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Update priorities of requests with vectors in :class:`FrontierVectors`;
+        ``score_rows`` is a function which returns scores for an array
+        of row ids (e.g. ``row_scores.__getitem__`` for scores
+        returned by :meth:`FrontierVectors.score`). Priorities of other
+        requests (e.g. seeds) are kept.
+        Return ``(old_priorities, new_priorities)`` arrays.
+        """
+        handles = self._live[:self._n_live].copy()
+        rows = self._rows[handles]
+        old_priorities = self._priorities[handles]
+        new_priorities = old_priorities.copy()
+        has_vector = rows >= 0
+        if has_vector.any():
+            new_priorities[has_vector] = (
+                score_rows(rows[has_vector]) * FLOAT_PRIORITY_MULTIPLIER)
+        self._set_all_priorities(handles, new_priorities)
+        return old_priorities, new_priorities
+
+    def update_scores(self,
+                      entries: np.ndarray,
+                      scores: np.ndarray,
+                      ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Set priorities of requests with ``entries`` handles from
+        float ``scores`` (e.g. rows found by
+        :meth:`FrontierVectors.rows_by_queue`). When only a few requests
+        are changed, the order is updated incrementally; otherwise it
+        is rebuilt and the queue is trimmed to ``maxsize``.
+        Return ``(old_priorities, new_priorities)`` of all queued
+        requests, in :meth:`iter_active_entries` order.
+        """
+        handles = self._live[:self._n_live].copy()
+        old_priorities = self._priorities[handles]
+        new_priorities = old_priorities.copy()
+        entries = np.asarray(entries, dtype=np.int64)
+        new_priorities[self._live_pos[entries]] = (
+            np.asarray(scores) * FLOAT_PRIORITY_MULTIPLIER)
+        if len(entries) > self.compact_ratio * self._n_live:
+            self._set_all_priorities(handles, new_priorities)
+        else:
+            changed = np.flatnonzero(new_priorities != old_priorities)
+            for handle, priority in zip(handles[changed].tolist(),
+                                        new_priorities[changed].tolist()):
+                self.change_priority(handle, priority)
+        return old_priorities, new_priorities
+
+    def priorities(self) -> np.ndarray:
+        """
+        Return priorities of queued requests,
+        in :meth:`iter_active_entries` order.
+        """
+        return self._priorities[self._live[:self._n_live]]
+
+    def _set_all_priorities(self,
+                            handles: np.ndarray,
+                            priorities: np.ndarray) -> None:
+        """
+        Set ``priorities`` of all queued requests (``handles``);
+        the queue is trimmed to ``maxsize``.
+        """
+        n = len(priorities)
         if self.maxsize and n > self.maxsize:
             n_rm = n - self.maxsize
-            to_remove_idx = np.array(new_priorities).argpartition(n_rm)[:n_rm]
-            to_remove = np.zeros(n, dtype=np.bool)
-            to_remove[to_remove_idx] = True
-        else:
-            to_remove = itertools.repeat(False)
-        for entry, priority, remove in zip(self.iter_active_entries(),
-                                           new_priorities,
-                                           to_remove):
-            if remove:
-                self.remove_entry(entry)
-            else:
-                self.change_priority(entry, priority)
+            to_remove = priorities.argpartition(n_rm)[:n_rm]
+            self._remove_many(handles[to_remove])
+            self._evicted(n_rm)
+        self._priorities[handles] = priorities
+        self.heapify()
+
+    def remap_rows(self, mapping: np.ndarray) -> None:
+        """ Update :class:`FrontierVectors` row ids after compaction """
+        handles = self._live[:self._n_live]
+        rows = self._rows[handles]
+        has_vector = rows >= 0
+        self._rows[handles[has_vector]] = mapping[rows[has_vector]]
+
+    def clear(self) -> None:
+        """ Remove all requests """
+        self._remove_many(self._live[:self._n_live].copy())
+        self.heapify()
+
+    def drain(self) -> List[scrapy.Request]:
+        """
+        Remove all requests from the queue and return them,
+        in the order they would be popped.
+        """
+        live = self._live[:self._n_live]
+        handles = live[np.lexsort((self._counts[live],
+                                   -self._priorities[live]))]
+        requests = []
+        rows = []
+        for handle in handles.tolist():
+            request, row = self._release(handle)
+            requests.append(request)
+            if row >= 0:
+                rows.append(row)
+        self._live_pos[handles] = -1
+        self._n_live = 0
+        if rows:
+            assert self.vectors is not None
+            self.vectors.free(rows)
         self.heapify()
+        return requests
 
-    def remove_entry(self, entry: List) -> scrapy.Request:
+    def remove_entry(self, entry: int) -> scrapy.Request:
         """
-        Mark an existing entry as removed.
-        ``entry`` is an item from :attr:`entries` attribute.
+        Remove a request with ``entry`` handle from the queue
+        and return it.
         """
-        request = entry[2]
-        entry[2] = self.REMOVED
-        # move removed entry to the top at next heapify call
-        max_prio = 0 if not self.entries else -self.entries[0][0]
-        entry[0] = - (max_prio + self.REMOVED_PRIORITY)
+        request, row = self._release(entry)
+        self._unlink(entry)
+        if row >= 0:
+            assert self.vectors is not None
+            self.vectors.free([row])
+        self._changed()
+        self._maybe_compact()
         return request
 
+    def _unlink(self, handle: int) -> None:
+        """ Remove ``handle`` from the list of queued requests """
+        pos = self._live_pos[handle]
+        last = self._live[self._n_live - 1]
+        self._live[pos] = last
+        self._live_pos[last] = pos
+        self._live_pos[handle] = -1
+        self._n_live -= 1
+
+    def _evict(self, handle: int) -> None:
+        """
+        Drop a request with ``handle`` to make room for a new one;
+        unlike :meth:`remove_entry`, its link vector is not restored.
+        """
+        row = int(self._rows[handle])
+        self._rows[handle] = -1
+        self._release(handle)
+        self._unlink(handle)
+        if row >= 0:
+            assert self.vectors is not None
+            self.vectors.free([row])
+        self._evicted(1)
+        self._maybe_compact()
+
+    def _evicted(self, n: int) -> None:
+        self.n_evicted += n
+        if self.on_evict is not None:
+            self.on_evict(n)
+
     def pop_random(self, n_attempts: int=10) -> Optional[scrapy.Request]:
-        """ Pop random entry from a queue """
-        self._pop_empty()
-        if not self.entries:
+        """
+        Pop random entry from a queue.
+        ``n_attempts`` is ignored; it is kept for backwards compatibility.
+        """
+        if not self._n_live:
             return None
-
-        # Because we've called _pop_empty it is guaranteed there is at least
-        # one non-removed entry in a queue (the one at the top).
-        for i in range(n_attempts):
-            entry = random.choice(self.entries)
-            if entry[2] is not self.REMOVED:
-                request = self.remove_entry(entry)
-                self._pop_empty()
-                return request
-        return None
+        return self.remove_entry(
+            int(self._live[random.randrange(self._n_live)]))
 
     def max_priority(self) -> int:
         """ Return maximum request priority in this queue """
-        if not self.entries:
+        handle = self._top()
+        if handle is None:
             return self.EMPTY_PRIORITY
-        return -self.entries[0][0]
+        return int(self._priorities[handle])
 
     @property
     def next_request(self) -> Optional[scrapy.Request]:
-        if not self.entries:
+        handle = self._top()
+        if handle is None:
             return None
-        return self.entries[0][2]
+        return self._requests[handle]
 
     def heapify(self) -> None:
-        heapq.heapify(self.entries)
-        self._pop_empty()
+        """ Rebuild request order, dropping all tombstones """
+        live = self._live[:self._n_live]
+        priorities = self._priorities[live]
+        counts = self._counts[live]
+        order = np.lexsort((counts, -priorities))
+        self._order = live[order]
+        self._order_priorities = priorities[order]
+        self._order_counts = counts[order]
+        self._order_pos = 0
+        self._order_end = len(order)
+        self._heap = []
+        self._min_heap = []
+        self._changed()
+
+    def _changed(self) -> None:
+        if self.on_change is not None:
+            self.on_change()
+
+    def _top(self) -> Optional[int]:
+        """
+        Return a handle of the top priority request; tombstones
+        at the top are dropped.
+        """
+        order = self._order
+        while self._order_pos < self._order_end:
+            pos = self._order_pos
+            if self._is_valid(order[pos], self._order_priorities[pos],
+                              self._order_counts[pos]):
+                break
+            self._order_pos += 1
+        heap = self._heap
+        while heap and not self._is_valid(heap[0][2], -heap[0][0],
+                                          heap[0][1]):
+            heapq.heappop(heap)
+
+        if self._order_pos < self._order_end:
+            pos = self._order_pos
+            if not heap or ((-self._order_priorities[pos],
+                             self._order_counts[pos]) < heap[0][:2]):
+                return int(order[pos])
+        if heap:
+            return heap[0][2]
+        return None
+
+    def _bottom(self) -> Optional[int]:
+        """
+        Return a handle of the request which would be popped last
+        (it requires ``maxsize`` to be set); tombstones at the bottom
+        are dropped.
+        """
+        order = self._order
+        while self._order_end > self._order_pos:
+            pos = self._order_end - 1
+            if self._is_valid(order[pos], self._order_priorities[pos],
+                              self._order_counts[pos]):
+                break
+            self._order_end -= 1
+        heap = self._min_heap
+        while heap and not self._is_valid(heap[0][2], heap[0][0],
+                                          -heap[0][1]):
+            heapq.heappop(heap)
+
+        if self._order_end > self._order_pos:
+            pos = self._order_end - 1
+            if not heap or ((self._order_priorities[pos],
+                             -self._order_counts[pos]) < heap[0][:2]):
+                return int(order[pos])
+        if heap:
+            return heap[0][2]
+        return None
+
+    def _is_valid(self, handle: int, priority: int, count: int) -> bool:
+        """ Check if an order entry is not a tombstone """
+        return (self._live_pos[handle] >= 0 and
+                self._counts[handle] == count and
+                self._priorities[handle] == priority)
 
-    def _pop_empty(self) -> None:
-        """ Pop all removed entries from heap top """
-        while self.entries and self.next_request is self.REMOVED:
-            heapq.heappop(self.entries)
+    def _n_entries(self) -> int:
+        return (self._order_end - self._order_pos +
+                max(len(self._heap), len(self._min_heap)))
+
+    def _maybe_compact(self) -> None:
+        n_entries = self._n_entries()
+        if n_entries - self._n_live > self.compact_ratio * n_entries:
+            self.heapify()
+
+    def _release(self, handle: int) -> Tuple[scrapy.Request, int]:
+        """
+        Free a request table slot; return the request and
+        its :class:`FrontierVectors` row id, which should be freed
+        by the caller. The link vector is put back to request meta.
+        """
+        request = self._requests[handle]
+        assert request is not None
+        request.priority = int(self._priorities[handle])
+        row = int(self._rows[handle])
+        if row >= 0:
+            assert self.vectors is not None
+            request.meta['link_vector'] = self.vectors.take([row])
+            self._rows[handle] = -1
+        self._requests[handle] = None
+        self._free.append(handle)
+        return request, row
+
+    def _remove_many(self, handles: np.ndarray) -> None:
+        """ Remove requests with ``handles``; the order is not updated """
+        rows = self._rows[handles]
+        rows = rows[rows >= 0]
+        self._rows[handles] = -1
+        for handle in handles.tolist():
+            self._requests[handle] = None
+        self._free.extend(handles.tolist())
+        self._live_pos[handles] = -1
+        live = self._live[:self._n_live]
+        live = live[self._live_pos[live] >= 0]
+        self._n_live = len(live)
+        self._live[:self._n_live] = live
+        self._live_pos[live] = np.arange(self._n_live)
+        if len(rows):
+            assert self.vectors is not None
+            self.vectors.free(rows)
 
     def iter_requests(self) -> Iterable[scrapy.Request]:
         """
-        Return all Request objects in a queue.
-        The first request is guaranteed to have top priority;
-        order of other requests is arbitrary.
+        Return all Request objects in a queue, in arbitrary order.
+        Requests with vectors in :class:`FrontierVectors`
+        don't have ``link_vector`` in meta.
         """
-        return (e[2] for e in self.iter_active_entries())
+        handles = self._live[:self._n_live]
+        priorities = self._priorities[handles].tolist()
+        for handle, priority in zip(handles.tolist(), priorities):
+            request = self._requests[handle]
+            request.priority = priority
+            yield request
+
+    def vector_rows(self) -> np.ndarray:
+        """
+        Return :class:`FrontierVectors` row ids of queued requests
+        (-1 for requests without a row), in :meth:`iter_requests` order.
+        """
+        return self._rows[self._live[:self._n_live]]
 
     def __len__(self) -> int:
-        return len(self.entries)
+        return self._n_live
 
     def nbytes(self) -> int:
         """
-        Memory taken by link vectors in requests stored in self.entries.
+        Memory taken by link vectors of queued requests.
         """
-        return sum(request_nbytes(request) for _, _, request in self.entries)
+        handles = self._live[:self._n_live]
+        nbytes = sum(request_nbytes(self._requests[handle])
+                     for handle in handles.tolist())
+        rows = self._rows[handles]
+        rows = rows[rows >= 0]
+        if len(rows):
+            assert self.vectors is not None
+            nbytes += self.vectors.arena.rows_nbytes(rows)
+        return nbytes
 
 
 class BalancedPriorityQueue:
@@ -237,12 +878,43 @@ class BalancedPriorityQueue:
     When ``batch_size`` is set to None (default), a heuristic algorithm
     is used to choose the batch size - the greater is a number of queues
     being balanced, the larger is a batch size.
+
+    Sampling weights of queues are kept in a :class:`deepdeep.sumtree.SumTree`
+    indexed by slot ids, so sampling a batch of ``n`` queues out of ``D``
+    is O(n log D). A queue notifies this queue when its top request
+    may change (see ``RequestsPriorityQueue.on_change``); weights of such
+    queues are updated before the next batch is sampled.
+
+    When ``spill`` (:class:`deepdeep.spill.SpillStore`) is passed, cold
+    queues are moved to disk: queues which are not chosen for
+    ``spill_idle_batches`` batches, or with sampling probability less than
+    ``spill_min_probability`` of a uniform one. A few queues are checked
+    after each batch (``spill_scan_size``). Only the top priority of
+    a spilled queue is kept in memory; the queue is read back when it is
+    chosen, or when :meth:`get_queue` is called. Requests pushed to
+    a spilled queue are kept in memory until it is read back or spilled
+    again. ``queues`` attribute contains only queues in memory, and
+    their priorities are not updated while they are on disk. The random
+    policy (``eps``) chooses among queues in memory, so that random
+    requests don't cause spilled queues to be read back.
+
+    ``n_evicted`` attribute is the number of requests dropped because
+    their queues were full (see ``RequestsPriorityQueue.maxsize``).
     """
+    # Weights are exp((priority - offset) / temperature); all weights
+    # are recomputed with a new offset when an exponent exceeds this value.
+    max_weight_exponent = 300.0
+
+    spill_idle_batches = 1000
+    spill_min_probability = 0.01
+    spill_scan_size = 100
+
     def __init__(self,
                  queue_factory: Callable[[str], RequestsPriorityQueue],
                  eps: float=0.0,
                  balancing_temperature: float=1.0,
                  batch_size: Optional[int]=None,
+                 spill: Any=None,
                  ) -> None:
         assert balancing_temperature > 0
         self.queues = {}  # type: Dict[str, RequestsPriorityQueue]
@@ -252,15 +924,80 @@ class BalancedPriorityQueue:
         self.balancing_temperature = balancing_temperature
         self._batch_size = batch_size
         self._buffer = []  # type: List[scrapy.Request]
+        # slot name -> slot id, and slot id -> queue (None for free ids)
+        self._slot_ids = {}  # type: Dict[str, int]
+        self._slot_queues = []  # type: List[Optional[RequestsPriorityQueue]]
+        self._free_ids = []  # type: List[int]
+        # ids of slots with queues in memory, for the random policy
+        self._resident_ids = []  # type: List[int]
+        self._resident_pos = {}  # type: Dict[int, int]
+        self._weights = SumTree()
+        self._weight_offset = None  # type: Optional[float]
+        self._weight_temperature = None  # type: Optional[float]
+        # ids of slots with outdated weights
+        self._dirty = set()  # type: Set[int]
+        self.n_evicted = 0
+        self.spill = spill
+        self._slot_names = []  # type: List[Optional[str]]
+        self._spilled = {}  # type: Dict[int, _SpilledQueue]
+        self._n_spilled = 0
+        # slot id -> number of the last batch the slot was chosen in
+        self._last_chosen = np.zeros(0, dtype=np.int64)
+        self._n_batches = 0
+        self._spill_cursor = 0
 
     def push(self, request: scrapy.Request) -> None:
         slot = request.meta.get('scheduler_slot')
         if slot in self.closed_slots:
             raise QueueClosed()
         if slot not in self.queues:
-            self.queues[slot] = self.queue_factory(slot)
+            self._add_queue(slot)
         self.queues[slot].push(request)
 
+    def _add_queue(self, slot: str) -> RequestsPriorityQueue:
+        """
+        Create a queue in memory for ``slot``; a spilled slot keeps its id
+        """
+        queue = self.queues[slot] = self.queue_factory(slot)
+        slot_id = self._slot_ids.get(slot)
+        if slot_id is None:
+            if self._free_ids:
+                slot_id = self._free_ids.pop()
+            else:
+                slot_id = len(self._slot_queues)
+                self._slot_queues.append(None)
+                self._slot_names.append(None)
+            self._slot_ids[slot] = slot_id
+            self._slot_names[slot_id] = slot
+        if slot_id >= len(self._last_chosen):
+            self._last_chosen = resized(
+                self._last_chosen, max(16, 2 * len(self._last_chosen)))
+        self._last_chosen[slot_id] = self._n_batches
+        self._set_slot_queue(slot_id, queue)
+        queue.on_change = functools.partial(self._dirty.add, slot_id)
+        queue.on_evict = self._on_evict
+        self._dirty.add(slot_id)
+        return queue
+
+    def _set_slot_queue(self, slot_id: int,
+                        queue: Optional[RequestsPriorityQueue]) -> None:
+        """ Set a queue in memory for ``slot_id`` (None if there is none) """
+        self._slot_queues[slot_id] = queue
+        pos = self._resident_pos.get(slot_id)
+        if queue is not None and pos is None:
+            self._resident_pos[slot_id] = len(self._resident_ids)
+            self._resident_ids.append(slot_id)
+        elif queue is None and pos is not None:
+            # swap with the last id to remove it in O(1)
+            last = self._resident_ids.pop()
+            if last != slot_id:
+                self._resident_ids[pos] = last
+                self._resident_pos[last] = pos
+            del self._resident_pos[slot_id]
+
+    def _on_evict(self, n: int) -> None:
+        self.n_evicted += n
+
     def pop(self) -> Optional[scrapy.Request]:
         if not self._buffer:
             self._buffer.extend(self._pop_many(self.batch_size))
@@ -277,18 +1014,21 @@ class BalancedPriorityQueue:
         # and hurts sampling quality. With a large number of domains it is
         # crucial for fast sampling, and negative effects are much less
         # profound.
-        return min(1000, max(1, len(self.queues) // 1000))
+        return min(1000, max(1, len(self._slot_ids) // 1000))
 
     @log_time
     def _pop_many(self, n: int) -> List[scrapy.Request]:
-        all_slots = list(self.queues.keys())
-        if not all_slots:
+        if not self._slot_ids:
             return []
 
-        weights = [q.max_priority() for q in self.queues.values()]
-        temperature = FLOAT_PRIORITY_MULTIPLIER * self.balancing_temperature
-        p = softmax(weights, t=temperature)
-        chosen_slots = np.random.choice(all_slots, size=n, replace=True, p=p)
+        self._update_weights()
+        self._n_batches += 1
+        chosen_queues = []  # type: List[Optional[RequestsPriorityQueue]]
+        if self._weights.total > 0:
+            chosen = self._weights.sample(n)
+            self._last_chosen[chosen] = self._n_batches
+            chosen_queues = [self._get_slot_queue(slot_id)
+                             for slot_id in chosen.tolist()]
 
         # It is not possible to get a required amount of requests
         # from some domain queues - high-priority domain can be chosen too many
@@ -301,8 +1041,7 @@ class BalancedPriorityQueue:
         # to the batch. The amount of random requests is chosen to make
         # average ratio of random requests equal to ``eps``.
 
-        queues = np.asarray([self.queues[slot] for slot in chosen_slots])
-        requests = [r for r in [q.pop() for q in queues] if r]
+        requests = [r for r in [q.pop() for q in chosen_queues if q] if r]
 
         # XXX: n_random is not 100% correct because there can be not enough
         # requests to pop from random queues as well. But it doesn't look
@@ -312,25 +1051,146 @@ class BalancedPriorityQueue:
             n=len(requests) * (1 + self.eps),
             p=self.eps
         )
-        random_queues = [
-            self.queues[slot]
-            for slot in np.random.choice(all_slots, size=n_random)
-        ]
-        for queue in random_queues:
+        positions = (np.random.randint(len(self._resident_ids), size=n_random)
+                     if self._resident_ids else np.zeros(0, dtype=int))
+        for pos in positions.tolist():
+            queue = self._slot_queues[self._resident_ids[pos]]
+            assert queue is not None
             request = queue.pop_random()
             if request is not None:
                 request.meta['from_random_policy'] = True
                 requests.append(request)
 
         random.shuffle(requests)
-        # print("======= Unique domains selected: %s" % len(set(chosen_slots)))
         # print("======= Random requests: %d/%d" % (n_random, len(requests)))
+        if self.spill is not None:
+            self._spill_cold_queues()
         return requests
 
+    def _get_slot_queue(self, slot_id: int
+                        ) -> Optional[RequestsPriorityQueue]:
+        """
+        Return a queue for ``slot_id``, reading it from disk if it is
+        spilled; return None for free ids.
+        """
+        if slot_id in self._spilled:
+            return self._unspill(slot_id)
+        return self._slot_queues[slot_id]
+
+    def _top_priority(self, slot_id: int) -> int:
+        queue = self._slot_queues[slot_id]
+        priority = (queue.max_priority() if queue is not None
+                    else RequestsPriorityQueue.EMPTY_PRIORITY)
+        spilled = self._spilled.get(slot_id)
+        if spilled is not None:
+            priority = max(priority, spilled.max_priority)
+        return priority
+
+    def _spill_cold_queues(self) -> None:
+        """ Check next ``spill_scan_size`` slots; spill cold queues """
+        n_ids = len(self._slot_queues)
+        n_scan = min(self.spill_scan_size, n_ids)
+        slot_ids = (self._spill_cursor + np.arange(n_scan)) % n_ids
+        self._spill_cursor = (self._spill_cursor + n_scan) % n_ids
+        idle = (self._n_batches - self._last_chosen[slot_ids] >
+                self.spill_idle_batches)
+        unlikely = (self._weights[slot_ids] * len(self._slot_ids) <
+                    self.spill_min_probability * self._weights.total)
+        for slot_id in slot_ids[idle | unlikely].tolist():
+            queue = self._slot_queues[slot_id]
+            if (queue is not None and len(queue) and
+                    all(map(self.spill.can_store, queue.iter_requests()))):
+                self._spill_queue(slot_id)
+
+    def _spill_queue(self, slot_id: int) -> None:
+        """ Move requests of a queue in memory to disk """
+        queue = self._slot_queues[slot_id]
+        slot = self._slot_names[slot_id]
+        assert queue is not None and slot is not None
+        max_priority = queue.max_priority()
+        queue.on_change = None
+        requests = queue.drain()
+        spilled = self._spilled.get(slot_id)
+        if spilled is None:
+            spilled = self._spilled[slot_id] = _SpilledQueue()
+        spilled.locations.append(self.spill.write(requests))
+        spilled.n_requests += len(requests)
+        spilled.max_priority = max(spilled.max_priority, max_priority)
+        self._n_spilled += len(requests)
+        del self.queues[slot]
+        self._set_slot_queue(slot_id, None)
+
+    def _unspill(self, slot_id: int) -> RequestsPriorityQueue:
+        """ Read requests of a spilled queue back to memory """
+        spilled = self._spilled.pop(slot_id)
+        queue = self._slot_queues[slot_id]
+        if queue is None:
+            slot = self._slot_names[slot_id]
+            assert slot is not None
+            queue = self._add_queue(slot)
+        for location in spilled.locations:
+            for request in self.spill.read(location):
+                queue.push(request)
+            self.spill.free(location)
+        self._n_spilled -= spilled.n_requests
+        return queue
+
+    @property
+    def n_spilled_slots(self) -> int:
+        """ Number of slots with requests on disk """
+        return len(self._spilled)
+
+    @property
+    def n_spilled_requests(self) -> int:
+        """ Number of requests on disk """
+        return self._n_spilled
+
+    def _update_weights(self) -> None:
+        """
+        Update sampling weights of queues with changed top requests;
+        softmax of top priorities is computed as
+        ``exp((priority - offset) / temperature)`` normalized by
+        the sum tree total.
+        """
+        temperature = FLOAT_PRIORITY_MULTIPLIER * self.balancing_temperature
+        if temperature != self._weight_temperature:
+            self._weight_temperature = temperature
+            self._weight_offset = None
+        if self._weight_offset is None:
+            slot_ids = np.array(sorted(self._slot_ids.values()),
+                                dtype=np.int64)
+        else:
+            slot_ids = np.array(sorted(self._dirty), dtype=np.int64)
+        self._dirty.clear()
+        if not len(slot_ids):
+            return
+        priorities = np.array([self._top_priority(slot_id)
+                               for slot_id in slot_ids.tolist()],
+                              dtype=np.float64)
+        non_empty = priorities > RequestsPriorityQueue.EMPTY_PRIORITY
+        if self._weight_offset is None:
+            self._weight_offset = (priorities[non_empty].max()
+                                   if non_empty.any() else 0.0)
+        exponents = (priorities - self._weight_offset) / temperature
+        if exponents.max() > self.max_weight_exponent:
+            # priorities are much higher than before
+            self._weight_offset = None
+            return self._update_weights()
+        self._weights.update(slot_ids, np.exp(exponents))
+        if self._weights.total == 0 and non_empty.any():
+            # priorities are much lower than before, weights underflow
+            self._weight_offset = None
+            return self._update_weights()
+
     def get_active_slots(self) -> List[str]:
+        """ Return slots of non-empty queues in memory """
         return [key for key, queue in self.queues.items() if len(queue)]
 
     def get_queue(self, slot: str) -> RequestsPriorityQueue:
+        """ Return a queue for ``slot``; a spilled queue is read back """
+        slot_id = self._slot_ids.get(slot)
+        if slot_id in self._spilled:
+            return self._unspill(slot_id)
         return self.queues[slot]
 
     def close_queue(self, slot: str) -> int:
@@ -341,8 +1201,27 @@ class BalancedPriorityQueue:
         Return a number of dropped requests.
         """
         self.closed_slots.add(slot)
-        queue = self.queues.pop(slot, None) or []
-        return len(queue)
+        slot_id = self._slot_ids.pop(slot, None)
+        if slot_id is None:
+            return 0
+        n_dropped = 0
+        spilled = self._spilled.pop(slot_id, None)
+        if spilled is not None:
+            for location in spilled.locations:
+                self.spill.free(location)
+            n_dropped += spilled.n_requests
+            self._n_spilled -= spilled.n_requests
+        queue = self.queues.pop(slot, None)
+        if queue is not None:
+            queue.on_change = None
+            n_dropped += len(queue)
+            queue.clear()
+        self._set_slot_queue(slot_id, None)
+        self._slot_names[slot_id] = None
+        self._free_ids.append(slot_id)
+        self._dirty.discard(slot_id)
+        self._weights.update([slot_id], 0.0)
+        return n_dropped
 
     def debug_dump(self, fp: TextIO) -> None:
         """ Dump debug information about this queue to a .csv file """
@@ -362,18 +1241,150 @@ class BalancedPriorityQueue:
                     'slot': slot,
                 })
 
+    @log_time
+    def save(self, path: str, chunk_size: int=1 << 16) -> int:
+        """
+        Save all queued requests (including spilled requests and
+        requests from the pop buffer), their priorities and link vectors,
+        and closed slots to a snapshot file at ``path``
+        (see :mod:`deepdeep.snapshot`); use :meth:`load` to restore them.
+        The snapshot is written to a temporary file ``chunk_size``
+        requests at a time; it replaces ``path`` when it is complete.
+
+        Requests with callbacks or errbacks are not saved;
+        return the number of saved requests.
+        """
+        def can_save(request):
+            return (getattr(request, 'callback', None) is None and
+                    getattr(request, 'errback', None) is None)
+
+        slots = list(self._slot_ids)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            writer = SnapshotWriter(f, slots, sorted(self.closed_slots),
+                                    chunk_size=chunk_size)
+            writer.add(-1, [r for r in self._buffer if can_save(r)])
+            for idx, slot in enumerate(slots):
+                slot_id = self._slot_ids[slot]
+                queue = self._slot_queues[slot_id]
+                if queue is not None and len(queue):
+                    requests = list(queue.iter_requests())
+                    keep = np.array(list(map(can_save, requests)))
+                    rows = queue.vector_rows()[keep]
+                    with_vectors = np.flatnonzero(rows >= 0)
+                    vectors = None
+                    if len(with_vectors):
+                        assert queue.vectors is not None
+                        vectors = queue.vectors.take(rows[with_vectors])
+                    writer.add(
+                        idx,
+                        [r for r, k in zip(requests, keep) if k],
+                        vectors=vectors,
+                        with_vectors=with_vectors)
+                spilled = self._spilled.get(slot_id)
+                if spilled is not None:
+                    for location in spilled.locations:
+                        writer.add(idx, [r for r in self.spill.read(location)
+                                         if can_save(r)])
+            writer.close()
+        os.replace(tmp_path, path)
+        return writer.n_requests
+
+    @log_time
+    def load(self, path: str) -> int:
+        """
+        Add requests from a snapshot saved by :meth:`save` to this queue,
+        and close slots which were closed; return the number of loaded
+        requests. Requests are loaded one chunk at a time, as
+        :class:`deepdeep.scheduler.CompactRequest` objects where possible;
+        link vectors of a chunk are added to
+        :class:`FrontierVectors` at once (see
+        :meth:`RequestsPriorityQueue.push_many`).
+        """
+        from deepdeep.scheduler import CompactRequest  # it imports queues
+
+        n_loaded = 0
+        with open(path, 'rb') as f:
+            header, chunks = read_snapshot(f)
+            slots = header['slots']
+            self.closed_slots.update(header['closed_slots'])
+            for chunk in chunks:
+                requests = [
+                    _restore_request(CompactRequest, url, priority, meta,
+                                     state)
+                    for url, priority, meta, state in zip(
+                        chunk.urls, chunk.priorities.tolist(), chunk.metas,
+                        chunk.states)]
+                bounds = np.flatnonzero(np.diff(chunk.slots)) + 1
+                starts = [0] + bounds.tolist()
+                stops = bounds.tolist() + [len(chunk)]
+                for start, stop in zip(starts, stops):
+                    lo, hi = np.searchsorted(chunk.with_vectors, [start, stop])
+                    n_loaded += self._load_requests(
+                        int(chunk.slots[start]),
+                        slots,
+                        requests[start:stop],
+                        chunk.vectors[lo:hi],
+                        chunk.with_vectors[lo:hi] - start)
+        return n_loaded
+
+    def _load_requests(self,
+                       slot_idx: int,
+                       slots: List[str],
+                       requests: List[Any],
+                       vectors: sparse.csr_matrix,
+                       with_vectors: np.ndarray) -> int:
+        """ Add requests of a slot from a snapshot chunk """
+        if slot_idx < 0:
+            for pos, idx in enumerate(with_vectors.tolist()):
+                requests[idx].meta['link_vector'] = vectors[pos]
+            self._buffer.extend(requests)
+            return len(requests)
+        slot = slots[slot_idx]
+        if slot in self.closed_slots:
+            return 0
+        for request in requests:
+            request.meta['scheduler_slot'] = slot
+        if slot in self._slot_ids:
+            queue = self.get_queue(slot)
+        else:
+            queue = self._add_queue(slot)
+        queue.push_many(requests, vectors, with_vectors)
+        return len(requests)
+
     def __len__(self) -> int:
-        return sum(len(q) for q in self.queues.values()) + len(self._buffer)
+        return (sum(len(q) for q in self.queues.values()) +
+                len(self._buffer) + self._n_spilled)
 
     def nbytes(self) -> int:
         """
         Memory taken by link vectors in requests stored in all queues
-        and self.buffer.
+        in memory and self.buffer.
         """
         return (sum(q.nbytes() for q in self.queues.values()) +
                 sum(map(request_nbytes, self._buffer)))
 
 
+class _SpilledQueue:
+    """ Locations of requests of a queue on disk, and their top priority """
+    __slots__ = ['locations', 'n_requests', 'max_priority']
+
+    def __init__(self) -> None:
+        self.locations = []  # type: List[Any]
+        self.n_requests = 0
+        self.max_priority = RequestsPriorityQueue.EMPTY_PRIORITY
+
+
+def _restore_request(compact_cls, url, priority, meta, state):
+    """ Build a request saved by :meth:`BalancedPriorityQueue.save` """
+    if state is None:
+        return compact_cls(url, priority, meta)
+    if 'referer' in state:
+        return compact_cls(url, priority, meta, state['referer'])
+    request = scrapy.Request(url, priority=priority, meta=meta, **state)
+    return compact_cls.from_request(request)
+
+
 def request_nbytes(request):
     if hasattr(request, 'meta'):
         return csr_nbytes(request.meta.get('link_vector'))
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental rescheduling
+========================
+
+When target :math:`Q(s, a)` function changes, priorities of queued
+requests become outdated. Rescoring the whole frontier at once blocks
+the reactor for a long time on large crawls, so crawl latency spikes
+after each model switch. :class:`IncrementalRescheduler` instead
+rescores domain queues in bounded time slices spread across reactor
+iterations; queues which are most likely to be sampled next
+(the ones with highest top request priority) are rescored first.
+"""
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from deepdeep.queues import BalancedPriorityQueue, RequestsPriorityQueue
+
+
+class IncrementalRescheduler:
+    """
+    Rescore requests of a :class:`deepdeep.queues.BalancedPriorityQueue`
+    incrementally.
+
+    Call :meth:`start` when the model changes: all non-empty domain
+    queues become stale, and a new rescoring pass starts (an unfinished
+    pass is restarted). Call :meth:`step` periodically from the reactor:
+    it rescores stale queues, in order of decreasing top request priority,
+    until ``time_slice`` seconds pass; at least one queue is rescored
+    per step.
+
+    ``rescore`` is a function which updates priorities of requests in
+    a domain queue and returns ``(old_scores, new_scores)`` arrays.
+    When a pass is finished, ``on_pass_done`` is called with lists of
+    old and new scores of all rescored queues.
+
+    Progress of the current pass and staleness (an approximate share
+    of queued requests which are scored with an older model) are written
+    to ``stats`` (a Scrapy StatsCollector) under ``rescheduling/`` prefix.
+    """
+    def __init__(self,
+                 queue: BalancedPriorityQueue,
+                 rescore: Callable[[RequestsPriorityQueue],
+                                   Tuple[np.ndarray, np.ndarray]],
+                 time_slice: float=0.02,
+                 on_pass_done: Optional[Callable[[List[np.ndarray],
+                                                  List[np.ndarray]],
+                                                 Any]]=None,
+                 stats: Any=None,
+                 clock: Callable[[], float]=time.time,
+                 ) -> None:
+        self.queue = queue
+        self.rescore = rescore
+        self.time_slice = time_slice
+        self.on_pass_done = on_pass_done
+        self.stats = stats
+        self.clock = clock
+
+        self.version = 0
+        self.n_passes = 0
+        self._pending = deque()  # type: deque
+        self._n_stale = 0
+        self._n_total = 0
+        self._n_rescored = 0
+        self._scores_old = []  # type: List[np.ndarray]
+        self._scores_new = []  # type: List[np.ndarray]
+
+    @property
+    def in_progress(self) -> bool:
+        return bool(self._pending)
+
+    def start(self) -> None:
+        """ Start a new rescoring pass: the model is changed """
+        self.version += 1
+        queues = self.queue.queues
+        slots = [slot for slot, queue in queues.items() if len(queue)]
+        slots.sort(key=lambda slot: queues[slot].max_priority(),
+                   reverse=True)
+        self._pending = deque(slots)
+        self._n_stale = self._n_total = sum(len(queues[slot])
+                                            for slot in slots)
+        self._n_rescored = 0
+        self._scores_old = []
+        self._scores_new = []
+        self._report()
+
+    def step(self) -> int:
+        """
+        Rescore stale queues for about ``time_slice`` seconds;
+        return the number of rescored requests.
+        """
+        if not self._pending:
+            return 0
+        deadline = self.clock() + self.time_slice
+        n_rescored = 0
+        while self._pending:
+            queue = self.queue.queues.get(self._pending.popleft())
+            if queue is None:
+                continue  # the queue is closed
+            n_requests = len(queue)
+            if n_requests:
+                old, new = self.rescore(queue)
+                self._scores_old.append(old)
+                self._scores_new.append(new)
+                n_rescored += n_requests
+            if self.clock() >= deadline:
+                break
+        self._n_stale = max(0, self._n_stale - n_rescored)
+        self._n_rescored += n_rescored
+        if not self._pending:
+            self._n_stale = 0
+            self.n_passes += 1
+            if self.on_pass_done is not None:
+                self.on_pass_done(self._scores_old, self._scores_new)
+            self._scores_old = []
+            self._scores_new = []
+        self._report()
+        return n_rescored
+
+    def progress(self) -> float:
+        """ Share of requests rescored in the current pass """
+        if not self._n_total:
+            return 1.0
+        return min(1.0, self._n_rescored / self._n_total)
+
+    def staleness(self) -> float:
+        """
+        Approximate share of queued requests scored with an older model
+        (queue sizes are taken at the start of the pass).
+        """
+        if not self._n_total:
+            return 0.0
+        return self._n_stale / self._n_total
+
+    def info(self) -> Dict[str, float]:
+        return {
+            'progress': self.progress(),
+            'staleness': self.staleness(),
+            'passes': self.n_passes,
+            'version': self.version,
+        }
+
+    def _report(self) -> None:
+        if self.stats is None:
+            return
+        for key, value in self.info().items():
+            self.stats.set_value('rescheduling/%s' % key, value)
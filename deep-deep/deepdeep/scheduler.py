@@ -1,21 +1,96 @@
 # -*- coding: utf-8 -*-
+from typing import Any, Dict, Optional, Union
+
+import scrapy  # type: ignore
 from scrapy.utils.misc import load_object  # type: ignore
 
 from deepdeep.queues import RequestsPriorityQueue, QueueClosed
 
 
+class CompactRequest:
+    """
+    A compact representation of a plain GET ``scrapy.Request``
+    which is waiting in a scheduler queue: only url, priority, meta
+    (it holds a link vector and a scheduler slot) and a Referer header
+    (RefererMiddleware sets it for all links extracted by a spider)
+    are kept. Requests don't need other headers, cookies, flags, etc.
+    while they are queued, and most of queued requests are never
+    downloaded, so storing them this way saves a lot of memory
+    on large crawls.
+
+    It has ``url``, ``priority`` and ``meta`` attributes like
+    ``scrapy.Request``, so queues can handle both.
+    """
+    __slots__ = ['url', 'priority', 'meta', 'referer']
+
+    def __init__(self,
+                 url: str,
+                 priority: int,
+                 meta: Dict[str, Any],
+                 referer: Optional[bytes]=None) -> None:
+        self.url = url
+        self.priority = priority
+        self.meta = meta
+        self.referer = referer
+
+    @classmethod
+    def from_request(cls, request: scrapy.Request
+                     ) -> Union['CompactRequest', scrapy.Request]:
+        """
+        Return a CompactRequest for ``request``, or ``request`` itself
+        if it can't be restored from url, priority, meta and Referer
+        (e.g. it has a callback, other headers or a body).
+        """
+        if type(request) is not scrapy.Request:
+            return request
+        referer = None
+        if request.headers:
+            referers = request.headers.getlist('Referer')
+            if len(request.headers) != 1 or len(referers) != 1:
+                return request
+            referer = referers[0]
+        if (request.method != 'GET' or
+                request.body or
+                request.cookies or
+                request.callback is not None or
+                request.errback is not None or
+                request.dont_filter or
+                request.flags or
+                request.encoding != 'utf-8' or
+                getattr(request, '_cb_kwargs', None)):
+            return request
+        return cls(request.url, request.priority, request.meta, referer)
+
+    def to_request(self) -> scrapy.Request:
+        """ Build a ``scrapy.Request`` """
+        headers = {'Referer': self.referer} if self.referer else None
+        return scrapy.Request(self.url, priority=self.priority,
+                              meta=self.meta, headers=headers)
+
+    def __repr__(self):
+        return '<CompactRequest %s>' % self.url
+
+
 class Scheduler:
     """
     This scheduler allows to customize request queue class:
     by default ``deepdeep.queues.RequestsPriorityQueue`` is used,
     but a spider can implement ``get_scheduler_queue()`` method
     which returns another queue class.
+
+    Plain GET requests are stored in the queue
+    as :class:`CompactRequest` objects; ``scrapy.Request`` is built again
+    when the request is dequeued.
+
+    Requests dropped by the queue because of its size limit
+    (``n_evicted`` queue attribute) are counted as dropped.
     """
     def __init__(self, dupefilter, stats):
         self.dupefilter = dupefilter
         self.stats = stats
         self.queue = None
         self.spider = None
+        self._n_evicted = 0
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -49,13 +124,24 @@ class Scheduler:
 
         try:
             self.stats.inc_value('custom-scheduler/enqueued/', spider=self.spider)
-            self.queue.push(request)
+            self.queue.push(CompactRequest.from_request(request))
         except QueueClosed:
             self.stats.inc_value('custom-scheduler/dropped/', spider=self.spider)
+        self._count_evicted()
         return True
 
+    def _count_evicted(self) -> None:
+        n_evicted = getattr(self.queue, 'n_evicted', 0)
+        if n_evicted > self._n_evicted:
+            self.stats.inc_value('custom-scheduler/dropped/',
+                                 n_evicted - self._n_evicted,
+                                 spider=self.spider)
+            self._n_evicted = n_evicted
+
     def next_request(self):
         request = self.queue.pop()
+        if isinstance(request, CompactRequest):
+            request = request.to_request()
         if request:
             self.stats.inc_value('custom-scheduler/dequeued/', spider=self.spider)
         return request
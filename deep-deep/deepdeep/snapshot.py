@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+Frontier Snapshots
+==================
+
+A frontier snapshot is a binary file with all queued requests of
+a :class:`deepdeep.queues.BalancedPriorityQueue`
+(see :meth:`deepdeep.queues.BalancedPriorityQueue.save`); it allows
+to resume a crawl from a checkpoint.
+
+A snapshot starts with a JSON header (format version, names of
+scheduler slots and closed slots), followed by chunks of at most
+``chunk_size`` requests. Each chunk is a fixed sequence of ``.npy``
+arrays written one after another:
+
+* slot indices of requests (-1 for requests from the pop buffer);
+  requests of a slot are contiguous;
+* request priorities;
+* URL lengths and UTF-8 encoded URLs;
+* pickled meta dicts (without link vectors and scheduler slots) and
+  other request attributes (see :func:`request_state`);
+* positions of requests with link vectors, and ``data``, ``indices``
+  and ``indptr`` arrays of a CSR matrix with their vectors.
+
+The file is written and read chunk by chunk, so neither the whole
+file nor all requests in a text form are kept in memory, and vectors
+of a chunk are loaded with a few array operations. The last chunk
+is followed by an end marker, so truncated files are detected.
+"""
+import json
+import pickle
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse  # type: ignore
+import scrapy  # type: ignore
+
+from deepdeep.interning import InternedRow
+
+
+MAGIC = b'DEEPDEEP-FRONTIER\n'
+VERSION = 1
+
+
+class SnapshotChunk:
+    """
+    Requests from a chunk of a snapshot: ``slots``, ``priorities``,
+    ``urls``, ``metas`` and ``states`` (see :func:`request_state`)
+    are given for each request; ``vectors`` is a CSR matrix with link
+    vectors of requests at ``with_vectors`` positions (sorted).
+    """
+    __slots__ = ['slots', 'priorities', 'urls', 'metas', 'states',
+                 'vectors', 'with_vectors']
+
+    def __init__(self,
+                 slots: np.ndarray,
+                 priorities: np.ndarray,
+                 urls: List[str],
+                 metas: List[Dict[str, Any]],
+                 states: List[Optional[Dict[str, Any]]],
+                 vectors: sparse.csr_matrix,
+                 with_vectors: np.ndarray) -> None:
+        self.slots = slots
+        self.priorities = priorities
+        self.urls = urls
+        self.metas = metas
+        self.states = states
+        self.vectors = vectors
+        self.with_vectors = with_vectors
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+
+class SnapshotWriter:
+    """
+    Write a frontier snapshot to a binary file ``fp``: call :meth:`add`
+    for requests of each slot, and :meth:`close` at the end.
+    ``slots`` are names of slots; requests are added with an index
+    of their slot in this list.
+    """
+    def __init__(self,
+                 fp: BinaryIO,
+                 slots: List[str],
+                 closed_slots: List[str],
+                 chunk_size: int=1 << 16) -> None:
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.n_requests = 0
+        fp.write(MAGIC)
+        _save_json(fp, {
+            'version': VERSION,
+            'slots': slots,
+            'closed_slots': closed_slots,
+        })
+        self._reset()
+
+    def add(self,
+            slot: int,
+            requests: List[Any],
+            vectors: Optional[sparse.csr_matrix]=None,
+            with_vectors: Optional[np.ndarray]=None) -> None:
+        """
+        Add ``requests`` of a slot with ``slot`` index (-1 for requests
+        from the pop buffer). ``vectors`` is a CSR matrix with link vectors
+        of requests at ``with_vectors`` positions in ``requests``;
+        link vectors of other requests are taken from their meta.
+        """
+        if with_vectors is None:
+            with_vectors = np.zeros(0, dtype=np.int64)
+        with_vectors = np.asarray(with_vectors, dtype=np.int64)
+        for start in range(0, len(requests), self.chunk_size):
+            stop = min(start + self.chunk_size, len(requests))
+            in_range = np.flatnonzero((with_vectors >= start) &
+                                      (with_vectors < stop))
+            self._add(slot, requests[start:stop],
+                      (vectors[in_range]
+                       if vectors is not None and len(in_range) else None),
+                      with_vectors[in_range] - start)
+
+    def _add(self,
+             slot: int,
+             requests: List[Any],
+             vectors: Optional[sparse.csr_matrix],
+             with_vectors: np.ndarray) -> None:
+        if len(self._slots) + len(requests) > self.chunk_size:
+            self._flush()
+        offset = len(self._slots)
+        if vectors is not None:
+            self._vectors.append(vectors)
+            self._with_vectors.append(with_vectors + offset)
+        for idx, request in enumerate(requests):
+            meta = dict(request.meta)
+            if slot >= 0:
+                meta.pop('scheduler_slot', None)
+            vector = meta.get('link_vector')
+            if vector is not None and _is_row(vector):
+                del meta['link_vector']
+                self._vectors.append(vector.tocsr()
+                                     if isinstance(vector, InternedRow)
+                                     else vector)
+                self._with_vectors.append(np.array([offset + idx]))
+            self._metas.append(meta)
+            self._states.append(request_state(request))
+            self._urls.append(request.url.encode('utf8'))
+            self._priorities.append(request.priority)
+            self._slots.append(slot)
+
+    def close(self) -> None:
+        """ Write remaining requests and the end marker """
+        self._flush()
+        np.save(self.fp, np.zeros(2, dtype=np.int64), allow_pickle=False)
+
+    def _reset(self) -> None:
+        self._slots = []  # type: List[int]
+        self._priorities = []  # type: List[int]
+        self._urls = []  # type: List[bytes]
+        self._metas = []  # type: List[Dict[str, Any]]
+        self._states = []  # type: List[Optional[Dict[str, Any]]]
+        self._vectors = []  # type: List[sparse.csr_matrix]
+        self._with_vectors = []  # type: List[np.ndarray]
+
+    def _flush(self) -> None:
+        n_requests = len(self._slots)
+        if not n_requests:
+            return
+        if self._vectors:
+            with_vectors = np.concatenate(self._with_vectors)
+            order = np.argsort(with_vectors, kind='mergesort')
+            vectors = sparse.vstack(self._vectors, format='csr')[order]
+            with_vectors = with_vectors[order]
+        else:
+            vectors = sparse.csr_matrix((0, 0))
+            with_vectors = np.zeros(0, dtype=np.int64)
+        arrays = [
+            np.array([n_requests, vectors.shape[1]], dtype=np.int64),
+            np.array(self._slots, dtype=np.int32),
+            np.array(self._priorities, dtype=np.int64),
+            np.fromiter(map(len, self._urls), dtype=np.int64,
+                        count=n_requests),
+            np.frombuffer(b''.join(self._urls), dtype=np.uint8),
+            np.frombuffer(pickle.dumps((self._metas, self._states),
+                                       protocol=pickle.HIGHEST_PROTOCOL),
+                          dtype=np.uint8),
+            with_vectors,
+            vectors.data,
+            vectors.indices,
+            vectors.indptr,
+        ]
+        for array in arrays:
+            np.save(self.fp, array, allow_pickle=False)
+        self.n_requests += n_requests
+        self._reset()
+
+
+def read_snapshot(fp: BinaryIO
+                  ) -> Tuple[Dict[str, Any], Iterator[SnapshotChunk]]:
+    """
+    Read a snapshot written by :class:`SnapshotWriter` from a binary
+    file ``fp``. Return the header (a dict with ``slots`` and
+    ``closed_slots``) and an iterator over chunks, which reads
+    them from ``fp`` one at a time. ValueError is raised
+    if ``fp`` is not a snapshot or if it is truncated.
+    """
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a frontier snapshot")
+    header = _load_json(fp)
+    if header['version'] != VERSION:
+        raise ValueError("Unsupported frontier snapshot version: %s" %
+                         header['version'])
+    return header, _iter_chunks(fp)
+
+
+def _iter_chunks(fp: BinaryIO) -> Iterator[SnapshotChunk]:
+    while True:
+        n_requests, n_features = _load(fp).tolist()
+        if not n_requests:
+            return
+        (slots, priorities, url_lengths, urls, metas, with_vectors,
+         data, indices, indptr) = [_load(fp) for _ in range(9)]
+        url_bytes = urls.tobytes()
+        url_ends = np.cumsum(url_lengths).tolist()
+        url_starts = [0] + url_ends[:-1]
+        metas, states = pickle.loads(metas.tobytes())
+        yield SnapshotChunk(
+            slots=slots,
+            priorities=priorities,
+            urls=[url_bytes[start:end].decode('utf8')
+                  for start, end in zip(url_starts, url_ends)],
+            metas=metas,
+            states=states,
+            vectors=sparse.csr_matrix(
+                (data, indices, indptr),
+                shape=(len(with_vectors), n_features)),
+            with_vectors=with_vectors,
+        )
+
+
+def request_state(request: Any) -> Optional[Dict[str, Any]]:
+    """
+    Return attributes of ``request`` other than url, priority and meta:
+    None or ``{'referer': referer}`` for
+    :class:`deepdeep.scheduler.CompactRequest`, and keyword arguments
+    of ``scrapy.Request`` for other requests. Callbacks and errbacks
+    are not saved.
+    """
+    if isinstance(request, scrapy.Request):
+        return {
+            'method': request.method,
+            'headers': dict(request.headers.items()),
+            'body': request.body,
+            'cookies': request.cookies,
+            'dont_filter': request.dont_filter,
+            'flags': request.flags,
+            'encoding': request.encoding,
+        }
+    referer = getattr(request, 'referer', None)
+    return None if referer is None else {'referer': referer}
+
+
+def _is_row(vector: Any) -> bool:
+    return ((sparse.issparse(vector) or isinstance(vector, InternedRow))
+            and vector.shape[0] == 1)
+
+
+def _load(fp: BinaryIO) -> np.ndarray:
+    try:
+        return np.load(fp, allow_pickle=False)
+    except (EOFError, ValueError):
+        raise ValueError("Frontier snapshot is truncated")
+
+
+def _save_json(fp: BinaryIO, value: Any) -> None:
+    data = json.dumps(value).encode('utf8')
+    np.save(fp, np.frombuffer(data, dtype=np.uint8), allow_pickle=False)
+
+
+def _load_json(fp: BinaryIO) -> Any:
+    return json.loads(_load(fp).tobytes().decode('utf8'))
@@ -4,17 +4,18 @@ from pathlib import Path
 from typing import Any, Dict, Tuple, Union, Optional, List, Iterator, Set
 import abc
 import time
-import gzip
 import logging
 from weakref import WeakKeyDictionary
 
 import psutil  # type: ignore
+from twisted.internet.task import LoopingCall
 import tqdm  # type: ignore
 import joblib  # type: ignore
 import numpy as np  # type: ignore
 import scipy.sparse as sp  # type: ignore
 import networkx as nx  # type: ignore
 import scrapy  # type: ignore
+from scrapy import signals
 from scrapy.http import TextResponse, Response  # type: ignore
 from scrapy.statscollectors import StatsCollector  # type: ignore
 from scrapy_cdr.utils import text_cdr_item  # type: ignore
@@ -23,14 +24,21 @@ import tensorboard_logger  # type: ignore
 from deepdeep.queues import (
     BalancedPriorityQueue,
     RequestsPriorityQueue,
+    FrontierVectors,
     score_to_priority,
     priority_to_score, FLOAT_PRIORITY_MULTIPLIER)
 from deepdeep.scheduler import Scheduler
 from deepdeep.spiders._base import BaseSpider
-from deepdeep.qlearning import QLearner
+from deepdeep.qlearning import QLearner, vstack_AS
+from deepdeep.async_qlearning import AsyncQLearner
+from deepdeep.arena import CSRArena
+from deepdeep.interning import RowInterner, InternedArena
+from deepdeep.rescheduling import IncrementalRescheduler
+from deepdeep.spill import SpillStore
 from deepdeep.utils import set_request_domain, get_domain, log_time, chunks
 from deepdeep.vectorizers import LinkVectorizer, PageVectorizer
 from deepdeep.goals import BaseGoal
+from deepdeep.training import TrainingController
 from deepdeep.metrics import ndcg_score
 
 
@@ -48,15 +56,25 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
 
     """
     _ARGS = {
-        'double', 'use_urls', 'use_full_urls', 'use_same_domain',
+        'double', 'lagged_double', 'use_urls', 'use_full_urls', 'use_same_domain',
         'use_link_text', 'use_page_urls', 'use_full_page_urls',
         'use_pages', 'page_vectorizer_path',
         'eps', 'balancing_temperature', 'gamma',
-        'clf_alpha', 'clf_penalty',
+        'clf_alpha', 'clf_penalty', 'clf_backend',
+        'ftrl_alpha', 'ftrl_beta', 'ftrl_l1', 'ftrl_l2',
         'replay_sample_size', 'replay_maxsize', 'replay_maxlinks',
+        'replay_path', 'replay_maxbytes', 'replay_eviction',
+        'replay_stratified',
+        'replay_prioritized', 'replay_alpha', 'replay_beta',
         'domain_queue_maxsize', 'steps_before_switch',
+        'reschedule_time_slice', 'reschedule_interval',
+        'reschedule_selective', 'reschedule_full_interval',
+        'reschedule_delta_tol', 'spill_path', 'spill_idle_batches',
         'checkpoint_path', 'checkpoint_interval', 'checkpoint_latest',
-        'baseline', 'export_cdr',
+        'frontier_path', 'baseline', 'export_cdr', 'async_learner',
+        'fit_interval', 'train_budget', 'factored_as',
+        'warm_start_path', 'warm_start_memory', 'checkpoint_replay',
+        'intern_links',
     }
     ALLOWED_ARGUMENTS = _ARGS | BaseSpider.ALLOWED_ARGUMENTS
     custom_settings = {
@@ -85,16 +103,34 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
     # whether to use page content as a feature
     use_pages = 0
 
+    # Store page feature vector once per page instead of appending it
+    # to each link vector; it saves a lot of memory with use_pages=1.
+    factored_as = 0
+
+    # Link classifier: 'sgd' (SGDRegressor) or 'ftrl' (FTRL-Proximal)
+    clf_backend = 'sgd'
+
     # Link classifier hyper-parameters
     clf_penalty = 'l2'
     clf_alpha = 1e-6
 
+    # FTRL-Proximal hyper-parameters, used with clf_backend='ftrl'
+    ftrl_alpha = 0.1
+    ftrl_beta = 1.0
+    ftrl_l1 = 1.0
+    ftrl_l2 = 1.0
+
     # path to a saved page vectorizer model
     page_vectorizer_path = None  # type: str
 
     # use Double Learning
     double = 1
 
+    # choose next actions for Double Learning only when target Q function
+    # changes; it allows to cache Q values of next states in replay memory,
+    # which makes learning a lot faster.
+    lagged_double = 0
+
     # probability of selecting a random request
     eps = 0.2
 
@@ -112,6 +148,14 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
     # how many examples to fetch from experience replay on each iteration
     replay_sample_size = 300
 
+    # Online Q function is updated every `fit_interval` steps.
+    fit_interval = 1
+
+    # When non-zero, `fit_interval` is ignored, and the number of
+    # experience replay minibatches is adjusted so that training takes
+    # about `train_budget` share of wall time (e.g. 0.2 means 20%).
+    train_budget = 0.0
+
     # Max size of experience replay memory.
     # When all features are enabled (use_pages, use_full_urls)
     # a single observation uses about 1MB memory on average, so
@@ -125,8 +169,72 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
     # for each domain. No limit by default.
     replay_maxlinks = 0
 
+    # Directory for memory-mapped experience replay storage: observations
+    # are kept in files there, and only offsets and rewards are kept
+    # in RAM. This allows replay_maxsize much larger than RAM permits.
+    # By default experience replay memory is kept in RAM.
+    replay_path = None  # type: Optional[str]
+
+    # Max memory taken by experience replay examples, in bytes
+    # (e.g. 4e9 for 4GB). Unlike replay_maxsize, it doesn't depend on
+    # observation size. No limit by default.
+    replay_maxbytes = 0
+
+    # Which example to evict when experience replay memory is full:
+    # "random", "oldest" or "lowest_priority" (requires replay_prioritized).
+    replay_eviction = 'random'
+
+    # Sample experience replay minibatches balanced across domains
+    # and rewarded/non-rewarded pages, so that a few link-heavy domains
+    # don't dominate them. Can't be used with replay_prioritized.
+    replay_stratified = 0
+
+    # Store each distinct link feature vector once, and keep only
+    # references to it in requests and experience replay memory.
+    # It saves memory when the same links (e.g. navigation) are present
+    # on many pages. With factored_as=1 only replay memory rows are interned.
+    intern_links = 0
+
+    # Use Prioritized Experience Replay: sample observations with large
+    # TD errors more often. replay_alpha controls how much prioritization
+    # is used, replay_beta - how much it is compensated by importance
+    # sampling weights.
+    replay_prioritized = 0
+    replay_alpha = 0.6
+    replay_beta = 0.4
+
+    # Max number of requests in a domain queue: when a link is added
+    # to a full queue, the link with the lowest priority is dropped.
     domain_queue_maxsize = 0  # no limit by default
 
+    # By default all queued requests are rescored at once after a model
+    # switch (blocking the crawl), and it is done less often for large
+    # queues. With reschedule_time_slice > 0 they are rescored
+    # incrementally instead: every reschedule_interval seconds domain
+    # queues are rescored for about reschedule_time_slice seconds
+    # (e.g. 0.02), most promising domains first.
+    reschedule_time_slice = 0.0
+    reschedule_interval = 0.1
+    rescheduler = None  # type: Optional[IncrementalRescheduler]
+
+    # With reschedule_selective=1 only requests whose links have features
+    # with changed weights are rescored after a model switch (it requires
+    # a frontier of link vectors, i.e. factored_as=0). Weight changes
+    # smaller than reschedule_delta_tol are postponed until they accumulate.
+    # All requests are rescored from scratch every reschedule_full_interval
+    # switches, to bound accumulated errors.
+    reschedule_selective = 0
+    reschedule_full_interval = 10
+    reschedule_delta_tol = 1e-4
+
+    # Domain queues which are rarely sampled are moved to segment files
+    # in spill_path directory (it is disabled by default): queues
+    # which are not sampled for spill_idle_batches batches, or which have
+    # a low sampling probability.
+    spill_path = None  # type: Optional[str]
+    spill_idle_batches = 1000
+    spill_store = None  # type: Optional[SpillStore]
+
     # current model is saved every checkpoint_interval timesteps
     checkpoint_interval = 1000
 
@@ -136,9 +244,37 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
     # Store only latest checkpoint to save disk space.
     checkpoint_latest = 0
 
+    # Save experience replay memory to "replay" folder in checkpoint_path
+    # on each checkpoint (only new observations are written). When a spider
+    # is started with the same checkpoint_path, it resumes training:
+    # Q function is restored from the policy checkpoint saved along with
+    # the replay, and then the replay is loaded.
+    checkpoint_replay = 0
+
+    # Path to a frontier-*.bin snapshot saved on a checkpoint: queued
+    # requests are loaded from it, to resume a crawl. Use JOBDIR setting
+    # to keep the dupefilter state as well.
+    frontier_path = None  # type: Optional[str]
+
     # use baseline algorithm (BFS) instead of Q-Learning
     baseline = False
 
+    # how often to check if training should catch up, in seconds
+    training_tick_interval = 1.0
+
+    # Train Q function in a separate process; spider process only scores
+    # links using the latest target Q function.
+    async_learner = 0
+
+    # Path to a Q-*.joblib file saved by dump_policy: Q function weights
+    # are loaded from it instead of starting from scratch. Vectorizer
+    # options must be the same as in the saved policy.
+    warm_start_path = None  # type: Optional[str]
+
+    # Also restore experience replay memory from warm_start_path
+    # (if it was saved with the policy).
+    warm_start_memory = 0
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
@@ -152,27 +288,77 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
         self.use_link_text = bool(int(self.use_link_text))
         self.use_page_urls = bool(int(self.use_page_urls))
         self.use_full_page_urls = bool(int(self.use_full_page_urls))
+        self.factored_as = bool(int(self.factored_as))
         self.double = int(self.double)
+        self.lagged_double = int(self.lagged_double)
         self.steps_before_switch = int(self.steps_before_switch)
         self.replay_sample_size = int(self.replay_sample_size)
+        self.fit_interval = int(self.fit_interval)
+        self.train_budget = float(self.train_budget)
         self.replay_maxsize = int(self.replay_maxsize)
         self.replay_maxlinks = int(self.replay_maxlinks)
+        self.replay_maxbytes = int(float(self.replay_maxbytes))
+        self.replay_eviction = str(self.replay_eviction)
+        self.replay_stratified = bool(int(self.replay_stratified))
+        self.intern_links = bool(int(self.intern_links))
+        self.link_interner = (RowInterner() if self.intern_links
+                              else None)  # type: Optional[RowInterner]
+        self.replay_prioritized = bool(int(self.replay_prioritized))
+        self.replay_alpha = float(self.replay_alpha)
+        self.replay_beta = float(self.replay_beta)
         self.clf_penalty = str(self.clf_penalty)
         self.clf_alpha = float(self.clf_alpha)
+        self.clf_backend = str(self.clf_backend)
+        self.ftrl_alpha = float(self.ftrl_alpha)
+        self.ftrl_beta = float(self.ftrl_beta)
+        self.ftrl_l1 = float(self.ftrl_l1)
+        self.ftrl_l2 = float(self.ftrl_l2)
         self.domain_queue_maxsize = int(self.domain_queue_maxsize)
+        self.reschedule_time_slice = float(self.reschedule_time_slice)
+        self.reschedule_interval = float(self.reschedule_interval)
+        self.reschedule_selective = bool(int(self.reschedule_selective))
+        self.reschedule_full_interval = int(self.reschedule_full_interval)
+        self.reschedule_delta_tol = float(self.reschedule_delta_tol)
+        self.spill_idle_batches = int(self.spill_idle_batches)
+        self._switches_since_full_rescore = 0
         self.baseline = bool(int(self.baseline))
-        self.Q = QLearner(
+        self.async_learner = bool(int(self.async_learner))
+        use_async = self.async_learner and not self.baseline
+        self.training = None  # type: Optional[TrainingController]
+        if self.train_budget and not use_async and not self.baseline:
+            self.training = TrainingController(
+                fit=self._fit_batch,
+                budget=self.train_budget,
+            )
+        qlearner_cls = AsyncQLearner if use_async else QLearner
+        self.Q = qlearner_cls(
             steps_before_switch=self.steps_before_switch,
             replay_sample_size=self.replay_sample_size,
+            fit_interval=0 if self.training else self.fit_interval,
             gamma=self.gamma,
             double_learning=bool(self.double),
+            lagged_double_learning=bool(self.lagged_double),
             on_model_changed=self.on_model_changed,
             pickle_memory=False,
             dummy=self.baseline,
             er_maxsize=self.replay_maxsize,
             er_maxlinks=self.replay_maxlinks,
+            er_path=self.replay_path or None,
+            er_maxbytes=self.replay_maxbytes or None,
+            er_eviction=self.replay_eviction,
+            er_stratified=self.replay_stratified,
+            er_interner=self.link_interner,
+            prioritized_replay=self.replay_prioritized,
+            replay_alpha=self.replay_alpha,
+            replay_beta=self.replay_beta,
             clf_alpha=self.clf_alpha,
             clf_penalty=self.clf_penalty,
+            clf_backend=self.clf_backend,
+            ftrl_alpha=self.ftrl_alpha,
+            ftrl_beta=self.ftrl_beta,
+            ftrl_l1=self.ftrl_l1,
+            ftrl_l2=self.ftrl_l2,
+            factored=self.factored_as,
         )
         self.link_vectorizer = LinkVectorizer(
             use_url=bool(self.use_urls),
@@ -190,6 +376,15 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
             self.use_pages = int(self.use_pages)
             self.page_vectorizer = PageVectorizer() if self.use_pages else None
 
+        self.warm_start_memory = bool(int(self.warm_start_memory))
+        if self.warm_start_path and not self.baseline:
+            self.warm_start(self.warm_start_path, self.warm_start_memory)
+
+        self.checkpoint_replay = bool(int(self.checkpoint_replay))
+        if (self.checkpoint_replay and self.checkpoint_path and
+                not self.baseline):
+            self.resume_replay()
+
         self.total_reward = 0
         self.rewards = []  # type: List[float]
         self.steps_before_reschedule = 0
@@ -204,6 +399,41 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
         self._save_params_json()
         self._setup_tensorboard_logger()
 
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider._start_rescheduling_task,
+                                signals.spider_opened)
+        if spider.training is not None:
+            spider.training.stats = crawler.stats
+            crawler.signals.connect(spider._start_training_task,
+                                    signals.spider_opened)
+        return spider
+
+    def _start_rescheduling_task(self):
+        if self.rescheduler is None:
+            return
+        self._rescheduling_task = LoopingCall(self.rescheduler.step)
+        self._rescheduling_task.start(self.reschedule_interval, now=False)
+
+    def _start_training_task(self):
+        self._training_task = LoopingCall(self._training_tick)
+        self._training_task.start(self.training_tick_interval, now=False)
+
+    def _training_tick(self):
+        info = self.training.tick()
+        for key, value in info.items():
+            self.log_value('Learning/%s' % key, value)
+
+    def _fit_batch(self) -> bool:
+        """ Train online Q function on a single replay minibatch """
+        # the training controller is used only with a synchronous learner
+        assert isinstance(self.Q, QLearner)
+        if not len(self.Q.memory):
+            return False
+        self.Q.fit_iteration(self.Q.replay_sample_size)
+        return True
+
     def _save_params_json(self):
         if self.checkpoint_path:
             params = json.dumps(self.get_params(), indent=4)
@@ -249,7 +479,11 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
         if not self.is_seed(response):
             self.steps_before_reschedule -= 1
         self._debug_expected_vs_got(response)
+        start = time.time()
         output, reward = self._parse(response)
+        if self.training is not None:
+            self.training.record_busy(time.time() - start)
+            self.training.step()
         self.log_stats()
 
         if not self.is_seed(response):
@@ -289,13 +523,15 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
             return [], 0
 
         as_t = response.meta.get('link_vector')
+        domain = get_domain(response.url)
 
         if not hasattr(response, 'text'):
             # learn to avoid non-html responses
             self.Q.add_experience(
                 as_t=as_t,
                 AS_t1=None,
-                r_t1=0
+                r_t1=0,
+                domain=domain,
             )
             self.update_node(response, {'reward': 0})
             return [], 0
@@ -316,9 +552,9 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
             self.Q.add_experience(
                 as_t=as_t,
                 AS_t1=links_matrix,
-                r_t1=reward
+                r_t1=reward,
+                domain=domain,
             )
-        domain = get_domain(response.url)
         self.crawled_domains.add(domain)
         if reward > 0.5:
             self.relevant_domains.add(domain)
@@ -346,8 +582,11 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
         indices, links_to_follow = zip(*indices_and_links)
         AS = links_matrix[list(indices)]
         scores = self.Q.predict(AS)
+        vectors = AS
+        if self.link_interner is not None and sp.issparse(AS):
+            vectors = self.link_interner.intern_rows(AS)
 
-        for link, v, score in zip(links_to_follow, AS, scores):
+        for link, v, score in zip(links_to_follow, vectors, scores):
             url = link['url']
             next_domain = get_domain(url)
             meta = {
@@ -368,25 +607,73 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
         response._cached_page_vector = vec
         return vec
 
+    def closed(self, reason):
+        if isinstance(self.Q, AsyncQLearner):
+            self.Q.close()
+        for name in ['_training_task', '_rescheduling_task']:
+            task = getattr(self, name, None)
+            if task is not None and task.running:
+                task.stop()
+        if self.spill_store is not None:
+            self.spill_store.close()
+
     def get_scheduler_queue(self):
         """
         This method is called by deepdeep.scheduler.Scheduler
         to create a new queue.
+
+        Link vectors of queued requests are kept in a single arena
+        shared by all domain queues (:attr:`frontier_vectors`), unless
+        factored_as is used.
         """
+        self.frontier_vectors = None  # type: Optional[FrontierVectors]
+        if not self.factored_as:
+            arena = (InternedArena(self.link_interner)
+                     if self.link_interner is not None else CSRArena())
+            self.frontier_vectors = FrontierVectors(arena)
+
         def new_queue(domain):
             return RequestsPriorityQueue(fifo=True,
-                                         maxsize=self.domain_queue_maxsize)
-        return BalancedPriorityQueue(
+                                         maxsize=self.domain_queue_maxsize,
+                                         vectors=self.frontier_vectors)
+        self.spill_store = (SpillStore(self.spill_path) if self.spill_path
+                            else None)
+        queue = BalancedPriorityQueue(
             queue_factory=new_queue,
             eps=self.eps,
             balancing_temperature=self.balancing_temperature,
+            spill=self.spill_store,
         )
+        queue.spill_idle_batches = self.spill_idle_batches
+        if self.frontier_path:
+            n_loaded = queue.load(self.frontier_path)
+            self.logger.info("Loaded %d requests from frontier snapshot %s",
+                             n_loaded, self.frontier_path)
+        self.rescheduler = None
+        if self.reschedule_time_slice > 0 and not self.baseline:
+            crawler = getattr(self, 'crawler', None)
+            self.rescheduler = IncrementalRescheduler(
+                queue,
+                rescore=self._rescore_queue,
+                time_slice=self.reschedule_time_slice,
+                on_pass_done=self._log_rescoring_metrics,
+                stats=crawler.stats if crawler else None,
+            )
+        return queue
 
     @property
     def scheduler(self) -> Scheduler:
         return self.crawler.engine.slot.scheduler
 
     def on_model_changed(self):
+        if self._can_rescore_selectively():
+            # only a few requests are usually rescored, so it is done at once
+            self.recalculate_request_priorities()
+            return
+        if self.rescheduler is not None:
+            # requests are rescored by the rescheduling task
+            self.rescheduler.start()
+            return
         # TODO: this should pause engine first, in order
         # for download timeouts to work correctly
         if self.steps_before_reschedule <= 0:
@@ -402,43 +689,139 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
 
     @log_time
     def recalculate_request_priorities(self) -> int:
+        """
+        Rescore all queued requests at once; return the number
+        of rescored requests.
+        """
         if self.baseline:
             return 0
+        if self._can_rescore_selectively():
+            return self._rescore_selectively()
 
         scores_new = []
         scores_old = []
+        row_scores = None
+        if self.frontier_vectors is not None:
+            # score all queued link vectors at once
+            row_scores = self.frontier_vectors.score(self.Q.predict)
+        for slot in tqdm.tqdm(self.scheduler.queue.get_active_slots()):
+            queue = self.scheduler.queue.get_queue(slot)
+            old, new = self._rescore_queue(queue, row_scores)
+            scores_old.append(old)
+            scores_new.append(new)
+        return self._log_rescoring_metrics(scores_old, scores_new)
 
-        def request_priorities(requests: List[scrapy.Request]) -> List[int]:
-            priorities = np.ndarray(len(requests), dtype=int)
-            old_priorities = np.zeros_like(priorities)
-            vectors, indices = [], []
-            for idx, request in enumerate(requests):
-                old_priorities[idx] = request.priority
-                if self.is_seed(request):
-                    priorities[idx] = request.priority
-                    continue
-                vectors.append(request.meta['link_vector'])
-                indices.append(idx)
-            if vectors:
-                scores = np.concatenate([self.Q.predict(sp.vstack(batch))
-                                         for batch in chunks(vectors, 4096)])
-                priorities[indices] = scores * FLOAT_PRIORITY_MULTIPLIER
-
-            # keep scores in order to compute metrics later
-            scores_new.append(priorities / FLOAT_PRIORITY_MULTIPLIER)
-            scores_old.append(old_priorities / FLOAT_PRIORITY_MULTIPLIER)
-
-            # convert priorities to Python ints because scrapy.Request
-            # doesn't support numpy int types
-            priorities = [p.item() for p in priorities]
-
-            # TODO: use _log_promising_link or remove it
-            return priorities
+    def _can_rescore_selectively(self) -> bool:
+        return bool(self.reschedule_selective and
+                    self.frontier_vectors is not None and
+                    self.Q.target_scorer() is not None)
 
-        for slot in tqdm.tqdm(self.scheduler.queue.get_active_slots()):
+    def _rescore_selectively(self) -> int:
+        """
+        Rescore queued requests with links affected by the target model
+        change (see :meth:`deepdeep.queues.FrontierVectors.update_scores`);
+        return the number of rescored requests. Each
+        ``reschedule_full_interval`` switches all requests are rescored
+        from scratch, and the error of selective scores is logged.
+        """
+        vectors = self.frontier_vectors
+        assert vectors is not None
+        vectors.delta_tol = self.reschedule_delta_tol
+        scorer = self.Q.target_scorer()
+        row_scores, rows = vectors.update_scores(scorer)
+        self._switches_since_full_rescore += 1
+        if self._switches_since_full_rescore >= self.reschedule_full_interval:
+            self._switches_since_full_rescore = 0
+            exact_scores, rows = vectors.reset_scores(scorer)
+            self._log_selective_rescoring_error(row_scores[rows],
+                                                exact_scores[rows])
+            row_scores = exact_scores
+
+        priorities = {}  # type: Dict[RequestsPriorityQueue, Tuple[np.ndarray, np.ndarray]]
+        for queue, handles, queue_rows in vectors.rows_by_queue(rows):
+            priorities[queue] = queue.update_scores(handles,
+                                                    row_scores[queue_rows])
+        scores_old, scores_new = [], []
+        for slot in self.scheduler.queue.get_active_slots():
             queue = self.scheduler.queue.get_queue(slot)
-            queue.update_all_priorities(request_priorities)
+            old, new = priorities.get(queue) or (queue.priorities(),) * 2
+            scores_old.append(old / FLOAT_PRIORITY_MULTIPLIER)
+            scores_new.append(new / FLOAT_PRIORITY_MULTIPLIER)
+        n_requests = self._log_rescoring_metrics(scores_old, scores_new)
+        logging.info("Selective rescoring: {:,} of {:,} requests rescored"
+                     .format(len(rows), n_requests))
+        return len(rows)
+
+    def _log_selective_rescoring_error(self,
+                                       scores: np.ndarray,
+                                       exact_scores: np.ndarray) -> None:
+        """ Log how selective row scores differ from exact scores """
+        if not len(scores):
+            return
+        diff = scores - exact_scores
+        rmse = np.sqrt((diff ** 2).mean())
+        logging.info(
+            "Selective rescoring error: RMSE={:0.6f}, max={:0.6f}, "
+            "top-100 NDCG={:0.4f}".format(
+                rmse, np.abs(diff).max(),
+                ndcg_score(exact_scores, scores, k=100)))
+        self.log_value('Rescheduling/selective_rmse', rmse)
+
+    def _rescore_queue(self,
+                       queue: RequestsPriorityQueue,
+                       row_scores: Optional[np.ndarray]=None,
+                       ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Update priorities of requests in a domain queue; return arrays
+        of old and new request scores. ``row_scores`` are scores of all
+        :attr:`frontier_vectors` rows; when they are not passed,
+        only vectors of this queue are scored.
+        """
+        if self.frontier_vectors is not None:
+            if row_scores is not None:
+                score_rows = row_scores.__getitem__
+            else:
+                def score_rows(rows):
+                    return self.Q.predict(self.frontier_vectors.take(rows))
+            old, new = queue.rescore(score_rows)
+        else:
+            priorities = []  # type: List[np.ndarray]
+
+            def request_priorities(requests):
+                priorities.extend(self._request_priorities(requests))
+                return priorities[-1]
 
+            queue.update_all_priorities(request_priorities)
+            old, new = priorities
+        return old / FLOAT_PRIORITY_MULTIPLIER, new / FLOAT_PRIORITY_MULTIPLIER
+
+    def _request_priorities(self, requests: List[scrapy.Request]
+                            ) -> Tuple[np.ndarray, np.ndarray]:
+        """ Return old and new priorities of requests """
+        priorities = np.ndarray(len(requests), dtype=int)
+        old_priorities = np.zeros_like(priorities)
+        vectors, indices = [], []
+        for idx, request in enumerate(requests):
+            old_priorities[idx] = request.priority
+            if self.is_seed(request):
+                priorities[idx] = request.priority
+                continue
+            vectors.append(request.meta['link_vector'])
+            indices.append(idx)
+        if vectors:
+            scores = np.concatenate([self.Q.predict(vstack_AS(batch))
+                                     for batch in chunks(vectors, 4096)])
+            priorities[indices] = scores * FLOAT_PRIORITY_MULTIPLIER
+        # TODO: use _log_promising_link or remove it
+        return old_priorities, priorities
+
+    def _log_rescoring_metrics(self,
+                               scores_old: List[np.ndarray],
+                               scores_new: List[np.ndarray]) -> int:
+        """
+        Log how much request scores are changed by rescoring;
+        return the number of rescored requests.
+        """
         # Compute & print metrics.
         # The idea is to check how stable are results:
         #
@@ -530,6 +913,17 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
         self.log_value('Reward/run-average', run_average_reward)
         self.log_value('Coef/norm_online', coef_norm_online)
         self.log_value('Coef/norm_target', coef_norm_target)
+        self.log_value('Replay/size', len(self.Q.memory))
+        self.log_value('Replay/bytes', self.Q.memory.nbytes())
+        if self.rescheduler is not None:
+            self.log_value('Rescheduling/progress',
+                           self.rescheduler.progress())
+            self.log_value('Rescheduling/staleness',
+                           self.rescheduler.staleness())
+        if self.link_interner is not None:
+            stats = self.link_interner.stats()
+            for key in ['rows', 'hit_rate', 'nbytes', 'saved_nbytes']:
+                self.log_value('Interning/%s' % key, stats[key])
 
         stats = self.get_stats_item()
         logging.debug(
@@ -545,6 +939,11 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
         self.log_value('Queue/todo', stats['todo'])
         self.log_value('Queue/processed', stats['processed'])
         self.log_value('Queue/dropped', stats['dropped'])
+        if self.spill_store is not None:
+            queue = self.scheduler.queue
+            self.log_value('Queue/spilled_domains', queue.n_spilled_slots)
+            self.log_value('Queue/spilled_requests', queue.n_spilled_requests)
+            self.log_value('Queue/spilled_bytes', self.spill_store.nbytes())
 
     def get_stats_item(self):
         domains_open, domains_closed = self._domain_stats()
@@ -589,6 +988,61 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
         domains_closed = len(self.scheduler.queue.closed_slots)
         return domains_open, domains_closed
 
+    # spider arguments which define features of the Q function
+    _FEATURE_ARGS = [
+        'use_urls', 'use_full_urls', 'use_same_domain', 'use_link_text',
+        'use_page_urls', 'use_full_page_urls', 'use_pages',
+        'page_vectorizer_path',
+    ]
+
+    def warm_start(self, path: str, memory: bool=False) -> None:
+        """
+        Initialize Q function with weights of a policy saved by
+        :meth:`dump_policy` to ``path``; if ``memory`` is True,
+        experience replay memory is also restored.
+        ValueError is raised if the policy uses different features.
+        """
+        data = joblib.load(path)
+        self._check_warm_start_compatible(data)
+        Q = data['Q']
+        if memory and not len(Q.memory):
+            self.logger.warning(
+                "Policy %s is saved without experience replay memory", path)
+        self.Q.warm_start(Q, memory=memory)
+        self.logger.info(
+            "Warm start from %s: %d observations, %d in replay memory",
+            path, Q.t_, len(self.Q.memory))
+
+    def _check_warm_start_compatible(self, data: Dict) -> None:
+        params = data.get('_params', {})
+        errors = []
+        for key in self._FEATURE_ARGS:
+            if key in params and params[key] != getattr(self, key):
+                errors.append("%s=%r (current: %r)" % (
+                    key, params[key], getattr(self, key)))
+        link = {'url': 'http://example.com/', 'inside_text': 'example',
+                'domain_from': 'example.com', 'domain_to': 'example.com',
+                'page_url': 'http://example.com/'}
+        saved = _n_features(data['link_vectorizer'], link)
+        current = _n_features(self.link_vectorizer, link)
+        if saved != current:
+            errors.append("link vectorizer n_features=%d (current: %d)" % (
+                saved, current))
+        if (data['page_vectorizer'] is None) != (self.page_vectorizer is None):
+            errors.append("page vectorizer is %s" % (
+                "not used" if data['page_vectorizer'] is None else "used"))
+        elif self.page_vectorizer is not None:
+            html = '<html><body>example</body></html>'
+            saved = _n_features(data['page_vectorizer'], html)
+            current = _n_features(self.page_vectorizer, html)
+            if saved != current:
+                errors.append("page vectorizer n_features=%d (current: %d)"
+                              % (saved, current))
+        if errors:
+            raise ValueError(
+                "Policy can't be used for warm start, it has different "
+                "features: %s" % ", ".join(errors))
+
     def get_params(self) -> Dict:
         keys = self._ARGS - {'checkpoint_path', 'checkpoint_interval'}
         params = {key: getattr(self, key) for key in keys}
@@ -606,9 +1060,12 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
             return
         path = Path(self.checkpoint_path)
         id_ = 'latest' if self.checkpoint_latest else self.Q.t_
-        self.dump_policy(path/("Q-%s.joblib" % id_), False)
+        policy_name = "Q-%s.joblib" % id_
+        self.dump_policy(path/policy_name, False)
+        if self.checkpoint_replay:
+            self.dump_checkpoint_replay(policy_name)
         self.dump_crawl_graph(path/"graph.pickle")
-        self.dump_queue(path/("queue-%s.csv.gz" % id_))
+        self.dump_queue(path/("frontier-%s.bin" % id_))
         # Logging queue memory stats only on checkpoints because we need
         # to do a linear scan over all queues, which can be slow.
         queue = self.scheduler.queue
@@ -617,6 +1074,11 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
             'Replay entries {:,}, vectors bytes {:,}'
             .format(len(queue), queue.nbytes(),
                     len(self.Q.memory), self.Q.memory.nbytes()))
+        if self.link_interner is not None:
+            self.logger.info(
+                'Interned link vectors: {rows:,} distinct, {nbytes:,} bytes; '
+                'hit rate {hit_rate:.1%}, {saved_nbytes:,} bytes saved'
+                .format(**self.link_interner.stats()))
 
     @log_time
     def dump_crawl_graph(self, path) -> None:
@@ -632,6 +1094,11 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
             'page_vectorizer': self.page_vectorizer,
             '_params': self.get_params(),
         }
+        if isinstance(self.Q, AsyncQLearner):
+            # the model is owned by the learner process
+            self.Q.dump(path, data, save_experience_replay)
+            self._save_params_json()
+            return
         self.Q.pickle_memory = save_experience_replay
         try:
             joblib.dump(data, str(path), compress=3)
@@ -639,10 +1106,91 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
             self.Q.pickle_memory = False
         self._save_params_json()
 
+    def _checkpoint_dir(self) -> Path:
+        assert self.checkpoint_path is not None
+        return Path(self.checkpoint_path)
+
+    def _replay_checkpoint_path(self) -> Path:
+        return self._checkpoint_dir() / 'replay'
+
+    @log_time
+    def dump_replay(self, path: Path) -> None:
+        """ Save experience replay memory to ``path`` directory """
+        if isinstance(self.Q, AsyncQLearner):
+            self.Q.save_memory(str(path))
+        else:
+            self.Q.memory.save(str(path))
+
+    def dump_checkpoint_replay(self, policy_name: str) -> None:
+        """
+        Save experience replay memory to checkpoint_path, along with
+        the name of a policy checkpoint saved at the same time;
+        the replay is only restored with this policy (see
+        :meth:`resume_replay`).
+        """
+        path = self._checkpoint_dir()
+        self.dump_replay(self._replay_checkpoint_path())
+        (path/"replay.json").write_text(json.dumps({
+            'policy': policy_name, 't': self.Q.t_}))
+
+    def resume_replay(self) -> None:
+        """
+        Restore the policy and experience replay memory saved
+        on the latest checkpoint with ``checkpoint_replay`` option.
+        The replay is not loaded without the policy checkpoint
+        it was saved with, and it is not mixed with ``warm_start_path``.
+        """
+        path = self._checkpoint_dir()
+        replay_path = self._replay_checkpoint_path()
+        if not (path / 'replay.json').exists():
+            return
+        checkpoint = json.loads((path / 'replay.json').read_text())
+        policy_path = path / checkpoint['policy']
+        if self.warm_start_path:
+            self.logger.warning(
+                "Experience replay memory in %s is not restored, because "
+                "warm_start_path is used", replay_path)
+            return
+        if (not policy_path.exists() or
+                not (replay_path / 'memory.json').exists()):
+            self.logger.warning(
+                "Experience replay memory in %s is not restored: "
+                "%s or the replay is missing", replay_path, policy_path)
+            return
+        data = joblib.load(str(policy_path))
+        self._check_warm_start_compatible(data)
+        self.Q.warm_start(data['Q'], resume=True)
+        self.logger.info("Resuming from checkpoint %s: %d observations",
+                         policy_path, checkpoint['t'])
+        self.load_replay(replay_path)
+
     @log_time
+    def load_replay(self, path: Path) -> None:
+        """
+        Restore experience replay memory saved by :meth:`dump_replay`
+        to ``path`` directory.
+        """
+        mmap = bool(self.replay_path)
+        if isinstance(self.Q, AsyncQLearner):
+            self.Q.load_memory(str(path), mmap)
+            self.logger.info("Loading experience replay memory from %s "
+                             "in the learner process", path)
+            return
+        self.Q.memory.load(str(path), mmap)
+        self.logger.info("Restored %d observations in replay memory from %s",
+                         len(self.Q.memory), path)
+
     def dump_queue(self, path: Path) -> None:
-        with gzip.open(str(path), 'wt', encoding='utf8') as f:
-            self.scheduler.queue.debug_dump(f)
+        """
+        Save a snapshot of all queued requests to ``path``;
+        pass it as ``frontier_path`` to resume the crawl.
+        """
+        n_saved = self.scheduler.queue.save(str(path))
+        n_queued = len(self.scheduler.queue)
+        if n_saved < n_queued:
+            self.logger.warning(
+                "%d queued requests can't be saved to frontier snapshot "
+                "(they have callbacks or errbacks)", n_queued - n_saved)
 
     @classmethod
     def _steps_before_rescheduling(cls, n_requests: int,
@@ -657,3 +1205,7 @@ class QSpider(BaseSpider, metaclass=abc.ABCMeta):
         """
         ratio = budget / (1-budget)
         return int(n_requests / scheduling_rps / ratio / page_process_time_s)
+
+
+def _n_features(vectorizer, doc) -> int:
+    return vectorizer.transform([doc]).shape[1]
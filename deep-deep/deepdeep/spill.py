@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Queue Spilling
+==============
+
+On broad crawls most domain queues are rarely sampled, but their
+requests and link vectors take most of the frontier memory.
+:class:`SpillStore` keeps requests of such "cold" queues on local disk:
+:class:`deepdeep.queues.BalancedPriorityQueue` moves cold queues there,
+keeping only their top priority in memory, and reads them back
+when they are chosen.
+
+Each write appends a single record (a compressed pickle of a list of
+requests) to the current segment file; a new segment is started when
+the current one grows larger than ``segment_size``. Records are never
+rewritten: a record is freed after it is read back, and a segment
+file is removed when all of its records are freed.
+"""
+import pickle
+import shutil
+import tempfile
+import weakref
+import zlib
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+
+# segment id, offset and length of a record
+Location = Tuple[int, int, int]
+
+
+class SpillStore:
+    """
+    Store lists of requests in append-only segment files in a new
+    temporary directory inside ``path``; the directory is removed
+    when the store is garbage collected.
+
+    Requests are pickled, so they shouldn't have callbacks
+    (see :meth:`can_store`). :class:`deepdeep.interning.InternedRow`
+    link vectors are pickled as sparse matrices; they are interned again
+    when requests are pushed back to a queue which uses interning.
+    """
+    def __init__(self,
+                 path: str,
+                 segment_size: int=64 << 20,
+                 compress_level: int=1) -> None:
+        self.path = path
+        self.segment_size = segment_size
+        self.compress_level = compress_level
+        Path(path).mkdir(parents=True, exist_ok=True)
+        self._dir = Path(tempfile.mkdtemp(prefix='spill-', dir=path))
+        self._finalizer = weakref.finalize(
+            self, shutil.rmtree, str(self._dir), ignore_errors=True)
+        self._segment = -1
+        self._file = None  # type: Optional[BinaryIO]
+        # segment id -> number of records which are not freed, and size
+        self._live_records = {}  # type: Dict[int, int]
+        self._sizes = {}  # type: Dict[int, int]
+
+    @staticmethod
+    def can_store(request: Any) -> bool:
+        """ Return True if ``request`` can be written to the store """
+        return (getattr(request, 'callback', None) is None and
+                getattr(request, 'errback', None) is None)
+
+    def write(self, requests: List[Any]) -> Location:
+        """ Write a list of requests; return a location of the record """
+        data = zlib.compress(
+            pickle.dumps(requests, protocol=pickle.HIGHEST_PROTOCOL),
+            self.compress_level)
+        if (self._file is None or
+                self._sizes[self._segment] + len(data) > self.segment_size):
+            self._new_segment()
+        segment = self._segment
+        offset = self._sizes[segment]
+        assert self._file is not None
+        self._file.write(data)
+        self._sizes[segment] += len(data)
+        self._live_records[segment] += 1
+        return segment, offset, len(data)
+
+    def read(self, location: Location) -> List[Any]:
+        """ Read a list of requests from ``location`` """
+        segment, offset, length = location
+        if segment == self._segment:
+            assert self._file is not None
+            self._file.flush()
+        with self._segment_path(segment).open('rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        return pickle.loads(zlib.decompress(data))
+
+    def free(self, location: Location) -> None:
+        """
+        Mark a record at ``location`` as free; a segment is removed
+        when all its records are free.
+        """
+        segment = location[0]
+        self._live_records[segment] -= 1
+        if not self._live_records[segment] and segment != self._segment:
+            self._remove_segment(segment)
+
+    @property
+    def n_segments(self) -> int:
+        return len(self._sizes)
+
+    def nbytes(self) -> int:
+        """ Size of segment files on disk """
+        return sum(self._sizes.values())
+
+    def close(self) -> None:
+        """ Remove all segment files """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._finalizer()
+
+    def _new_segment(self) -> None:
+        previous = self._segment
+        if self._file is not None:
+            self._file.close()
+        self._segment += 1
+        self._file = self._segment_path(self._segment).open('wb')
+        self._live_records[self._segment] = 0
+        self._sizes[self._segment] = 0
+        if previous in self._live_records and not self._live_records[previous]:
+            self._remove_segment(previous)
+
+    def _remove_segment(self, segment: int) -> None:
+        del self._live_records[segment]
+        del self._sizes[segment]
+        self._segment_path(segment).unlink()
+
+    def _segment_path(self, segment: int) -> Path:
+        return self._dir / ('segment-%06d.bin' % segment)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Stratified Sampling
+===================
+
+:class:`StratifiedSampler` groups examples stored at integer slots
+into strata (e.g. by domain and reward bucket) and samples minibatches
+balanced across strata: each non-empty stratum gets an equal share of
+the minibatch, so a few large strata don't dominate it.
+
+Each stratum is an array-backed list of slots; a slot knows its
+stratum and its position in the list, so adding, removing and moving
+an example is O(1) (removed slots are replaced with the last slot
+of the same stratum).
+"""
+import random
+from typing import Dict, Hashable, List
+
+import numpy as np
+
+from deepdeep.utils import resized
+
+
+class StratifiedSampler:
+    """
+    Sample example slots uniformly across strata.
+
+    >>> sampler = StratifiedSampler()
+    >>> for idx, key in enumerate(['a', 'a', 'a', 'a', 'b']):
+    ...     sampler.add(idx, key)
+    >>> sampler.n_strata
+    2
+    >>> 4 in sampler.sample(2)
+    True
+    >>> sampler.remove(4)
+    >>> sampler.n_strata
+    1
+    >>> sorted(sampler.sample(10).tolist())
+    [0, 1, 2, 3]
+    """
+    def __init__(self) -> None:
+        self.clear()
+
+    def clear(self) -> None:
+        self._stratum_ids = {}  # type: Dict[Hashable, int]
+        self._keys = []  # type: List[Hashable]
+        self._members = []  # type: List[np.ndarray]  # stratum -> slots
+        self._sizes = np.zeros(0, dtype=np.int64)
+        # ids of non-empty strata, and a position of each stratum there
+        self._nonempty = np.zeros(0, dtype=np.int64)
+        self._nonempty_pos = np.zeros(0, dtype=np.int64)
+        self._n_nonempty = 0
+        self._strata = np.zeros(0, dtype=np.int64)  # slot -> stratum
+        self._pos = np.zeros(0, dtype=np.int64)  # slot -> position
+
+    @property
+    def n_strata(self) -> int:
+        """ Number of non-empty strata """
+        return self._n_nonempty
+
+    @property
+    def keys(self) -> List[Hashable]:
+        """ Stratum keys, indexed by stratum id """
+        return self._keys
+
+    def strata(self, size: int) -> np.ndarray:
+        """ Return stratum ids of slots ``0 <= idx < size`` """
+        return self._strata[:size]
+
+    def add(self, idx: int, key: Hashable) -> None:
+        """ A new example of stratum ``key`` is stored at slot ``idx`` """
+        stratum = self._stratum_id(key)
+        if idx >= len(self._strata):
+            capacity = max(idx + 1, 2 * len(self._strata))
+            self._strata = resized(self._strata, capacity)
+            self._pos = resized(self._pos, capacity)
+        members = self._members[stratum]
+        size = int(self._sizes[stratum])
+        if size >= len(members):
+            members = resized(members, max(4, 2 * len(members)))
+            self._members[stratum] = members
+        members[size] = idx
+        self._sizes[stratum] = size + 1
+        self._strata[idx] = stratum
+        self._pos[idx] = size
+        if size == 0:
+            self._nonempty[self._n_nonempty] = stratum
+            self._nonempty_pos[stratum] = self._n_nonempty
+            self._n_nonempty += 1
+
+    def remove(self, idx: int) -> None:
+        """ An example at slot ``idx`` is removed """
+        stratum = int(self._strata[idx])
+        members = self._members[stratum]
+        last = int(self._sizes[stratum]) - 1
+        pos = int(self._pos[idx])
+        moved = members[last]
+        members[pos] = moved
+        self._pos[moved] = pos
+        self._sizes[stratum] = last
+        if last == 0:
+            # swap-remove the stratum from the list of non-empty strata
+            pos = int(self._nonempty_pos[stratum])
+            moved = self._nonempty[self._n_nonempty - 1]
+            self._nonempty[pos] = moved
+            self._nonempty_pos[moved] = pos
+            self._n_nonempty -= 1
+
+    def move(self, src: int, dst: int) -> None:
+        """ An example is moved from slot ``src`` to slot ``dst`` """
+        stratum = self._strata[src]
+        self._strata[dst] = stratum
+        self._pos[dst] = self._pos[src]
+        self._members[stratum][self._pos[src]] = dst
+
+    def sample(self, k: int) -> np.ndarray:
+        """
+        Return slots of no more than ``k`` examples sampled without
+        replacement. Each non-empty stratum gets an equal share of
+        the sample; strata smaller than their share are taken whole,
+        and the rest is split between larger strata.
+        """
+        n_strata = self._n_nonempty
+        if not k or not n_strata:
+            return np.zeros(0, dtype=np.int64)
+        strata = self._nonempty[:n_strata]
+        sizes = self._sizes[strata]
+        if k < n_strata:
+            # at most one example per stratum
+            strata = strata[np.random.choice(n_strata, k, replace=False)]
+            pos = (np.random.rand(k) * self._sizes[strata]).astype(np.int64)
+            return np.array([self._members[s][p]
+                             for s, p in zip(strata.tolist(), pos.tolist())],
+                            dtype=np.int64)
+        counts = _allocate(sizes, k)
+        slots = []
+        for stratum, size, count in zip(strata.tolist(), sizes.tolist(),
+                                        counts.tolist()):
+            members = self._members[stratum]
+            if count == size:
+                slots.append(members[:size])
+            elif count:
+                slots.append(members[random.sample(range(size), count)])
+        return np.concatenate(slots)
+
+    def _stratum_id(self, key: Hashable) -> int:
+        stratum = self._stratum_ids.get(key)
+        if stratum is None:
+            stratum = len(self._keys)
+            self._stratum_ids[key] = stratum
+            self._keys.append(key)
+            self._members.append(np.zeros(0, dtype=np.int64))
+            if stratum >= len(self._sizes):
+                capacity = max(stratum + 1, 2 * len(self._sizes))
+                self._sizes = resized(self._sizes, capacity)
+                self._nonempty = resized(self._nonempty, capacity)
+                self._nonempty_pos = resized(self._nonempty_pos, capacity)
+        return stratum
+
+
+def _allocate(sizes: np.ndarray, k: int) -> np.ndarray:
+    """
+    Split ``k`` between strata of ``sizes`` as equally as possible,
+    without giving a stratum more than its size.
+
+    >>> _allocate(np.array([1, 10, 10]), 9).tolist()
+    [1, 4, 4]
+    >>> _allocate(np.array([1, 2, 10]), 100).tolist()
+    [1, 2, 10]
+    """
+    level = int(sizes.max())
+    remaining, n_left = k, len(sizes)
+    for size in np.sort(sizes).tolist():
+        if size * n_left > remaining:
+            level = remaining // n_left
+            break
+        remaining -= size
+        n_left -= 1
+    counts = np.minimum(sizes, level)
+    # the remainder of integer division goes to random larger strata
+    remaining = k - int(counts.sum())
+    spare = np.flatnonzero(sizes > level)
+    if remaining and len(spare):
+        extra = np.random.choice(spare, min(remaining, len(spare)),
+                                 replace=False)
+        counts[extra] += 1
+    return counts
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Sum Tree
+========
+
+:class:`SumTree` stores non-negative priorities of items and allows to
+sample items with probabilities proportional to their priorities.
+Sampling and priority updates are O(log n); both operations are
+vectorized, so a batch of items is processed with a few numpy operations
+per tree level.
+"""
+import numpy as np
+
+
+class SumTree:
+    """
+    Array-backed binary tree where each leaf is an item priority,
+    and each internal node is a sum of its children.
+
+    Items are indexed by integers ``0 <= idx < len(tree)``; the tree
+    grows automatically when priorities of new items are set.
+
+    >>> tree = SumTree()
+    >>> tree.update([0, 1, 2], [1.0, 0.0, 3.0])
+    >>> len(tree), tree.total
+    (3, 4.0)
+    >>> tree.find(np.array([0.5, 1.5, 3.9]))
+    array([0, 2, 2])
+    >>> tree[[0, 2]].tolist()
+    [1.0, 3.0]
+    """
+    def __init__(self, capacity: int=16) -> None:
+        self._capacity = _next_power_of_2(capacity)
+        self._tree = np.zeros(2 * self._capacity)
+        self._size = 0
+
+    @property
+    def _depth(self) -> int:
+        return self._capacity.bit_length() - 1
+
+    @property
+    def total(self) -> float:
+        """ Sum of all priorities """
+        return float(self._tree[1])
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, indices) -> np.ndarray:
+        return self._tree[np.asarray(indices) + self._capacity]
+
+    def update(self, indices, priorities) -> None:
+        """
+        Set ``priorities`` of items at ``indices``. If an index
+        is repeated, the last priority is used.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if not len(indices):
+            return
+        priorities = np.broadcast_to(
+            np.asarray(priorities, dtype=np.float64), indices.shape)
+        assert (priorities >= 0).all()
+        size = int(indices.max()) + 1
+        if size > self._capacity:
+            self._grow(size)
+        self._size = max(self._size, size)
+        nodes = indices + self._capacity
+        self._tree[nodes] = priorities
+        for _ in range(self._depth):
+            nodes = np.unique(nodes // 2)
+            self._tree[nodes] = (self._tree[2 * nodes] +
+                                 self._tree[2 * nodes + 1])
+
+    def find(self, values: np.ndarray) -> np.ndarray:
+        """
+        For each value ``0 <= v < total`` return an index of the first
+        item such that the sum of priorities of items up to it
+        (inclusive) is larger than ``v``.
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self._depth):
+            left = 2 * nodes
+            left_sums = self._tree[left]
+            go_right = values >= left_sums
+            values -= np.where(go_right, left_sums, 0)
+            nodes = left + go_right
+        # floating point errors may lead to items past the end
+        return np.minimum(nodes - self._capacity, self._size - 1)
+
+    def sample(self, k: int, random_state=np.random) -> np.ndarray:
+        """
+        Return indices of ``k`` items sampled with replacement, with
+        probabilities proportional to priorities. Stratified sampling
+        is used: the total is split into ``k`` equal ranges, and an item
+        is sampled from each range.
+        """
+        bounds = np.linspace(0, self.total, k + 1)
+        values = random_state.uniform(bounds[:-1], bounds[1:])
+        return self.find(values)
+
+    def _grow(self, size: int) -> None:
+        capacity = _next_power_of_2(size)
+        leaves = self._tree[self._capacity:self._capacity + self._size]
+        self._capacity = capacity
+        self._tree = np.zeros(2 * capacity)
+        self._tree[capacity:capacity + len(leaves)] = leaves
+        level_start = capacity // 2
+        while level_start >= 1:
+            nodes = np.arange(level_start, 2 * level_start)
+            self._tree[nodes] = (self._tree[2 * nodes] +
+                                 self._tree[2 * nodes + 1])
+            level_start //= 2
+
+
+def _next_power_of_2(n: int) -> int:
+    capacity = 1
+    while capacity < n:
+        capacity *= 2
+    return capacity
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Training scheduling
+===================
+
+By default online :math:`Q(s, a)` function is updated after each response,
+so training cost is fixed per response, regardless of how busy the spider
+is. :class:`TrainingController` instead runs experience replay minibatches
+so that training takes a configured share of wall time: it trains less
+when responses are coming fast, and catches up when the reactor
+is idle, e.g. when the downloader is saturated by network latency.
+"""
+import time
+from typing import Any, Callable, Dict, Optional
+
+
+class TrainingController:
+    """
+    Decide how many experience replay minibatches to train on, and when.
+
+    Each second of wall time adds ``budget`` seconds of training "credit";
+    time spent training is subtracted from it, so in the long run training
+    takes no more than ``budget`` share of wall time. Credit is capped at
+    ``max_credit`` seconds.
+
+    Call :meth:`step` after each processed response: it trains on as many
+    minibatches as credit allows, but no more than ``max_batches_per_step``,
+    to keep response processing latency low. Call :meth:`tick` periodically
+    (e.g. each second) from the reactor: if the reactor was idle
+    for at least ``idle_threshold`` share of the last interval, up to
+    ``max_batches`` minibatches are trained at once to use the accumulated
+    credit. Decisions for each interval are written to ``stats``
+    (a Scrapy StatsCollector) under ``learning/`` prefix.
+
+    ``fit`` is a function which trains on a single minibatch;
+    it should return False if there is nothing to train on.
+    Time spent processing responses should be reported via
+    :meth:`record_busy`; it is used to estimate reactor idle time.
+    """
+    def __init__(self,
+                 fit: Callable[[], bool],
+                 budget: float=0.2,
+                 max_batches_per_step: int=2,
+                 max_batches: int=50,
+                 max_credit: float=10.0,
+                 idle_threshold: float=0.5,
+                 stats: Any=None,
+                 clock: Callable[[], float]=time.time,
+                 ) -> None:
+        assert 0 < budget < 1
+        self.fit = fit
+        self.budget = budget
+        self.max_batches_per_step = max_batches_per_step
+        self.max_batches = max_batches
+        self.max_credit = max_credit
+        self.idle_threshold = idle_threshold
+        self.stats = stats
+        self.clock = clock
+
+        self.credit = 0.0
+        self.fit_time = None  # type: Optional[float]
+        self.n_batches = 0
+        self._last_accrued = self._interval_start = clock()
+        self._interval_batches = 0
+        self._interval_train_time = 0.0
+        self._interval_busy_time = 0.0
+
+    def record_busy(self, seconds: float) -> None:
+        """ Report time spent on work other than training """
+        self._interval_busy_time += seconds
+
+    def step(self) -> int:
+        """
+        Train on minibatches allowed by the budget; return the number
+        of minibatches trained.
+        """
+        return self._train(self.max_batches_per_step)
+
+    def tick(self) -> Dict[str, float]:
+        """
+        Catch up on training if the reactor was idle during the last
+        interval, and report interval stats. Return reported stats.
+        """
+        idle_share = self._idle_share()
+        if idle_share >= self.idle_threshold:
+            self._train(self.max_batches)
+
+        now = self.clock()
+        wall_time = max(now - self._interval_start, 1e-9)
+        info = {
+            'batches': self._interval_batches,
+            'train_share': self._interval_train_time / wall_time,
+            'idle_share': idle_share,
+            'credit': self.credit,
+            'fit_time': self.fit_time or 0.0,
+        }
+        if self.stats is not None:
+            for key, value in info.items():
+                self.stats.set_value('learning/interval/%s' % key, value)
+            self.stats.set_value('learning/batches', self.n_batches)
+        self._interval_start = now
+        self._interval_batches = 0
+        self._interval_train_time = 0.0
+        self._interval_busy_time = 0.0
+        return info
+
+    def _idle_share(self) -> float:
+        wall_time = self.clock() - self._interval_start
+        if wall_time <= 0:
+            return 0.0
+        busy = self._interval_busy_time + self._interval_train_time
+        return max(0.0, 1 - busy / wall_time)
+
+    def _accrue(self) -> None:
+        now = self.clock()
+        self.credit += (now - self._last_accrued) * self.budget
+        self.credit = min(self.credit, self.max_credit)
+        self._last_accrued = now
+
+    def _train(self, max_batches: int) -> int:
+        self._accrue()
+        if self.fit_time is None:
+            n = 1  # cost of a minibatch is not known yet
+        else:
+            n = min(max_batches, int(self.credit / max(self.fit_time, 1e-6)))
+        done = 0
+        for _ in range(n):
+            start = self.clock()
+            if not self.fit():
+                break
+            duration = self.clock() - start
+            done += 1
+            self.credit -= duration
+            self._interval_train_time += duration
+            if self.fit_time is None:
+                self.fit_time = duration
+            else:
+                self.fit_time = 0.8 * self.fit_time + 0.2 * duration
+        self.n_batches += done
+        self._interval_batches += done
+        return done
@@ -147,12 +147,59 @@ def canonicalize_url(url: str) -> str:
 
 
 def csr_nbytes(m: csr_matrix) -> int:
-    if m is not None:
-        return m.data.nbytes + m.indices.nbytes + m.indptr.nbytes
-    else:
+    if m is None:
         return 0
+    if hasattr(m, 'nbytes'):  # e.g. deepdeep.qlearning.FactoredAS
+        return m.nbytes
+    return m.data.nbytes + m.indices.nbytes + m.indptr.nbytes
 
 
 def chunks(lst, chunk_size: int):
     for idx in range(0, len(lst), chunk_size):
         yield lst[idx: idx + chunk_size]
+
+
+def resized(arr: np.ndarray, size: int, fill=0) -> np.ndarray:
+    """
+    Return a copy of a 1D array ``arr`` resized to ``size`` elements;
+    new elements are set to ``fill``.
+
+    >>> resized(np.array([1, 2]), 4, fill=-1)
+    array([ 1,  2, -1, -1])
+    """
+    new = np.full(size, fill, dtype=arr.dtype)
+    n = min(size, len(arr))
+    new[:n] = arr[:n]
+    return new
+
+
+def segment_max(values: np.ndarray, indptr: np.ndarray) -> np.ndarray:
+    """
+    Return maximum value for each segment ``values[indptr[i]:indptr[i+1]]``.
+    All segments must be non-empty.
+
+    >>> segment_max(np.array([1, 3, 2, 5, 5, 0]), np.array([0, 3, 6]))
+    array([3, 5])
+    """
+    return np.maximum.reduceat(values, indptr[:-1])
+
+
+def segment_argmax(values: np.ndarray, indptr: np.ndarray) -> np.ndarray:
+    """
+    Return positions of maximum values for each segment
+    ``values[indptr[i]:indptr[i+1]]``. All segments must be non-empty.
+    Like ``np.argmax``, the first occurrence is returned in case of ties;
+    positions are indices in ``values``, not offsets within segments.
+
+    >>> segment_argmax(np.array([1, 3, 2, 5, 5, 0]), np.array([0, 3, 6]))
+    array([1, 3])
+    >>> segment_argmax(np.array([2, 7]), np.array([0, 1, 2]))
+    array([0, 1])
+    """
+    lengths = np.diff(indptr)
+    is_max = values == np.repeat(segment_max(values, indptr), lengths)
+    positions = np.flatnonzero(is_max)
+    segments = np.repeat(np.arange(len(lengths)), lengths)[positions]
+    first = np.ones(len(positions), dtype=bool)
+    first[1:] = segments[1:] != segments[:-1]
+    return positions[first]
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""
+Benchmarks for performance-critical parts of deepdeep.qlearning.
+Random data with a shape similar to real crawls is used.
+"""
+import argparse
+import sys
+import timeit
+from pathlib import Path
+sys.path.insert(0, str((Path(__file__).parent / "..").absolute()))
+
+import numpy as np
+from scipy import sparse
+
+from deepdeep.qlearning import QLearner, LinearScorer
+
+
+def random_matrix(n_rows, n_features, nnz_per_row, rng):
+    indices = rng.randint(0, n_features, size=n_rows * nnz_per_row)
+    data = rng.rand(n_rows * nnz_per_row).astype(np.float32)
+    indptr = np.arange(0, n_rows * nnz_per_row + 1, nnz_per_row)
+    m = sparse.csr_matrix((data, indices, indptr), shape=(n_rows, n_features))
+    m.sum_duplicates()
+    return m
+
+
+def fitted_qlearner(n_features, nnz_per_row, rng, **kwargs):
+    Q = QLearner(**kwargs)
+    X = random_matrix(1000, n_features, nnz_per_row, rng)
+    Q.clf_online.partial_fit(X, rng.rand(X.shape[0]))
+    Q._update_target_clf()
+    Q.clf_online.partial_fit(X, rng.rand(X.shape[0]))
+    return Q
+
+
+def Q_t1_loop(Q, AS_t1_list):
+    """ A loop over AS_t1 matrices; this is how it was implemented before """
+    values = np.zeros(len(AS_t1_list))
+    for idx, AS_t1 in enumerate(AS_t1_list):
+        scores = Q.predict(AS_t1, online=True)
+        if Q.double_learning:
+            values[idx] = Q.predict_one(AS_t1[scores.argmax()])
+        else:
+            values[idx] = scores.max()
+    return values
+
+
+def Q_t1_gist(Q, AS_t1_list):
+    """
+    Stack all matrices, predict all scores at once, then slice the
+    results in Python (https://gist.github.com/kmike/c0d3fa1822cd6ddcdbca9b067ee3e94a)
+    """
+    AS_t1 = sparse.vstack(AS_t1_list, format='csr')
+    scores_online = Q.predict(AS_t1, online=True)
+    scores_target = Q.predict(AS_t1, online=False)
+    values = np.zeros(len(AS_t1_list))
+    start = 0
+    for idx, m in enumerate(AS_t1_list):
+        end = start + m.shape[0]
+        if Q.double_learning:
+            values[idx] = scores_target[start + scores_online[start:end].argmax()]
+        else:
+            values[idx] = scores_online[start:end].max()
+        start = end
+    return values
+
+
+def Q_t1_batched(Q, AS_t1_list):
+    return Q._get_Q_t1_values((len(AS_t1_list),), AS_t1_list)
+
+
+def bench_targets(args, rng):
+    print("Q(s_t+1, a_t+1) for {} observations, ~{} links each"
+          .format(args.sample_size, args.links))
+    for double_learning in [True, False]:
+        Q = fitted_qlearner(args.n_features, args.nnz, rng,
+                            double_learning=double_learning)
+        AS_t1_list = [
+            random_matrix(max(1, int(n)), args.n_features, args.nnz, rng)
+            for n in rng.exponential(args.links, size=args.sample_size)
+        ]
+        expected = Q_t1_loop(Q, AS_t1_list)
+        print("double_learning={}".format(double_learning))
+        for func in [Q_t1_loop, Q_t1_gist, Q_t1_batched]:
+            assert np.allclose(func(Q, AS_t1_list), expected)
+            timer = timeit.Timer(lambda: func(Q, AS_t1_list))
+            best = min(timer.repeat(repeat=args.repeat, number=1))
+            print("    {:15s} {:8.2f}ms".format(func.__name__, best * 1000))
+
+
+def bench_fit_iteration(args, rng):
+    print("fit_iteration: replay memory of {} observations, sample size {}, "
+          "{} steps per target switch"
+          .format(args.memory_size, args.sample_size, args.steps))
+    observations = [
+        (random_matrix(1, args.n_features, args.nnz, rng),
+         random_matrix(max(1, int(n)), args.n_features, args.nnz, rng),
+         rng.rand())
+        for n in rng.exponential(args.links, size=args.memory_size)
+    ]
+    for lagged in [False, True]:
+        Q = fitted_qlearner(args.n_features, args.nnz, rng,
+                            lagged_double_learning=lagged)
+        for as_t, AS_t1, r_t1 in observations:
+            Q.memory.add(as_t, AS_t1, r_t1)
+        timer = timeit.Timer(lambda: Q.fit_iteration(args.sample_size))
+        best = min(timer.repeat(repeat=args.repeat, number=args.steps))
+        print("    lagged_double_learning={!s:5} {:8.2f}ms per step".format(
+            lagged, best * 1000 / args.steps))
+
+
+def bench_scoring(args, rng):
+    print("Scoring: SGDRegressor.predict vs LinearScorer")
+    Q = fitted_qlearner(args.n_features, args.nnz, rng)
+    clf = Q.clf_target
+    scorer = LinearScorer.from_clf(clf)
+
+    def timed(func):
+        number = 100
+        best = min(timeit.Timer(func).repeat(repeat=args.repeat,
+                                               number=number))
+        return best * 1e6 / number
+
+    for n_rows in [1, 100, 4096]:
+        X = random_matrix(n_rows, args.n_features, args.nnz, rng)
+        assert np.allclose(clf.predict(X), scorer.predict(X))
+        print("    {:4d} rows:  sklearn {:9.1f}us  scorer {:9.1f}us".format(
+            n_rows, timed(lambda: clf.predict(X)),
+            timed(lambda: scorer.predict(X))))
+    x = random_matrix(1, args.n_features, args.nnz, rng)
+    print("    predict_one: sklearn {:9.1f}us  scorer {:9.1f}us".format(
+        timed(lambda: clf.predict(sparse.vstack([x]))[0]),
+        timed(lambda: scorer.predict_one(x))))
+
+
+BENCHMARKS = {
+    'targets': bench_targets,
+    'fit': bench_fit_iteration,
+    'scoring': bench_scoring,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    arg = parser.add_argument
+    arg('--n-features', type=int, default=2 * 1024 * 1024,
+        help='Number of features')
+    arg('--nnz', type=int, default=50, help='Non-zero features per row')
+    arg('--sample-size', type=int, default=300,
+        help='Experience replay sample size')
+    arg('--links', type=int, default=100, help='Average links per page')
+    arg('--memory-size', type=int, default=3000,
+        help='Experience replay memory size')
+    arg('--steps', type=int, default=100,
+        help='Number of fit_iteration steps between target switches')
+    arg('--repeat', type=int, default=5, help='Number of timing runs')
+    arg('benchmarks', nargs='*',
+        help='Benchmarks to run: %s (default: all)' % ', '.join(
+            sorted(BENCHMARKS)))
+    args = parser.parse_args()
+    unknown = sorted(set(args.benchmarks) - set(BENCHMARKS))
+    if unknown:
+        parser.error('unknown benchmarks: %s' % ', '.join(unknown))
+    rng = np.random.RandomState(42)
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        BENCHMARKS[name](args, rng)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Benchmarks for request scheduling in deepdeep.queues.
+Domain queues are replaced with lightweight stubs with an endless supply
+of requests, so that only the cost of choosing domain queues is measured.
+"""
+import argparse
+import random
+import sys
+import timeit
+from pathlib import Path
+sys.path.insert(0, str((Path(__file__).parent / "..").absolute()))
+
+import numpy as np
+
+from deepdeep.queues import BalancedPriorityQueue, FLOAT_PRIORITY_MULTIPLIER
+from deepdeep.utils import softmax
+
+
+class StubRequest:
+    def __init__(self, slot):
+        self.meta = {'scheduler_slot': slot}
+
+
+class StubQueue:
+    """
+    A domain queue which never gets empty; priority of its top request
+    decreases after each pop.
+    """
+    def __init__(self, slot, priority):
+        self.slot = slot
+        self.priority = priority
+        self.on_change = None
+
+    def push(self, request):
+        pass
+
+    def pop(self):
+        self.priority -= random.randint(0, FLOAT_PRIORITY_MULTIPLIER // 10)
+        if self.on_change is not None:
+            self.on_change()
+        return StubRequest(self.slot)
+
+    pop_random = pop
+
+    def max_priority(self):
+        return self.priority
+
+    def __len__(self):
+        return 1
+
+
+def balanced_queue(n_domains, rng, eps):
+    priorities = (rng.randn(n_domains) * FLOAT_PRIORITY_MULTIPLIER).astype(int)
+    queue = BalancedPriorityQueue(
+        lambda slot: StubQueue(slot, int(priorities[slot])), eps=eps)
+    for slot in range(n_domains):
+        queue.push(StubRequest(slot))
+    return queue
+
+
+def pop_many_softmax(queue, n):
+    """
+    Sampling over a softmax of all domain weights;
+    this is how it was implemented before.
+    """
+    all_slots = list(queue.queues.keys())
+    weights = [q.max_priority() for q in queue.queues.values()]
+    temperature = FLOAT_PRIORITY_MULTIPLIER * queue.balancing_temperature
+    p = softmax(weights, t=temperature)
+    chosen_slots = np.random.choice(all_slots, size=n, replace=True, p=p)
+    requests = [queue.queues[slot].pop() for slot in chosen_slots]
+    n_random = np.random.binomial(n=len(requests) * (1 + queue.eps),
+                                  p=queue.eps)
+    for slot in np.random.choice(all_slots, size=n_random):
+        requests.append(queue.queues[slot].pop_random())
+    return requests
+
+
+def pop_many_sumtree(queue, n):
+    return queue._pop_many(n)
+
+
+def bench_sampling(args, rng):
+    print("Sampling domain queues, eps={}".format(args.eps))
+    for n_domains in args.domains:
+        queue = balanced_queue(n_domains, rng, args.eps)
+        batch_size = queue.batch_size
+        line = "    {:>9,d} domains, batch {:4d}:".format(n_domains, batch_size)
+        for func in [pop_many_softmax, pop_many_sumtree]:
+            func(queue, batch_size)  # warm up
+            timer = timeit.Timer(lambda: func(queue, batch_size))
+            best = min(timer.repeat(repeat=args.repeat,
+                                    number=args.batches)) / args.batches
+            line += "  {} {:9.2f}ms ({:>11,.0f} requests/s)".format(
+                func.__name__[len('pop_many_'):], best * 1000,
+                batch_size / best)
+        print(line)
+
+
+BENCHMARKS = {
+    'sampling': bench_sampling,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    arg = parser.add_argument
+    arg('--domains', type=int, nargs='+',
+        default=[1000, 100 * 1000, 1000 * 1000],
+        help='Numbers of domains to benchmark')
+    arg('--eps', type=float, default=0.1,
+        help='Probability of choosing a random queue')
+    arg('--batches', type=int, default=10,
+        help='Number of batches per timing run')
+    arg('--repeat', type=int, default=3, help='Number of timing runs')
+    arg('benchmarks', nargs='*',
+        help='Benchmarks to run: %s (default: all)' % ', '.join(
+            sorted(BENCHMARKS)))
+    args = parser.parse_args()
+    unknown = sorted(set(args.benchmarks) - set(BENCHMARKS))
+    if unknown:
+        parser.error('unknown benchmarks: %s' % ', '.join(unknown))
+    rng = np.random.RandomState(42)
+    random.seed(42)
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        BENCHMARKS[name](args, rng)
+
+
+if __name__ == '__main__':
+    main()
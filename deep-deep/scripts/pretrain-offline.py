@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Pre-train Q function on recorded crawls and save it as a policy file
+(Q-*.joblib) which QSpider can start from.
+
+Vectorizers and Q-learning parameters are taken from a policy file saved
+by the recorded crawl (a QSpider checkpoint), so that link and page
+features match the features a new crawl with the same arguments uses.
+"""
+import argparse
+import logging
+import sys
+from pathlib import Path
+sys.path.insert(0, str((Path(__file__).parent / "..").absolute()))
+
+import joblib
+
+from deepdeep.offline import (
+    qlearner_params, load_crawl, pretrain, dump_policy,
+)
+from deepdeep.qlearning import QLearner
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    arg = parser.add_argument
+    arg('policy', help='Path to Q-*.joblib saved by a recorded crawl')
+    arg('output', help='Where to save the pre-trained policy')
+    arg('--crawl', nargs=2, action='append', required=True,
+        metavar=('GRAPH', 'ITEMS'),
+        help='Path to graph.pickle and items.jl.gz of a recorded crawl; '
+             'can be passed several times')
+    arg('--epochs', type=float, default=10,
+        help='Number of passes over the experience replay memory')
+    arg('--processes', type=int, default=None,
+        help='Number of processes for link extraction and vectorization '
+             '(default: number of CPUs)')
+    arg('--no-limit-by-domain', action='store_true',
+        help='Use links to other domains, like a crawl with '
+             'OFFSITE_ENABLED=0')
+    arg('--save-memory', action='store_true',
+        help='Save experience replay memory along with the model')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    policy = joblib.load(args.policy)
+    params = policy.get('_params', {})
+    link_vectorizer = policy['link_vectorizer']
+    page_vectorizer = policy.get('page_vectorizer')
+    Q = QLearner(pickle_memory=False, **qlearner_params(params))
+
+    transitions = []
+    for graph_path, items_path in args.crawl:
+        transitions.extend(load_crawl(
+            graph_path, items_path, link_vectorizer, page_vectorizer, Q,
+            limit_by_domain=not args.no_limit_by_domain,
+            processes=args.processes,
+        ))
+    n_steps = pretrain(Q, transitions, epochs=args.epochs)
+    logging.info("Trained on %d transitions, %d fit iterations",
+                 len(transitions), n_steps)
+    dump_policy(args.output, Q, link_vectorizer, page_vectorizer, params,
+                pickle_memory=args.save_memory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import gc
+import pickle
+
+import joblib
+import numpy as np
+from scipy import sparse
+
+from deepdeep.arena import CSRArena, MmapCSRArena
+
+
+def test_csr_arena():
+    rng = np.random.RandomState(0)
+    matrices = [sparse.random(n_rows, 20, density=0.3, format='csr',
+                              random_state=rng)
+                for n_rows in [3, 1, 5, 2]]
+    matrices.insert(2, sparse.csr_matrix((0, 20)))
+    arena = CSRArena(capacity=2)
+    starts = [arena.append(m) for m in matrices]
+    assert starts == [0, 3, 4, 4, 9]
+    assert len(arena) == 11
+    stacked = sparse.vstack(matrices).tocsr()
+    rows = rng.randint(0, 11, size=30)
+    assert (arena.take(rows) != stacked[rows]).nnz == 0
+    assert arena.take([]).shape == (0, 20)
+
+    arena.free(0, 3)
+    arena.free(9, 2)
+    assert arena.n_dead == 5
+    assert list(arena.live_rows()) == [3, 4, 5, 6, 7, 8]
+    mapping = arena.compact()
+    assert list(mapping) == [-1, -1, -1, 0, 1, 2, 3, 4, 5, -1, -1]
+    assert len(arena) == 6 and arena.n_dead == 0
+    assert (arena.take(np.arange(6)) != stacked[3:9]).nnz == 0
+
+
+def test_mmap_csr_arena(tmpdir):
+    rng = np.random.RandomState(0)
+    m = sparse.random(100, 20, density=0.3, format='csr', random_state=rng)
+    arena = MmapCSRArena(str(tmpdir), capacity=8)
+    for row in range(0, 100, 10):
+        arena.append(m[row:row + 10])
+    assert len(tmpdir.listdir()) == 1
+    assert (arena.take(np.arange(100)) != m).nnz == 0
+
+    arena.free(0, 50)
+    arena.compact(chunk_size=7)
+    assert (arena.take(np.arange(50)) != m[50:]).nnz == 0
+
+    # the pickle is self-contained, and doesn't leave files behind
+    data = pickle.dumps(arena)
+    arena2 = pickle.loads(data)
+    assert isinstance(arena2, MmapCSRArena)
+    assert (arena2.take(np.arange(50)) != m[50:]).nnz == 0
+    assert len(tmpdir.listdir()) == 2
+
+    # arenas are independent
+    arena2.append(m[:10])
+    assert len(arena2) == 60 and len(arena) == 50
+    assert (arena.take(np.arange(50)) != m[50:]).nnz == 0
+
+    # files are removed with the arena; the pickle can be loaded again
+    del arena, arena2
+    gc.collect()
+    assert tmpdir.listdir() == []
+    arena3 = pickle.loads(data)
+    assert (arena3.take(np.arange(50)) != m[50:]).nnz == 0
+
+    # joblib writes memory-mapped buffers without copying them
+    arena3.append(m[:50])
+    joblib.dump(arena3, str(tmpdir.join('arena.joblib')), compress=3)
+    arena4 = joblib.load(str(tmpdir.join('arena.joblib')))
+    assert (arena4.take(np.arange(100)) !=
+            sparse.vstack([m[50:], m[:50]])).nnz == 0
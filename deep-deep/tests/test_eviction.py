@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from deepdeep.eviction import (
+    make_eviction_policy, OldestEviction, LowestPriorityEviction,
+)
+
+
+def test_oldest_eviction():
+    policy = OldestEviction()
+    for idx in range(5):
+        policy.add(idx, 1.0)
+    assert policy.choose(5) == 0
+    policy.remove(0)
+    policy.move(4, 0)  # swap-remove: the last example is moved
+    assert policy.choose(4) == 1
+    policy.remove(1)
+    policy.add(1, 1.0)  # the slot is reused by a new example
+    assert policy.choose(4) == 2
+    policy.remove(2)
+    policy.remove(3)
+    assert policy.choose(2) == 0
+
+
+def test_lowest_priority_eviction():
+    rng = np.random.RandomState(0)
+    policy = LowestPriorityEviction()
+    priorities = rng.rand(100)
+    for idx, priority in enumerate(priorities):
+        policy.add(idx, priority)
+    for _ in range(50):
+        indices = rng.randint(0, 100, size=10)
+        priorities[indices] = rng.rand(10)
+        policy.update(indices, priorities[indices])
+    assert policy.choose(100) == priorities.argmin()
+    idx = priorities.argmin()
+    policy.remove(idx)
+    policy.move(99, idx)
+    priorities[idx] = priorities[99]
+    assert policy.choose(99) == priorities[:99].argmin()
+    assert len(policy._heap) <= 2 * 99 + 16
+
+
+def test_make_eviction_policy():
+    policy = OldestEviction()
+    assert make_eviction_policy(policy) is policy
+    assert isinstance(make_eviction_policy('lowest_priority'),
+                      LowestPriorityEviction)
+    with pytest.raises(ValueError):
+        make_eviction_policy('newest')
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import pickle
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from deepdeep.ftrl import FTRLProximalRegressor
+from deepdeep.qlearning import QLearner, FactoredAS, LinearScorer
+
+
+N_FEATURES = 1000
+TRUE_COEF = np.zeros(N_FEATURES)
+TRUE_COEF[:50] = np.random.RandomState(42).randn(50)
+
+
+def random_data(n_rows, rng):
+    X = sparse.random(n_rows, N_FEATURES, density=0.02, format='csr',
+                      random_state=rng)
+    return X, X.dot(TRUE_COEF) + 0.5
+
+
+def test_ftrl_learns():
+    rng = np.random.RandomState(0)
+    clf = FTRLProximalRegressor(l1=0.1, l2=0.1)
+    X_test, y_test = random_data(200, rng)
+    for _ in range(100):
+        clf.partial_fit(*random_data(100, rng))
+    mse = ((clf.predict(X_test) - y_test) ** 2).mean()
+    assert mse < 0.2 * y_test.var()
+    keys = clf.keys_[:clf.n_features_]
+    assert len(set(keys)) == len(keys)
+    assert len(clf.slots_) == len(keys)
+    assert np.array_equal(clf.slots_.get(keys), np.arange(len(keys)))
+    # weights are stored only for features seen in training
+    assert clf.n_features_ <= N_FEATURES
+    assert len(clf.keys_) < 2 * N_FEATURES
+
+
+def test_ftrl_scorer():
+    rng = np.random.RandomState(0)
+    clf = FTRLProximalRegressor()
+    clf.partial_fit(*random_data(100, rng))
+    clf.partial_fit(*random_data(100, rng), sample_weight=rng.rand(100))
+    params = clf.trained_params()
+    assert np.all(params['w_'] != 0)
+    assert np.all(np.diff(params['keys_']) > 0)
+    assert len(params['w_']) < clf.n_features_
+
+    X, _ = random_data(20, rng)
+    dense_coef = np.zeros(X.shape[1])
+    dense_coef[clf.keys_[:clf.n_features_]] = clf.w_[:clf.n_features_]
+    expected = LinearScorer(dense_coef, clf.intercept_[0]).predict(X)
+    assert np.allclose(clf.predict(X), expected)
+    scorer = clf.scorer()
+    for row, value in zip(X, expected):
+        assert np.isclose(scorer.predict_one(row), value)
+
+    factored = FactoredAS(X[:, :600], X[:1, 600:], np.zeros(20, dtype=int))
+    assert np.allclose(scorer.predict(factored),
+                       clf.predict(factored.tocsr()))
+
+    # trained parameters and restored scorer arrays give the same scores
+    target = FTRLProximalRegressor()
+    for attr, value in params.items():
+        setattr(target, attr, value)
+    assert np.allclose(target.predict(X), expected)
+    restored = type(scorer)(intercept=scorer.intercept, **scorer.arrays())
+    assert np.allclose(restored.predict(X), expected)
+
+
+@pytest.mark.parametrize(['lagged'], [[True], [False]])
+def test_qlearner_ftrl(lagged):
+    rng = np.random.RandomState(0)
+    Q = QLearner(clf_backend='ftrl', steps_before_switch=5,
+                 replay_sample_size=5, lagged_double_learning=lagged)
+    X, _ = random_data(3, rng)
+    assert np.allclose(Q.predict(X), Q.initial_predictions)
+    for _ in range(10):
+        as_t, AS_t1 = random_data(1, rng)[0], random_data(4, rng)[0]
+        Q.add_experience(as_t, AS_t1, rng.rand())
+    assert Q.target_version_ == 2
+    assert Q.coef_norm(online=False) > 0
+    assert not hasattr(Q.clf_target, 'z_')
+    scores = Q.predict(X)
+    Q2 = pickle.loads(pickle.dumps(Q))
+    assert np.allclose(Q2.predict(X), scores)
+
+
+def test_qlearner_unknown_backend():
+    with pytest.raises(ValueError):
+        QLearner(clf_backend='foo')
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import gc
+import pickle
+
+import numpy as np
+from scipy import sparse
+
+from deepdeep.arena import CSRArena
+from deepdeep.interning import RowInterner, InternedRow
+from deepdeep.qlearning import ExperienceMemory, vstack_AS
+
+
+N_FEATURES = 50
+
+
+def random_matrix(n_rows, rng):
+    return sparse.random(n_rows, N_FEATURES, density=0.2, format='csr',
+                         random_state=rng, dtype=np.float32)
+
+
+def test_row_interner():
+    rng = np.random.RandomState(0)
+    rows = random_matrix(10, rng)
+    interner = RowInterner()
+    ids = interner.intern(rows[[0, 1, 2, 0, 1]])
+    assert ids[0] == ids[3] and ids[1] == ids[4]
+    assert len(interner) == 3
+    assert interner.stats()['hit_rate'] == 2 / 5
+    assert (interner.take(ids) != rows[[0, 1, 2, 0, 1]]).nnz == 0
+
+    # unsorted indices are canonicalized
+    row = rows[5].copy()
+    row.indices, row.data = row.indices[::-1].copy(), row.data[::-1].copy()
+    row.has_sorted_indices = False
+    assert interner.intern(row)[0] == interner.intern(rows[5])[0]
+
+    # rows are freed and compacted when they are not referenced
+    interner.decref(ids[:3])
+    assert len(interner) == 3
+    interner.decref(ids[3:])
+    assert len(interner) == 1
+    new_ids = interner.intern(rows[6:])
+    assert (interner.take(new_ids) != rows[6:]).nnz == 0
+    assert interner._arena.n_dead <= len(interner._arena) / 2
+
+
+def test_interned_row():
+    rng = np.random.RandomState(0)
+    rows = random_matrix(3, rng)
+    interner = RowInterner()
+    handles = interner.intern_rows(rows)
+    handles2 = interner.intern_rows(rows)
+    assert len(interner) == 3
+    assert (vstack_AS(handles[::-1]) != rows[::-1]).nnz == 0
+    restored = pickle.loads(pickle.dumps(handles[0]))
+    assert sparse.isspmatrix_csr(restored)
+    assert (restored != rows[0]).nnz == 0
+
+    del handles
+    gc.collect()
+    assert len(interner) == 3
+    del handles2
+    gc.collect()
+    assert len(interner) == 0
+
+
+class _GCArena(CSRArena):
+    """ Arena which runs a callback after append, like a gc pass would """
+    on_append = None
+
+    def append(self, m):
+        start = super().append(m)
+        callback, self.on_append = self.on_append, None
+        if callback is not None:
+            callback()
+        return start
+
+
+def test_release_during_intern():
+    rng = np.random.RandomState(0)
+    rows = random_matrix(5, rng)
+    arena = _GCArena()
+    interner = RowInterner(arena)
+    handles = interner.intern_rows(rows[:2])
+    # releasing both rows would compact the arena in the middle of intern
+    arena.on_append = handles.clear
+    ids = interner.intern(rows[2])
+    assert len(handles) == 0
+    assert len(interner) == 1
+    ids = np.concatenate([ids, interner.intern(rows[3:])])
+    assert (interner.take(ids) != rows[2:]).nnz == 0
+
+
+def test_interned_experience_memory(tmpdir):
+    rng = np.random.RandomState(0)
+    links = random_matrix(30, rng)
+    interner = RowInterner()
+    memory = ExperienceMemory(interner=interner, maxsize=50,
+                              eviction='oldest')
+    plain_memory = ExperienceMemory(maxsize=50, eviction='oldest')
+    examples = []
+    for _ in range(100):
+        as_t = interner.intern_rows(links[rng.randint(30, size=1)])[0]
+        AS_t1 = links[rng.randint(30, size=10)]
+        r_t1 = rng.rand()
+        memory.add(as_t, AS_t1, r_t1)
+        plain_memory.add(as_t.tocsr(), AS_t1, r_t1)
+        examples.append((as_t, AS_t1, r_t1))
+    assert len(interner) <= 30
+    assert memory.nbytes() < plain_memory.nbytes() / 2
+
+    indices = np.arange(len(memory))
+    for (as_t, AS_t1, r_t1), (as_t2, AS_t12, r_t12) in zip(
+            memory.get(indices), plain_memory.get(indices)):
+        assert r_t1 == r_t12
+
+    memory.save(str(tmpdir))
+    memory2 = ExperienceMemory(interner=RowInterner())
+    memory2.load(str(tmpdir))
+    for (as_t, AS_t1, r_t1), (as_t2, AS_t12, r_t12) in zip(
+            memory.get(indices), memory2.get(indices)):
+        assert (as_t != as_t2).nnz == 0
+        assert (AS_t1 != AS_t12).nnz == 0
+        assert r_t1 == r_t12
+
+    # rows are released when memory is cleared
+    del examples, as_t
+    memory.clear()
+    gc.collect()
+    assert len(interner) == 0
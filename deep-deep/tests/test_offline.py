@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import logging
+
+import joblib
+import networkx as nx
+import numpy as np
+import pytest
+
+from deepdeep.offline import (
+    load_pages, iter_transitions, pretrain, dump_policy, qlearner_params,
+)
+from deepdeep.qlearning import QLearner, FactoredAS
+from deepdeep.spiders.relevancy import KeywordRelevancySpider
+from deepdeep.vectorizers import LinkVectorizer, PageVectorizer
+
+
+ITEMS = [
+    {'url': 'http://example.com/',
+     'raw_content': '<a href="/good">good</a> <a href="/bad">bad</a> '
+                    '<a href="/pdf">pdf</a>'},
+    {'url': 'http://example.com/good',
+     'raw_content': '<a href="/">home</a> <a href="/bad">bad</a>'},
+    {'url': 'http://example.com/bad', 'raw_content': 'no links'},
+]
+
+
+def crawl_graph():
+    G = nx.DiGraph()
+    G.add_node(0, url='http://example.com/')  # seed
+    G.add_node(1, url='http://example.com/good', reward=1.0,
+               original_url='http://example.com/good')
+    G.add_node(2, url='http://example.com/bad', reward=0.0,
+               original_url='http://example.com/bad')
+    # non-html response
+    G.add_node(3, url='http://example.com/pdf', reward=0.0,
+               original_url='http://example.com/pdf')
+    # not visited
+    G.add_node(4, url='http://example.com/other',
+               original_url='http://example.com/other')
+    for parent, child in [(0, 1), (0, 2), (0, 3), (1, 4)]:
+        G.add_edge(parent, child)
+    return G
+
+
+def test_offline_pretrain(tmpdir):
+    link_vectorizer = LinkVectorizer()
+    page_vectorizer = PageVectorizer()
+    pages = load_pages(ITEMS, link_vectorizer, page_vectorizer, processes=2)
+    assert sorted(pages) == sorted(item['url'] for item in ITEMS)
+    assert pages['http://example.com/bad'].A is None
+
+    Q = QLearner(factored=True, replay_sample_size=2, steps_before_switch=2)
+    transitions = list(iter_transitions(crawl_graph(), pages, Q))
+    assert len(transitions) == 3
+    rewards = sorted(r_t1 for _, _, r_t1 in transitions)
+    assert rewards == [0.0, 0.0, 1.0]
+    for as_t, AS_t1, r_t1 in transitions:
+        assert isinstance(as_t, FactoredAS)
+        assert as_t.shape[0] == 1
+    n_links = {AS_t1.shape[0] if AS_t1 is not None else None
+               for _, AS_t1, _ in transitions}
+    assert n_links == {2, None}
+
+    assert pretrain(Q, transitions, epochs=4) == 6
+    assert Q.target_version_ == 4
+    path = str(tmpdir.join('Q-pretrained.joblib'))
+    dump_policy(path, Q, link_vectorizer, page_vectorizer, {'gamma': 0.4})
+    policy = joblib.load(path)
+    AS = transitions[0][1]
+    assert np.allclose(policy['Q'].predict(AS), Q.predict(AS))
+    assert len(policy['Q'].memory) == 0
+
+
+def test_qlearner_params():
+    params = qlearner_params({'gamma': '0.5', 'double': 0, 'eps': 0.1,
+                              'factored_as': 1, 'clf_backend': None})
+    assert params == {'gamma': 0.5, 'double_learning': False,
+                      'factored': True}
+    QLearner(**params)
+
+
+def test_warm_start_spider(tmpdir):
+    keywords_path = tmpdir.join('keywords.txt')
+    keywords_path.write('good\n')
+    spider = KeywordRelevancySpider(keywords_file=str(keywords_path))
+    pages = load_pages(ITEMS, spider.link_vectorizer, processes=1)
+    Q = QLearner(replay_sample_size=2)
+    transitions = list(iter_transitions(crawl_graph(), pages, Q))
+    pretrain(Q, transitions, epochs=2)
+    path = str(tmpdir.join('Q-pretrained.joblib'))
+    dump_policy(path, Q, spider.link_vectorizer, None, spider.get_params(),
+                pickle_memory=True)
+
+    spider = KeywordRelevancySpider(
+        keywords_file=str(keywords_path), warm_start_path=path,
+        warm_start_memory=1)
+    AS = transitions[0][1]
+    assert np.allclose(spider.Q.predict(AS), Q.predict(AS))
+    assert np.allclose(spider.Q.predict(AS, online=True),
+                       Q.predict(AS, online=True))
+    assert len(spider.Q.memory) == 3
+
+    with pytest.raises(ValueError):
+        KeywordRelevancySpider(
+            keywords_file=str(keywords_path), warm_start_path=path,
+            use_urls=1)
+
+
+def test_resume_replay_spider(tmpdir, caplog):
+    keywords_path = tmpdir.join('keywords.txt')
+    keywords_path.write('good\n')
+    checkpoint_path = tmpdir.join('checkpoint')
+    checkpoint_path.mkdir()
+    kwargs = dict(keywords_file=str(keywords_path), clf_backend='ftrl',
+                  checkpoint_path=str(checkpoint_path))
+    spider = KeywordRelevancySpider(checkpoint_replay=1, **kwargs)
+    pages = load_pages(ITEMS, spider.link_vectorizer, processes=1)
+    transitions = list(iter_transitions(crawl_graph(), pages, spider.Q))
+    pretrain(spider.Q, transitions, epochs=2)
+    spider.Q.t_ = 6
+    spider.dump_policy(checkpoint_path.join('Q-6.joblib'), False)
+    spider.dump_checkpoint_replay('Q-6.joblib')
+    AS = transitions[0][1]
+
+    # replay checkpoints are opt-in
+    caplog.set_level(logging.INFO)
+    assert len(KeywordRelevancySpider(**kwargs).Q.memory) == 0
+
+    resumed = KeywordRelevancySpider(checkpoint_replay=1, **kwargs)
+    assert resumed.Q.t_ == spider.Q.t_ == 6
+    assert len(resumed.Q.memory) == len(spider.Q.memory) == 3
+    assert np.allclose(resumed.Q.predict(AS), spider.Q.predict(AS))
+    assert 'Resuming from checkpoint' in caplog.text
+
+    # the replay is not restored without its policy
+    checkpoint_path.join('Q-6.joblib').remove()
+    resumed = KeywordRelevancySpider(checkpoint_replay=1, **kwargs)
+    assert resumed.Q.t_ == 0
+    assert len(resumed.Q.memory) == 0
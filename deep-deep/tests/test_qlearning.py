@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+import joblib
+import numpy as np
+import pytest
+from scipy import sparse
+
+from deepdeep.qlearning import (
+    QLearner, LinearScorer, FactoredAS, vstack_AS, ExperienceMemory,
+)
+from deepdeep.async_qlearning import AsyncQLearner, LearnerError
+
+
+N_FEATURES = 50
+
+
+def random_matrix(n_rows, rng):
+    return sparse.random(n_rows, N_FEATURES, density=0.2, format='csr',
+                         random_state=rng, dtype=np.float32)
+
+
+def fitted_qlearner(rng, **kwargs):
+    Q = QLearner(**kwargs)
+    Q.clf_online.partial_fit(random_matrix(20, rng), rng.rand(20))
+    Q._update_target_clf()
+    # make online and target Q functions different
+    Q.clf_online.partial_fit(random_matrix(20, rng), rng.rand(20))
+    return Q
+
+
+def Q_t1_values_loop(Q, AS_t1_list):
+    """ Reference (unbatched) implementation of Q._get_Q_t1_values """
+    values = np.zeros(len(AS_t1_list))
+    for idx, AS_t1 in enumerate(AS_t1_list):
+        if AS_t1 is not None and AS_t1.shape[0] > 0:
+            scores = Q.predict(AS_t1, online=True)
+            if Q.double_learning:
+                values[idx] = Q.predict_one(AS_t1[scores.argmax()])
+            else:
+                values[idx] = scores.max()
+    return values
+
+
+@pytest.mark.parametrize(['double_learning'], [[True], [False]])
+def test_get_Q_t1_values(double_learning):
+    rng = np.random.RandomState(0)
+    Q = fitted_qlearner(rng, double_learning=double_learning)
+    AS_t1_list = [random_matrix(n, rng) for n in [3, 1, 10, 0, 5]]
+    AS_t1_list.insert(2, None)
+    # duplicate rows: the first best action should be chosen
+    AS_t1_list.append(sparse.vstack([AS_t1_list[0]] * 2, format='csr'))
+    values = Q._get_Q_t1_values((len(AS_t1_list),), AS_t1_list)
+    assert values.shape == (len(AS_t1_list),)
+    assert values[2] == 0 and values[4] == 0
+    assert np.allclose(values, Q_t1_values_loop(Q, AS_t1_list))
+
+
+def test_get_Q_t1_values_empty():
+    Q = fitted_qlearner(np.random.RandomState(0))
+    assert np.array_equal(Q._get_Q_t1_values((2,), [None, None]), [0, 0])
+
+
+@pytest.mark.parametrize(['dtype'], [[np.float64], [np.float32]])
+def test_linear_scorer(dtype):
+    rng = np.random.RandomState(0)
+    Q = fitted_qlearner(rng)
+    scorer = LinearScorer.from_clf(Q.clf_online)
+    empty_row = sparse.csr_matrix((1, N_FEATURES))
+    X = sparse.vstack([random_matrix(3, rng), empty_row,
+                       random_matrix(5, rng)], format='csr').astype(dtype)
+    expected = Q.clf_online.predict(X)
+    assert np.allclose(scorer.predict(X), expected)
+    assert np.allclose(Q.predict(X, online=True), expected)
+    for row, value in zip(X, expected):
+        assert np.isclose(scorer.predict_one(row), value)
+        assert np.isclose(scorer.predict_row(row.indices, row.data), value)
+    assert np.isclose(Q.predict_one(X[0]), Q.clf_target.predict(X[0])[0])
+    assert LinearScorer.from_clf(QLearner().clf_online) is None
+
+
+def test_factored_as():
+    rng = np.random.RandomState(0)
+    Q = fitted_qlearner(rng)
+    n_a = 30
+    pages = []
+    for n_links in [3, 1, 7]:
+        A = random_matrix(n_links, rng)[:, :n_a]
+        s = random_matrix(1, rng)[:, n_a:]
+        joined = Q.join_As(A, s)
+        Q.factored = True
+        factored = Q.join_As(A, s)
+        Q.factored = False
+        assert isinstance(factored, FactoredAS)
+        assert factored.shape == joined.shape
+        assert (factored.tocsr() != joined).nnz == 0
+        pages.append((joined, factored))
+
+    for online in [True, False]:
+        for joined, factored in pages:
+            assert np.allclose(Q.predict(joined, online=online),
+                               Q.predict(factored, online=online))
+            assert np.isclose(Q.predict_one(joined[0], online=online),
+                              Q.predict_one(factored[0], online=online))
+
+    joined_list, factored_list = zip(*pages)
+    assert np.allclose(Q._get_Q_t1_values((3,), joined_list),
+                       Q._get_Q_t1_values((3,), factored_list))
+
+    # rows of the same page share the state vector
+    rows = list(factored_list[0]) + list(factored_list[2])[:2]
+    stacked = vstack_AS(rows)
+    assert isinstance(stacked, FactoredAS)
+    assert stacked.S.shape[0] == 2
+    expected = sparse.vstack([joined_list[0], joined_list[2][:2]])
+    assert (stacked.tocsr() != expected).nnz == 0
+
+    memory, factored_memory = ExperienceMemory(), ExperienceMemory()
+    for (joined, factored), (next_joined, next_factored) in zip(pages,
+                                                               pages[1:]):
+        memory.add(joined[0], next_joined, 1.0)
+        factored_memory.add(factored[0], next_factored, 1.0)
+    assert factored_memory.nbytes() < memory.nbytes()
+
+
+def test_lagged_double_learning_cache():
+    rng = np.random.RandomState(0)
+    Q = fitted_qlearner(rng, lagged_double_learning=True)
+    for _ in range(10):
+        Q.memory.add(random_matrix(1, rng), random_matrix(5, rng), 1.0)
+    Q.memory.add(random_matrix(1, rng), None, 0.0)
+    indices = np.arange(len(Q.memory))
+    AS_t1_list = [AS_t1 for _, AS_t1, _ in Q.memory.get(indices)]
+    values = Q._get_cached_Q_t1_values(indices, AS_t1_list)
+    assert np.allclose(values, Q_t1_values_loop(Q, AS_t1_list))
+
+    # online Q function changes, but cached values are used
+    # until the target Q function is switched
+    Q.clf_online.partial_fit(random_matrix(20, rng), rng.rand(20))
+    assert np.array_equal(Q._get_cached_Q_t1_values(indices, AS_t1_list),
+                          values)
+    cached, is_cached = Q.memory.get_cached_Q_t1(indices, Q.target_version_)
+    assert is_cached.all()
+
+    Q._update_target_clf()
+    _, is_cached = Q.memory.get_cached_Q_t1(indices, Q.target_version_)
+    assert not is_cached.any()
+    new_values = Q._get_cached_Q_t1_values(indices, AS_t1_list)
+    assert np.allclose(new_values, Q_t1_values_loop(Q, AS_t1_list))
+    assert not np.allclose(new_values, values)
+
+    # replaced observations are not cached
+    Q.memory.maxsize = len(Q.memory)
+    Q.memory.add(random_matrix(1, rng), random_matrix(5, rng), 1.0)
+    _, is_cached = Q.memory.get_cached_Q_t1(indices, Q.target_version_)
+    assert is_cached.sum() == len(indices) - 1
+
+
+def test_experience_memory_compaction():
+    rng = np.random.RandomState(0)
+    memory = ExperienceMemory(maxsize=10)
+    S = random_matrix(2, rng)
+    examples = []
+    for idx in range(100):
+        if idx % 2:
+            as_t = FactoredAS(random_matrix(1, rng), S, [0])
+            AS_t1 = FactoredAS(random_matrix(3, rng), S, [0, 1, 1])
+        else:
+            as_t = FactoredAS(random_matrix(1, rng), S, [1])
+            AS_t1 = None
+        memory.add(as_t, AS_t1, float(idx))
+        examples.append((as_t, AS_t1, float(idx)))
+    assert len(memory) == 10
+    # rows of replaced examples are removed from time to time
+    assert len(memory._actions) < 200
+    assert memory._actions.n_dead <= (memory.compact_ratio *
+                                      len(memory._actions))
+    # a shared state matrix is stored once
+    assert len(memory._states) == 2
+    by_reward = {r_t1: (as_t, AS_t1) for as_t, AS_t1, r_t1 in examples}
+    indices = np.arange(10)
+    for as_t, AS_t1, r_t1 in memory.get(indices):
+        expected_as_t, expected_AS_t1 = by_reward[r_t1]
+        assert (as_t.tocsr() != expected_as_t.tocsr()).nnz == 0
+        if expected_AS_t1 is None:
+            assert AS_t1 is None
+        else:
+            assert (AS_t1.tocsr() != expected_AS_t1.tocsr()).nnz == 0
+
+    AS_t1, indptr = memory.get_AS_t1(indices)
+    assert isinstance(AS_t1, FactoredAS)
+    assert AS_t1.S.shape[0] <= 2
+    lengths = [0 if by_reward[r][1] is None else 3
+               for r in memory.get_rewards(indices)]
+    assert list(np.diff(indptr)) == lengths
+    stacked_as_t = memory.get_as_t(indices).tocsr()
+    assert stacked_as_t.shape == (10, 2 * N_FEATURES)
+
+
+def test_mmap_experience_memory(tmpdir):
+    rng = np.random.RandomState(0)
+    memory = ExperienceMemory(path=str(tmpdir))
+    examples = [(random_matrix(1, rng), random_matrix(5, rng), float(idx))
+                for idx in range(20)]
+    for as_t, AS_t1, r_t1 in examples:
+        memory.add(as_t, AS_t1, r_t1)
+    assert tmpdir.listdir()
+    indices = np.array([3, 15, 7])
+    for (as_t, AS_t1, r_t1), idx in zip(memory.get(indices), indices):
+        assert (as_t != examples[idx][0]).nnz == 0
+        assert (AS_t1 != examples[idx][1]).nnz == 0
+        assert r_t1 == examples[idx][2]
+
+
+def _assert_same_examples(memory, memory2):
+    assert len(memory) == len(memory2)
+    indices = np.arange(len(memory))
+    for (as_t, AS_t1, r_t1), (as_t2, AS_t12, r_t12) in zip(
+            memory.get(indices), memory2.get(indices)):
+        assert (as_t.tocsr() != as_t2.tocsr()).nnz == 0
+        assert (AS_t1 is None) == (AS_t12 is None)
+        if AS_t1 is not None:
+            assert (AS_t1.tocsr() != AS_t12.tocsr()).nnz == 0
+        assert r_t1 == r_t12
+
+
+@pytest.mark.parametrize(['factored', 'mmap'], [
+    [False, False],
+    [True, False],
+    [True, True],
+])
+def test_experience_memory_save_load(tmpdir, factored, mmap):
+    rng = np.random.RandomState(0)
+    path = tmpdir.join('replay')
+    memory = ExperienceMemory(maxsize=30, prioritized=True)
+
+    def add(n):
+        for _ in range(n):
+            S = random_matrix(2, rng)
+            if factored:
+                as_t = FactoredAS(random_matrix(1, rng), S, [0])
+                AS_t1 = FactoredAS(random_matrix(3, rng), S, [1, 1, 0])
+            else:
+                as_t, AS_t1 = random_matrix(1, rng), random_matrix(3, rng)
+            memory.add(as_t, AS_t1, rng.rand())
+
+    add(20)
+    memory.save(str(path))
+    n_files = len(path.listdir())
+    # only new rows are saved
+    add(5)
+    memory.save(str(path))
+    chunks = {f.basename.split('.')[0] for f in path.listdir()
+              if f.basename.startswith('actions-')}
+    assert len(chunks) == 2
+    assert len(path.listdir()) > n_files
+    memory.update_priorities([3], [10.0])
+
+    add(100)  # replaced examples and compaction
+    memory.save(str(path))
+    memory2 = ExperienceMemory(prioritized=True,
+                               path=str(tmpdir.join('mmap')) if mmap else None)
+    memory2.load(str(path), mmap=mmap)
+    _assert_same_examples(memory, memory2)
+    indices = np.arange(len(memory))
+    assert np.allclose(memory._priorities[indices],
+                       memory2._priorities[indices])
+    assert memory2._actions.n_dead == memory._actions.n_dead
+
+    # loaded memory can be saved incrementally and changed
+    memory2.save(str(path))
+    memory2.add(*memory.get([0])[0])
+    assert len(memory2) == len(memory) + 1
+    memory3 = ExperienceMemory()
+    memory3.load(str(path))
+    _assert_same_examples(memory, memory3)
+
+
+@pytest.mark.parametrize(['factored', 'eviction'], [
+    [False, 'random'],
+    [False, 'oldest'],
+    [True, 'random'],
+    [True, 'lowest_priority'],
+])
+def test_experience_memory_maxbytes(factored, eviction):
+    rng = np.random.RandomState(0)
+    memory = ExperienceMemory(maxbytes=50000, eviction=eviction,
+                              prioritized=eviction == 'lowest_priority')
+    for idx in range(300):
+        S = random_matrix(1, rng)
+        n_links = rng.randint(0, 20)
+        if factored:
+            as_t = FactoredAS(random_matrix(1, rng), S, [0])
+            AS_t1 = FactoredAS(random_matrix(n_links, rng), S,
+                               np.zeros(n_links))
+        else:
+            as_t, AS_t1 = random_matrix(1, rng), random_matrix(n_links, rng)
+        memory.add(as_t, AS_t1, float(idx))
+        assert memory.nbytes() <= 50000
+        if memory.prioritized and len(memory) > 1:
+            memory.update_priorities([0], [rng.rand()])
+    assert 10 < len(memory) < 300
+
+    # bytes are counted incrementally, but match a full recount
+    copy = ExperienceMemory()
+    for as_t, AS_t1, r_t1 in memory.get(range(len(memory))):
+        copy.add(as_t, AS_t1, r_t1)
+    if not factored:
+        assert memory.nbytes() == copy.nbytes()
+    assert memory._actions.live_nbytes == copy._actions.live_nbytes
+    rewards = memory.get_rewards(np.arange(len(memory)))
+    if eviction == 'oldest':
+        assert sorted(rewards) == list(range(300 - len(memory), 300))
+
+
+def test_prioritized_replay():
+    rng = np.random.RandomState(0)
+    Q = QLearner(prioritized_replay=True, replay_sample_size=10,
+                 steps_before_switch=5)
+    for idx in range(20):
+        Q.add_experience(random_matrix(1, rng), random_matrix(3, rng), 0.0)
+    # a new observation gets the max priority
+    Q.memory.add(random_matrix(1, rng), random_matrix(3, rng), 1.0)
+    priorities = Q.memory._priorities[np.arange(len(Q.memory))]
+    assert priorities[-1] == priorities.max()
+
+    Q.memory.update_priorities([20], [100.0])
+    indices = Q.memory.sample_indices(1000)
+    assert indices.max() < len(Q.memory)
+    assert (indices == 20).mean() > 0.5
+    priorities = Q.memory._priorities[np.arange(len(Q.memory))]
+    weights = Q.memory.importance_weights(indices, beta=1.0)
+    assert weights.max() == 1
+    # observations with larger priorities get smaller weights
+    assert np.all(np.diff(weights[np.argsort(priorities[indices])]) <= 1e-12)
+
+
+def test_async_qlearner(tmpdir):
+    rng = np.random.RandomState(0)
+    switches = []
+    Q = AsyncQLearner(steps_before_switch=5, replay_sample_size=5,
+                      on_model_changed=lambda: switches.append(Q.t_))
+    try:
+        AS = random_matrix(4, rng)
+        assert np.allclose(Q.predict(AS), Q.initial_predictions)
+        for _ in range(12):
+            Q.add_experience(random_matrix(1, rng), random_matrix(3, rng),
+                             rng.rand())
+        Q.sync(timeout=60)
+        assert Q.target_version_ == 2
+        assert switches and switches[-1] == 12
+        assert len(Q.memory) == 12
+        assert Q.coef_norm(online=False) > 0
+
+        path = str(tmpdir.join('Q.joblib'))
+        Q.dump(path, {'Q': None, 'extra': 1}, pickle_memory=True)
+        Q.sync(timeout=60)
+        data = joblib.load(path)
+        assert data['extra'] == 1
+        assert len(data['Q'].memory) == 12
+        assert np.allclose(Q.predict(AS), data['Q'].predict(AS))
+    finally:
+        Q.close()
+
+
+def test_async_qlearner_error():
+    Q = AsyncQLearner(clf_backend='foo')
+    try:
+        with pytest.raises(LearnerError) as excinfo:
+            Q.sync(timeout=60)
+        assert 'Unknown clf_backend' in str(excinfo.value)
+        rng = np.random.RandomState(0)
+        with pytest.raises(LearnerError):
+            Q.add_experience(random_matrix(1, rng), random_matrix(3, rng), 1)
+    finally:
+        Q.close()
+
+
+def test_stratified_replay(tmpdir):
+    rng = np.random.RandomState(0)
+    memory = ExperienceMemory(stratified=True, maxsize=100)
+    for idx in range(300):
+        domain = 'big.com' if idx % 10 else 'small%d.com' % (idx % 30)
+        reward = 1.0 if domain == 'big.com' and idx % 7 == 0 else 0.0
+        memory.add(random_matrix(1, rng), random_matrix(3, rng), reward,
+                   domain=domain)
+    assert len(memory) == 100
+    keys = memory._sampler.keys
+    strata = [keys[s] for s in memory._sampler.strata(len(memory))]
+    rewards = memory.get_rewards(np.arange(len(memory)))
+    assert [bucket for _, bucket in strata] == (rewards > 0).tolist()
+
+    # large domain doesn't dominate the sample
+    indices = memory.sample_indices(8)
+    assert len(set(indices.tolist())) == 8
+    sampled_strata = [strata[idx] for idx in indices]
+    assert sampled_strata.count(('big.com', 0)) <= 2
+
+    memory.save(str(tmpdir))
+    memory2 = ExperienceMemory(stratified=True)
+    memory2.load(str(tmpdir))
+    keys2 = memory2._sampler.keys
+    assert [keys2[s] for s in memory2._sampler.strata(len(memory2))] == strata
+
+    with pytest.raises(ValueError):
+        ExperienceMemory(stratified=True, prioritized=True)
+
+
+@pytest.mark.parametrize(['stratified'], [[True], [False]])
+def test_warm_start_memory(stratified):
+    rng = np.random.RandomState(0)
+    kwargs = dict(clf_backend='ftrl', er_stratified=stratified,
+                  prioritized_replay=not stratified)
+    Q = QLearner(**kwargs)
+    for idx in range(20):
+        Q.memory.add(random_matrix(1, rng), random_matrix(3, rng),
+                     float(idx % 3 == 0), domain='d%d.com' % (idx % 4))
+    if not stratified:
+        Q.memory.update_priorities(np.arange(20), rng.rand(20))
+    Q.fit_iteration(5)
+    Q._update_target_clf()
+
+    Q2 = QLearner(**kwargs)
+    Q2.warm_start(Q, memory=True)
+    assert len(Q2.memory) == 20
+    assert Q2.memory.get_rewards(np.arange(20)).tolist() == \
+        Q.memory.get_rewards(np.arange(20)).tolist()
+    if stratified:
+        def strata(memory):
+            keys = memory._sampler.keys
+            return [keys[s] for s in memory._sampler.strata(len(memory))]
+        assert strata(Q2.memory) == strata(Q.memory)
+        assert ('d1.com', 1) in strata(Q2.memory)
+    else:
+        assert np.allclose(Q2.memory._priorities[np.arange(20)],
+                           Q.memory._priorities[np.arange(20)])
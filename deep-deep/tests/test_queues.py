@@ -1,7 +1,17 @@
 # -*- coding: utf-8 -*-
+import random
+
+import numpy as np
 import scrapy  # type: ignore
+from scipy import sparse
 
-from deepdeep.queues import RequestsPriorityQueue
+from deepdeep.queues import (
+    RequestsPriorityQueue, BalancedPriorityQueue, FrontierVectors,
+    FLOAT_PRIORITY_MULTIPLIER,
+)
+from deepdeep.qlearning import LinearScorer
+from deepdeep.spill import SpillStore
+from deepdeep.utils import softmax
 
 
 def test_request_priority_queue():
@@ -12,7 +22,7 @@ def test_request_priority_queue():
     q.push(scrapy.Request('http://example.com/2', priority=2))
     q.push(scrapy.Request('http://example.com/0', priority=0))
 
-    assert -q.entries[0][0] == 2
+    assert q.max_priority() == 2
     assert len(q) == 5
 
     assert q.pop().url == "http://example.com/2"
@@ -40,3 +50,353 @@ def test_rpq_pop_random():
 
     assert {req1.url, req2.url, req3.url} == {r.url for r in requests}
     assert q.pop_random() is None
+
+
+def test_rpq_update_priorities():
+    q = RequestsPriorityQueue(fifo=True)
+    for idx in range(5):
+        q.push(scrapy.Request('http://example.com/%d' % idx, priority=idx))
+    q.maxsize = 3
+    q.update_all_priorities(
+        lambda requests: [-int(r.url.rsplit('/', 1)[1]) for r in requests])
+    assert len(q) == 3
+    assert q.max_priority() == 0
+    assert [q.pop().url for _ in range(3)] == [
+        'http://example.com/0', 'http://example.com/1', 'http://example.com/2']
+    assert q.pop() is None
+
+    handles = [q.push(scrapy.Request('http://example.com/%d' % idx,
+                                     priority=0)) for idx in range(3)]
+    q.update_priorities(handles[1:], [2, 1])
+    q.change_priority(handles[0], 3)
+    assert [q.pop().priority for _ in range(3)] == [3, 2, 1]
+
+
+def test_rpq_maxsize():
+    rng = random.Random(0)
+    vectors = FrontierVectors()
+    q = RequestsPriorityQueue(fifo=True, maxsize=10, vectors=vectors)
+    evicted = []
+    q.on_evict = evicted.append
+    pushed = []
+    for idx in range(200):
+        request = scrapy.Request(
+            'http://example.com/%d' % idx, priority=rng.randint(0, 20),
+            meta={'link_vector': sparse.csr_matrix([[idx, 0, 1]])})
+        pushed.append(request)
+        q.push(request)
+        assert len(q) == min(idx + 1, 10)
+        if idx % 7 == 0:
+            q.change_priority(next(q.iter_active_entries()),
+                              rng.randint(0, 20))
+    assert q.n_evicted == sum(evicted) == 190
+    assert len(vectors.arena) - vectors.arena.n_dead == 10
+    assert q._n_entries() <= 2 * len(q) + 10
+
+    # a request which would be popped last is dropped
+    expected = sorted(
+        q.iter_requests(),
+        key=lambda r: (-r.priority, int(r.url.rsplit('/', 1)[1])))[:9]
+    low = scrapy.Request('http://example.com/low', priority=-1)
+    assert q.push(low) == -1
+    assert q.push(scrapy.Request('http://example.com/high',
+                                 priority=100)) >= 0
+    assert q.n_evicted == 192
+    popped = [q.pop() for _ in range(10)]
+    assert popped[0].url == 'http://example.com/high'
+    keys = [(-r.priority, int(r.url.rsplit('/', 1)[1])) for r in popped[1:]]
+    assert keys == sorted(keys)
+    assert {r.url for r in popped[1:]} == {r.url for r in expected}
+    for request in popped[1:]:
+        idx = int(request.url.rsplit('/', 1)[1])
+        assert request.meta['link_vector'].toarray().tolist() == [[idx, 0, 1]]
+    assert q.pop() is None
+
+
+def test_rpq_tombstones():
+    rng = random.Random(0)
+    q = RequestsPriorityQueue(fifo=False)
+    for idx in range(1000):
+        q.push(scrapy.Request('http://example.com/%d' % idx,
+                              priority=rng.randint(0, 10)))
+        if idx % 3 == 0:
+            assert q.pop_random() is not None
+    assert len(q) == 666
+    assert len(set(q.iter_active_entries())) == 666
+    # tombstones are compacted
+    assert q._n_entries() <= 2 * len(q) + 1
+    # requests with equal priorities are popped in LIFO order
+    popped = [q.pop() for _ in range(len(q))]
+    keys = [(-r.priority, -int(r.url.rsplit('/', 1)[1])) for r in popped]
+    assert keys == sorted(keys)
+    assert q.pop() is None
+    assert q.max_priority() == q.EMPTY_PRIORITY
+
+
+def test_balanced_queue_weights():
+    queue = BalancedPriorityQueue(lambda slot: RequestsPriorityQueue(),
+                                  batch_size=10)
+
+    def push(slot, score):
+        queue.push(scrapy.Request(
+            'http://%s/%s' % (slot, score),
+            priority=int(score * FLOAT_PRIORITY_MULTIPLIER),
+            meta={'scheduler_slot': slot}))
+
+    def weights():
+        queue._update_weights()
+        slots = sorted(queue.queues)
+        w = queue._weights[[queue._slot_ids[slot] for slot in slots]]
+        return dict(zip(slots, w / queue._weights.total))
+
+    def expected_weights():
+        slots = sorted(queue.queues)
+        p = softmax([queue.queues[slot].max_priority() for slot in slots],
+                    t=FLOAT_PRIORITY_MULTIPLIER)
+        return dict(zip(slots, p))
+
+    def check_weights():
+        w, expected = weights(), expected_weights()
+        assert sorted(w) == sorted(expected)
+        for slot in w:
+            assert np.isclose(w[slot], expected[slot])
+
+    push('a', 1.0)
+    push('a', 0.5)
+    push('b', 0.0)
+    push('c', -1.0)
+    check_weights()
+    # weights are updated when top requests are changed
+    queue.get_queue('a').pop()
+    check_weights()
+    push('c', 2.0)
+    check_weights()
+    queue.get_queue('c').update_all_priorities(
+        lambda requests: [r.priority - 20000 for r in requests])
+    check_weights()
+    # priorities much larger than before
+    push('b', 1000.0)
+    check_weights()
+    assert np.isclose(weights()['b'], 1.0)
+    queue.get_queue('b').pop()
+    check_weights()
+
+    b_id = queue._slot_ids['b']
+    assert queue.close_queue('b') == 1
+    check_weights()
+    push('d', 0.0)
+    assert queue._slot_ids['d'] == b_id
+    check_weights()
+
+    # empty queues are not sampled
+    queue.get_queue('a').pop()
+    counts = {}
+    for _ in range(100):
+        request = queue.pop()
+        slot = request.meta['scheduler_slot']
+        counts[slot] = counts.get(slot, 0) + 1
+        push(slot, 0.0)
+    assert 'a' not in counts
+    assert counts['c'] > 0 and counts['d'] > 0
+
+
+def test_balanced_queue_spill(tmpdir):
+    rng = np.random.RandomState(0)
+    vectors = FrontierVectors()
+    queue = BalancedPriorityQueue(
+        lambda slot: RequestsPriorityQueue(vectors=vectors),
+        batch_size=1, spill=SpillStore(str(tmpdir)))
+    queue.spill_idle_batches = 2
+    links = {}
+
+    def push(slot, idx, score):
+        url = 'http://%s/%d' % (slot, idx)
+        links[url] = sparse.random(1, 10, density=0.5, format='csr',
+                                   random_state=rng)
+        queue.push(scrapy.Request(
+            url, priority=int(score * FLOAT_PRIORITY_MULTIPLIER),
+            meta={'scheduler_slot': slot, 'link_vector': links[url]}))
+
+    for slot, score in [('a', 10), ('b', -10), ('c', -10)]:
+        for idx in range(3):
+            push(slot, idx, score + idx)
+
+    # b and c are not chosen, so they are spilled
+    for _ in range(3):
+        assert queue.pop().meta['scheduler_slot'] == 'a'
+    assert queue.n_spilled_slots == 2
+    assert queue.n_spilled_requests == 6
+    assert len(queue) == 6
+    assert sorted(queue.queues) == ['a']
+    assert len(vectors.arena) - vectors.arena.n_dead == 0
+
+    # new requests of a spilled queue are kept in memory until it is read
+    push('b', 3, -5)
+    assert len(queue) == 7
+    q = queue.get_queue('b')
+    assert len(q) == 4
+    assert queue.n_spilled_slots == 1
+    assert q.max_priority() == -5 * FLOAT_PRIORITY_MULTIPLIER
+    urls = []
+    while len(q):
+        request = q.pop()
+        urls.append(request.url)
+        assert (request.meta['link_vector'] != links[request.url]).nnz == 0
+    assert urls == ['http://b/3', 'http://b/2', 'http://b/1', 'http://b/0']
+
+    assert queue.close_queue('c') == 3
+    assert queue.n_spilled_requests == 0
+    assert len(queue) == 0
+    assert queue.pop() is None
+
+
+def test_balanced_queue_random_policy(tmpdir):
+    np.random.seed(0)
+    queue = BalancedPriorityQueue(lambda slot: RequestsPriorityQueue(),
+                                  eps=0.5, batch_size=10,
+                                  spill=SpillStore(str(tmpdir)))
+    queue.spill_min_probability = 0
+    queue.spill_idle_batches = 10 ** 6
+
+    def push(slot, idx, score):
+        queue.push(scrapy.Request(
+            'http://%s/%d' % (slot, idx),
+            priority=int(score * FLOAT_PRIORITY_MULTIPLIER),
+            meta={'scheduler_slot': slot}))
+
+    for idx in range(300):
+        push('a', idx, 0)
+    for slot in range(100):
+        for idx in range(10):
+            push('x%d' % slot, idx, -20)
+    # most slot ids are free, and some queues are spilled
+    for slot in range(90):
+        queue.close_queue('x%d' % slot)
+    for slot in range(90, 95):
+        queue._spill_queue(queue._slot_ids['x%d' % slot])
+    assert sorted(queue._resident_ids) == sorted(
+        queue._slot_ids[slot] for slot in queue.queues)
+
+    requests = [queue.pop() for _ in range(200)]
+    n_random = sum(r.meta.get('from_random_policy', False) for r in requests)
+    # random requests are not lost on free slot ids
+    assert n_random > 0.25 * len(requests)
+    # random requests don't read spilled queues back
+    assert queue.n_spilled_slots == 5
+    slots = {r.meta['scheduler_slot'] for r in requests}
+    assert {'x%d' % slot for slot in range(95, 100)} <= slots
+
+
+def test_frontier_vectors():
+    rng = np.random.RandomState(0)
+    vectors = FrontierVectors()
+    queue = BalancedPriorityQueue(
+        lambda slot: RequestsPriorityQueue(vectors=vectors))
+    links = {}
+    for idx in range(200):
+        url = 'http://example%d.com/%d' % (idx % 3, idx)
+        meta = {'scheduler_slot': 'example%d.com' % (idx % 3)}
+        if idx % 50:
+            meta['link_vector'] = links[url] = sparse.random(
+                1, 20, density=0.3, format='csr', random_state=rng)
+        queue.push(scrapy.Request(url, priority=-idx, meta=meta))
+    assert len(vectors.arena) == 196
+    for slot in ['example0.com', 'example1.com']:
+        for _ in range(40):
+            queue.get_queue(slot).pop_random()
+    assert vectors.arena.n_dead <= len(vectors.arena) / 2
+
+    coef = rng.rand(20)
+    row_scores = vectors.score(lambda X: X.dot(coef), chunk_size=16)
+    for slot in queue.get_active_slots():
+        q = queue.get_queue(slot)
+        old, new = q.rescore(row_scores.__getitem__)
+        assert len(old) == len(new) == len(q)
+    queue.close_queue('example2.com')
+
+    n_requests = 0
+    while True:
+        request = queue.pop()
+        if request is None:
+            break
+        n_requests += 1
+        url = request.url
+        if url in links:
+            vector = request.meta['link_vector']
+            assert (vector != links[url]).nnz == 0
+            assert request.priority == int(
+                vector.dot(coef)[0] * FLOAT_PRIORITY_MULTIPLIER)
+        else:
+            assert 'link_vector' not in request.meta
+            assert request.priority == -int(url.rsplit('/', 1)[1])
+    assert n_requests == 200 - 80 - 66
+    assert vectors.nbytes() == 0
+
+
+def test_frontier_selective_rescoring():
+    rng = np.random.RandomState(0)
+    vectors = FrontierVectors()
+    vectors.delta_tol = 0
+    queues = [RequestsPriorityQueue(vectors=vectors) for _ in range(2)]
+    X = sparse.random(60, 20, density=0.1, format='csr', random_state=rng)
+    for idx in range(60):
+        queues[idx % 2].push(scrapy.Request(
+            'http://example.com/%d' % idx, meta={'link_vector': X[idx]}))
+
+    def update(coef, intercept=0.5):
+        scores, rows = vectors.update_scores(LinearScorer(coef, intercept))
+        for queue, handles, queue_rows in vectors.rows_by_queue(rows):
+            queue.update_scores(handles, scores[queue_rows])
+        return scores, rows
+
+    def check_priorities(coef, intercept=0.5):
+        for queue in queues:
+            for request in queue.iter_requests():
+                idx = int(request.url.rsplit('/', 1)[1])
+                score = X[idx].dot(coef)[0] + intercept
+                assert abs(request.priority -
+                           score * FLOAT_PRIORITY_MULTIPLIER) <= 1
+
+    coef = rng.randn(20)
+    scores, rows = update(coef)
+    assert rows.tolist() == list(range(60))
+    assert np.allclose(scores, X.dot(coef) + 0.5)
+    check_priorities(coef)
+
+    # only rows with changed features are rescored
+    coef[[3, 7]] += 1.0
+    scores, rows = update(coef)
+    assert rows.tolist() == np.flatnonzero(X[:, [3, 7]].getnnz(axis=1)).tolist()
+    assert np.allclose(scores, X.dot(coef) + 0.5)
+    check_priorities(coef)
+
+    # small changes are postponed until they accumulate
+    vectors.delta_tol = 0.5
+    coef[5] += 0.3
+    scores, rows = update(coef)
+    assert len(rows) == 0
+    coef[5] += 0.3
+    scores, rows = update(coef)
+    assert rows.tolist() == np.flatnonzero(X[:, 5].getnnz(axis=1)).tolist()
+    check_priorities(coef)
+
+    # an intercept change affects all rows
+    scores, rows = update(coef, intercept=1.5)
+    assert len(rows) == 60
+    check_priorities(coef, intercept=1.5)
+
+    # compaction and rows appended after the index is built
+    while len(queues[0]):
+        queues[0].pop()
+    queues[1].pop()
+    assert vectors.arena.n_dead == 0
+    for idx in range(10):
+        queues[0].push(scrapy.Request(
+            'http://example.com/%d' % idx, meta={'link_vector': X[idx]}))
+    scores, rows = update(coef, intercept=1.5)
+    assert len(rows) == 10
+    check_priorities(coef, intercept=1.5)
+    exact_scores, live_rows = vectors.reset_scores(
+        LinearScorer(coef, 1.5))
+    assert len(live_rows) == 39
+    assert np.allclose(scores[live_rows], exact_scores[live_rows])
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import scrapy  # type: ignore
+
+from deepdeep.queues import RequestsPriorityQueue, BalancedPriorityQueue
+from deepdeep.rescheduling import IncrementalRescheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+
+def _queue():
+    queue = BalancedPriorityQueue(lambda slot: RequestsPriorityQueue())
+    for domain, priority, size in [('a', 1, 2), ('b', 5, 3), ('c', 3, 5)]:
+        for idx in range(size):
+            queue.push(scrapy.Request(
+                'http://%s.com/%d' % (domain, idx), priority=priority,
+                meta={'scheduler_slot': domain}))
+    return queue
+
+
+def test_incremental_rescheduler():
+    queue = _queue()
+    clock = FakeClock()
+    rescored = []
+    passes = []
+
+    def rescore(q):
+        # each queue takes 0.01s to rescore
+        clock.time += 0.01
+        rescored.append(q.next_request.url.split('/')[2])
+        old = np.array([r.priority for r in q.iter_requests()], dtype=float)
+        q.update_all_priorities(lambda requests: [-1] * len(requests))
+        return old, np.full_like(old, -1)
+
+    rescheduler = IncrementalRescheduler(
+        queue, rescore, time_slice=0.015, clock=clock,
+        on_pass_done=lambda old, new: passes.append((old, new)))
+    assert rescheduler.step() == 0
+    assert rescheduler.progress() == 1.0
+    assert rescheduler.staleness() == 0.0
+
+    rescheduler.start()
+    assert rescheduler.in_progress
+    assert rescheduler.staleness() == 1.0
+    assert rescheduler.progress() == 0.0
+
+    # queues with higher top priority are rescored first
+    assert rescheduler.step() == 8
+    assert rescored == ['b.com', 'c.com']
+    assert rescheduler.progress() == 0.8
+    assert abs(rescheduler.staleness() - 0.2) < 1e-9
+    assert not passes
+
+    assert rescheduler.step() == 2
+    assert rescored == ['b.com', 'c.com', 'a.com']
+    assert not rescheduler.in_progress
+    assert rescheduler.staleness() == 0.0
+    assert rescheduler.n_passes == 1
+    assert len(passes) == 1
+    old, new = passes[0]
+    assert sorted(np.concatenate(old).tolist()) == [1] * 2 + [3] * 5 + [5] * 3
+    assert np.concatenate(new).tolist() == [-1] * 10
+    assert queue.get_queue('b').max_priority() == -1
+
+    # a new model switch restarts an unfinished pass
+    rescored.clear()
+    rescheduler.start()
+    rescheduler.step()
+    rescheduler.start()
+    assert rescheduler.version == 3
+    assert rescheduler.progress() == 0.0
+    while rescheduler.in_progress:
+        rescheduler.step()
+    assert sorted(rescored[2:]) == ['a.com', 'b.com', 'c.com']
+    assert rescheduler.n_passes == 2
+    assert rescheduler.info() == {
+        'progress': 1.0, 'staleness': 0.0, 'passes': 2, 'version': 3}
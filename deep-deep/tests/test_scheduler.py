@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import scrapy  # type: ignore
+from scrapy.dupefilters import RFPDupeFilter  # type: ignore
+from scrapy.http import HtmlResponse  # type: ignore
+from scrapy.spidermiddlewares.referer import RefererMiddleware  # type: ignore
+
+from deepdeep.queues import BalancedPriorityQueue, RequestsPriorityQueue
+from deepdeep.scheduler import Scheduler, CompactRequest
+
+
+def test_compact_request():
+    request = scrapy.Request('http://example.com/a b', priority=5,
+                             meta={'scheduler_slot': 'example.com'})
+    compact = CompactRequest.from_request(request)
+    assert isinstance(compact, CompactRequest)
+    restored = compact.to_request()
+    assert restored.url == request.url == 'http://example.com/a%20b'
+    assert restored.priority == 5
+    assert restored.meta == request.meta
+
+    for kwargs in [dict(method='POST'), dict(headers={'X-Foo': 'bar'}),
+                   dict(callback=len), dict(dont_filter=True)]:
+        request = scrapy.Request('http://example.com', **kwargs)
+        assert CompactRequest.from_request(request) is request
+
+
+def test_compact_request_referer():
+    response = HtmlResponse('http://example.com/page', body=b'<html></html>')
+    requests = [
+        scrapy.Request('http://example.com/%d' % idx, priority=idx,
+                       meta={'scheduler_slot': 'example.com'})
+        for idx in range(3)]
+    requests = list(RefererMiddleware().process_spider_output(
+        response, requests, spider=None))
+    for request in requests:
+        assert request.headers.get('Referer') == b'http://example.com/page'
+        compact = CompactRequest.from_request(request)
+        assert isinstance(compact, CompactRequest)
+        restored = compact.to_request()
+        assert restored.url == request.url
+        assert restored.priority == request.priority
+        assert restored.headers == request.headers
+
+    request = requests[0].replace(headers={'Referer': 'http://example.com',
+                                           'X-Foo': 'bar'})
+    assert CompactRequest.from_request(request) is request
+
+
+class DummyStats:
+    def __init__(self):
+        self.values = {}
+
+    def inc_value(self, key, count=1, **kwargs):
+        self.values[key] = self.values.get(key, 0) + count
+
+
+def test_scheduler_compact_requests():
+    scheduler = Scheduler(dupefilter=RFPDupeFilter(), stats=DummyStats())
+    scheduler.open(spider=None)
+    scheduler.enqueue_request(scrapy.Request('http://example.com/1',
+                                             priority=1))
+    scheduler.enqueue_request(scrapy.Request('http://example.com/2',
+                                             priority=2, method='POST'))
+    assert len(scheduler.queue) == 2
+    assert all(isinstance(request, CompactRequest) or
+               request.method == 'POST'
+               for request in scheduler.queue.iter_requests())
+    request = scheduler.next_request()
+    assert isinstance(request, scrapy.Request)
+    assert (request.url, request.method) == ('http://example.com/2', 'POST')
+    request = scheduler.next_request()
+    assert type(request) is scrapy.Request
+    assert (request.url, request.priority) == ('http://example.com/1', 1)
+    assert scheduler.next_request() is None
+    assert not scheduler.has_pending_requests()
+
+
+class BoundedQueueSpider:
+    def get_scheduler_queue(self):
+        return BalancedPriorityQueue(
+            lambda slot: RequestsPriorityQueue(maxsize=2))
+
+
+def test_scheduler_counts_evicted():
+    stats = DummyStats()
+    scheduler = Scheduler(dupefilter=RFPDupeFilter(), stats=stats)
+    scheduler.open(spider=BoundedQueueSpider())
+    for idx in range(5):
+        scheduler.enqueue_request(scrapy.Request(
+            'http://example.com/%d' % idx, priority=idx,
+            meta={'scheduler_slot': 'example.com'}))
+    assert len(scheduler.queue) == 2
+    assert stats.values['custom-scheduler/enqueued/'] == 5
+    assert stats.values['custom-scheduler/dropped/'] == 3
+    assert [scheduler.next_request().url for _ in range(2)] == [
+        'http://example.com/4', 'http://example.com/3']
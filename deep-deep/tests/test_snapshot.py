@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+import scrapy  # type: ignore
+from scrapy.http import HtmlResponse  # type: ignore
+from scrapy.spidermiddlewares.referer import RefererMiddleware  # type: ignore
+from scipy import sparse
+
+from deepdeep.queues import (
+    RequestsPriorityQueue, BalancedPriorityQueue, FrontierVectors,
+    FLOAT_PRIORITY_MULTIPLIER,
+)
+from deepdeep.scheduler import CompactRequest
+from deepdeep.spill import SpillStore
+
+
+def _new_queue(spill=None):
+    vectors = FrontierVectors()
+    return BalancedPriorityQueue(
+        lambda slot: RequestsPriorityQueue(vectors=vectors),
+        batch_size=2, spill=spill)
+
+
+def _pop_all(queue):
+    requests = []
+    while True:
+        request = queue.pop()
+        if request is None:
+            return requests
+        requests.append(request)
+
+
+def test_frontier_snapshot(tmpdir):
+    rng = np.random.RandomState(0)
+    queue = _new_queue(spill=SpillStore(str(tmpdir.join('spill'))))
+    links = {}
+    for idx in range(20):
+        slot = 'a' if idx < 8 else 'b'
+        url = 'http://%s/%d' % (slot, idx)
+        meta = {'scheduler_slot': slot, 'depth': idx}
+        if idx % 5:
+            meta['link_vector'] = links[url] = sparse.random(
+                1, 10, density=0.5, format='csr', random_state=rng)
+        score = 10 if slot == 'a' else -10
+        priority = score * FLOAT_PRIORITY_MULTIPLIER - idx
+        queue.push(scrapy.Request(url, priority=priority, meta=meta))
+    queue.push(scrapy.Request('http://c/0', meta={'scheduler_slot': 'c'}))
+    queue.close_queue('c')
+    queue.push(scrapy.Request('http://a/callback', callback=len,
+                              meta={'scheduler_slot': 'a'}))
+
+    # a request is left in the pop buffer, and b is spilled
+    for _ in range(5):
+        assert queue.pop().meta['scheduler_slot'] == 'a'
+    assert queue.n_spilled_requests == 12
+    assert len(queue) == 16
+
+    # requests with callbacks are not saved
+    path = str(tmpdir.join('frontier.bin'))
+    assert queue.save(path, chunk_size=4) == 15
+    restored = _new_queue()
+    assert restored.load(path) == 15
+    assert restored.closed_slots == {'c'}
+    assert len(restored) == 15
+
+    expected = {request.url: request for request in _pop_all(queue)
+                if request.callback is None}
+    requests = _pop_all(restored)
+    assert sorted(r.url for r in requests) == sorted(expected)
+    for request in requests:
+        assert isinstance(request, CompactRequest)
+        original = expected[request.url]
+        assert request.priority == original.priority
+        assert request.meta['depth'] == original.meta['depth']
+        assert (request.meta['scheduler_slot'] ==
+                original.meta['scheduler_slot'])
+        if request.url in links:
+            vector = request.meta['link_vector']
+            assert (vector != links[request.url]).nnz == 0
+        else:
+            assert 'link_vector' not in request.meta
+
+    data = open(path, 'rb').read()
+    truncated = tmpdir.join('truncated.bin')
+    truncated.write_binary(data[:len(data) // 2])
+    with pytest.raises(ValueError):
+        _new_queue().load(str(truncated))
+
+
+def test_frontier_snapshot_headers(tmpdir):
+    response = HtmlResponse('http://a/page', body=b'<html></html>')
+    links = [scrapy.Request('http://a/%d' % idx, priority=idx,
+                            meta={'scheduler_slot': 'a'})
+             for idx in range(5)]
+    links = list(RefererMiddleware().process_spider_output(
+        response, links, spider=None))
+    links[0] = links[0].replace(headers={'Referer': 'http://a/page',
+                                         'X-Foo': 'bar'},
+                                dont_filter=True)
+    links[1] = CompactRequest.from_request(links[1])
+    queue = _new_queue()
+    for request in links:
+        queue.push(request)
+
+    # requests with headers are saved, not only seeds
+    path = str(tmpdir.join('frontier.bin'))
+    assert queue.save(path) == 5
+    restored = _new_queue()
+    assert restored.load(path) == 5
+    requests = {r.url: r for r in _pop_all(restored)}
+    assert sorted(requests) == sorted(r.url for r in links)
+    for url in ['http://a/1', 'http://a/2', 'http://a/3', 'http://a/4']:
+        assert isinstance(requests[url], CompactRequest)
+        request = requests[url].to_request()
+        assert request.headers.get('Referer') == b'http://a/page'
+    request = requests['http://a/0']
+    assert type(request) is scrapy.Request
+    assert request.headers.get('X-Foo') == b'bar'
+    assert request.headers.get('Referer') == b'http://a/page'
+    assert request.dont_filter
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import random
+
+import scrapy  # type: ignore
+from scipy import sparse  # type: ignore
+
+from deepdeep.interning import RowInterner
+from deepdeep.scheduler import CompactRequest
+from deepdeep.spill import SpillStore
+
+
+def test_spill_store(tmpdir):
+    store = SpillStore(str(tmpdir), segment_size=1000)
+    interner = RowInterner()
+    vector = sparse.csr_matrix([[0, 1.5, 0, 2]])
+    requests = [
+        CompactRequest('http://example.com/%d' % idx, idx,
+                       {'link_vector': interner.intern_rows(vector)[0]})
+        for idx in range(5)]
+    location = store.write(requests)
+    other = store.write([scrapy.Request('http://example.com/page')])
+    restored = store.read(location)
+    assert [r.url for r in restored] == [r.url for r in requests]
+    assert [r.priority for r in restored] == list(range(5))
+    assert (restored[0].meta['link_vector'] != vector).nnz == 0
+    assert store.read(other)[0].url == 'http://example.com/page'
+    store.free(location)
+    store.free(other)
+
+    # a segment is removed when all its records are free
+    rng = random.Random(0)
+    locations = [
+        store.write([CompactRequest(
+            'http://example.com/%x' % rng.getrandbits(2000), idx, {})])
+        for idx in range(5)]
+    assert store.n_segments > 1
+    for location in locations[:-1]:
+        store.free(location)
+    assert store.n_segments == 1
+    assert store.read(locations[-1])[0].priority == 4
+
+    assert not store.can_store(scrapy.Request('http://example.com',
+                                              callback=lambda r: None))
+    store.close()
+    assert not tmpdir.listdir()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from deepdeep.stratified import StratifiedSampler
+
+
+def test_stratified_sampler():
+    rng = np.random.RandomState(0)
+    sampler = StratifiedSampler()
+    strata = []
+    for idx in range(200):
+        key = 'big' if idx % 10 else 'small-%d' % (idx % 20)
+        sampler.add(idx, key)
+        strata.append(key)
+    assert sampler.n_strata == 3
+
+    # swap-remove random examples, like ExperienceMemory does
+    size = len(strata)
+    for _ in range(100):
+        idx = rng.randint(size)
+        sampler.remove(idx)
+        size -= 1
+        if idx != size:
+            sampler.move(size, idx)
+        strata[idx] = strata.pop()
+    keys = [sampler.keys[s] for s in sampler.strata(size)]
+    assert keys == strata
+
+    sample = sampler.sample(30)
+    assert len(set(sample.tolist())) == len(sample) == 30
+    assert sample.max() < size
+    counts = {key: 0 for key in set(strata)}
+    for idx in sample:
+        counts[strata[idx]] += 1
+    # each stratum gets at least an equal share, unless it is smaller
+    for key, count in counts.items():
+        assert count >= min(strata.count(key), 30 // 3)
+
+    # small samples take at most one example from a stratum
+    sample = sampler.sample(2)
+    assert len({strata[idx] for idx in sample}) == 2
+
+    sampler.clear()
+    assert sampler.n_strata == 0
+    assert len(sampler.sample(10)) == 0
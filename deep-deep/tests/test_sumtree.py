@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from deepdeep.sumtree import SumTree
+
+
+def test_sumtree_update():
+    rng = np.random.RandomState(0)
+    tree = SumTree(capacity=4)
+    priorities = rng.rand(100)
+    tree.update(np.arange(100), priorities)
+    assert len(tree) == 100
+    assert np.isclose(tree.total, priorities.sum())
+    priorities[[5, 50, 99]] = [10, 0, 3]
+    tree.update([5, 50, 99], [10, 0, 3])
+    assert np.isclose(tree.total, priorities.sum())
+    assert np.allclose(tree[np.arange(100)], priorities)
+
+    cumsum = np.cumsum(priorities)
+    values = rng.uniform(0, tree.total, size=1000)
+    assert np.array_equal(tree.find(values),
+                          np.searchsorted(cumsum, values, side='right'))
+
+
+def test_sumtree_sample():
+    rng = np.random.RandomState(0)
+    tree = SumTree()
+    tree.update([0, 1, 2, 3], [1, 0, 2, 7])
+    counts = np.bincount(tree.sample(10000, rng), minlength=4)
+    assert counts[1] == 0
+    assert np.allclose(counts / 10000, [0.1, 0, 0.2, 0.7], atol=0.01)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from deepdeep.training import TrainingController
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def get_controller(fit_time=0.1, **kwargs):
+    clock = FakeClock()
+    fits = []
+
+    def fit():
+        clock.now += fit_time
+        fits.append(clock.now)
+        return True
+
+    return TrainingController(fit, clock=clock, **kwargs), clock, fits
+
+
+def test_training_budget():
+    tc, clock, fits = get_controller(budget=0.2, max_batches_per_step=2)
+    assert tc.step() == 1  # minibatch cost is unknown yet
+    assert tc.fit_time == 0.1
+
+    # responses are processed continuously: each second gives 0.2s
+    # of credit, i.e. 2 minibatches
+    for _ in range(10):
+        clock.now += 1.0
+        tc.record_busy(1.0)
+        assert tc.step() <= 2
+    info = tc.tick()
+    assert 19 <= info['batches'] <= 21
+    assert info['idle_share'] == 0
+
+    # a single busy step after a long pause: credit is capped
+    clock.now += 100
+    tc.record_busy(0.5)
+    assert tc.step() == 2
+    assert tc.credit <= tc.max_credit
+
+
+def test_training_catch_up():
+    stats = {}
+
+    class Stats:
+        def set_value(self, key, value):
+            stats[key] = value
+
+    tc, clock, fits = get_controller(budget=0.5, max_batches=5,
+                                     stats=Stats())
+    tc.step()
+    clock.now += 10
+    tc.record_busy(1.0)
+    info = tc.tick()
+    assert info['idle_share'] > 0.5
+    assert info['batches'] == 6
+    assert stats['learning/batches'] == 6
+    assert stats['learning/interval/batches'] == 6
+
+    # reactor is busy: no catch-up
+    clock.now += 10
+    tc.record_busy(9.0)
+    assert tc.tick()['batches'] == 0
+
+
+def test_training_nothing_to_fit():
+    tc = TrainingController(lambda: False)
+    assert tc.step() == 0
+    assert tc.tick()['batches'] == 0